@@ -53,12 +53,20 @@ fg.clear_rules_from_all_proxies()
 fg.setup_failures(gremlins)
 testID = fg.start_new_test()
 print('test id: %s' % testID)
-print((
-    'Use `postman` to inject test requests,\n\twith HTTP header X-Gremlin-ID: <header-value>\n\tpress Enter key to '
-    'continue to validation phase'))
-a = sys.stdin.read(1)
-
-ac = AssertionChecker(checklist['log_server'], testID, debug=debugMode)
+if 'traffic' in checklist:
+    # 按 checklist 中的流量配置自动发送测试请求
+    report = run_traffic(checklist['traffic'], gremlins, debug=debugMode)
+    print('sent %d requests, %d completed, %d errors, statuses %s' % (
+        report.sent, report.completed, report.errors, report.statuses))
+else:
+    print((
+        'Use `postman` to inject test requests,\n\twith HTTP header X-Gremlin-ID: <header-value>\n\tpress Enter key to '
+        'continue to validation phase'))
+    a = sys.stdin.read(1)
+
+ac = AssertionChecker(checklist['log_server'], testID, debug=debugMode, start_time=fg.get_test_start_time())
+# 等待日志进入 ElasticSearch
+ac.wait_until_ingested()
 results = ac.check_assertions(checklist)
 exit_status = 0
 
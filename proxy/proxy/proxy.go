@@ -164,7 +164,7 @@ func (p *Proxy) proxyTCP(conn *net.TCPConn) {
 			"action":   "delay",
 			"rule":     rule.ToConfig(),
 			"testid":   p.getmyID(),
-			"ts":       t.Format("2006-01-02T15:04:05.999999"),
+			"ts":       t.UTC().Format("2006-01-02T15:04:05.999999"),
 		}).Info("Stream")
 		time.Sleep(rule.DelayTime)
 	}
@@ -178,7 +178,7 @@ func (p *Proxy) proxyTCP(conn *net.TCPConn) {
 			"action":   "abort",
 			"rule":     rule.ToConfig(),
 			"testid":   p.getmyID(),
-			"ts":       t.Format("2006-01-02T15:04:05.999999"),
+			"ts":       t.UTC().Format("2006-01-02T15:04:05.999999"),
 		}).Info("Stream")
 		conn.SetLinger(0)
 		conn.Close()
@@ -472,7 +472,7 @@ func (p *Proxy) executeRequestRule(reqID string, rule Rule, req *http.Request,
 		"delaytime":      delay.Nanoseconds() / (1000 * 1000), //actual time req was delayed in milliseconds
 		"errorcode":      errorCode,                           //actual error injected or -2
 		"uri":            req.RequestURI,
-		"ts":             t.Format("2006-01-02T15:04:05.999999"),
+		"ts":             t.UTC().Format("2006-01-02T15:04:05.999999"),
 		"rule":           rule.ToConfig(),
 	}).Info("Request")
 
@@ -526,7 +526,7 @@ func (p *Proxy) executeResponseRule(reqID string, rule Rule, resp *http.Response
 		"errorcode":      errorCode,                           //actual error injected or -2
 		"status":         resp.StatusCode,
 		"duration":       after.String(),
-		"ts":             t.Format("2006-01-02T15:04:05.999999"),
+		"ts":             t.UTC().Format("2006-01-02T15:04:05.999999"),
 		//log header/body?
 		"rule": rule.ToConfig(),
 	}).Info("Response")
@@ -594,10 +594,15 @@ func (p *Proxy) SetTestID(testID string) {
 		"source": config.ProxyFor,
 		"dest":   p.name,
 		"testid": testID,
-		"ts":     t.Format("2006-01-02T15:04:05.999999"),
+		"ts":     t.UTC().Format("2006-01-02T15:04:05.999999"),
 	}).Info("Test start")
 }
 
+// GetTestID returns the ID of the current test, empty when no test is set
+func (p *Proxy) GetTestID() string {
+	return p.testid
+}
+
 func (p *Proxy) getmyID() string {
 	return p.testid
 }
@@ -611,7 +616,7 @@ func (p *Proxy) StopTest(testID string) bool {
 	proxylog.WithFields(logrus.Fields{
 		"source": config.ProxyFor,
 		"dest":   p.name,
-		"ts":     t.Format("2006-01-02T15:04:05.999999"),
+		"ts":     t.UTC().Format("2006-01-02T15:04:05.999999"),
 		"testid": testID,
 	}).Info("Test stop")
 	return false
@@ -72,7 +72,8 @@ func (r *Router) exposeREST() {
 	hr.GET("/gremlin/v1/proxy/:service/instances", r.GetInstances)
 	hr.PUT("/gremlin/v1/proxy/:service/:instances", r.SetInstances)
 	hr.DELETE("/gremlin/v1/proxy/:service/instances", r.RemoveInstances)
-	// 对测试：设置、移除
+	// 对测试：获取、设置、移除
+	hr.GET("/gremlin/v1/test", r.GetTest)
 	hr.PUT("/gremlin/v1/test/:id", r.SetTest)
 	hr.DELETE("/gremlin/v1/test/:id", r.RemoveTest)
 	// 运行
@@ -228,6 +229,16 @@ func (r *Router) readRule(req *http.Request) (*services.Service, *proxy.Rule, er
 	return s, &rule, nil
 }
 
+// GetTest returns the ID of the current test, empty when no test is set
+func (r *Router) GetTest(w http.ResponseWriter, req *http.Request, _ httprouter.Params) {
+	testid := ""
+	if len(r.services) > 0 {
+		// SetTest sets the same ID on every service
+		testid = r.services[0].Proxy.GetTestID()
+	}
+	w.Write([]byte(testid))
+}
+
 // SetTest tells the router that a test with given ID will be happening
 func (r *Router) SetTest(w http.ResponseWriter, req *http.Request,
 	params httprouter.Params) {
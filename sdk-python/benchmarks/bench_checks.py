@@ -0,0 +1,178 @@
+#!/usr/bin/python
+# coding=utf-8
+"""断言检查的吞吐量基准 Benchmark every check in AssertionChecker.functiondict on synthetic logs
+
+用 SyntheticLog 生成不同规模的代理日志，对每个规模逐个运行所有检查，报告每秒处理的事件数和峰值内存。
+
+    python benchmarks/bench_checks.py --sizes 10k,100k,1m --backend ndjson --json results.json
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+from gremlin import AssertionChecker, EventStore, NDJSONSource, SegmentStore, SyntheticLog
+
+
+def parse_size(s: str) -> int:
+    """10k, 1m, 10M 形式的事件数"""
+    s = s.strip().lower()
+    for suffix, factor in (("k", 1000), ("m", 1000 * 1000)):
+        if s.endswith(suffix):
+            return int(float(s[:-1]) * factor)
+    return int(s)
+
+
+def answered_req_id(log: SyntheticLog, count: int) -> str:
+    """前 count 个事件中第一个 reviews 成功回复的 reqID"""
+    for event in log.events(count):
+        if event["msg"] == "Response" and event["dest"] == "reviews" and event["status"] == 200:
+            return event["reqID"]
+    raise ValueError("no successful reviews response in {} events".format(count))
+
+
+def check_kwargs(log: SyntheticLog, count: int) -> dict[str, dict]:
+    """与生成的日志相符的检查参数，检查都应该通过，从而处理全部事件"""
+    return {
+        'no_proxy_errors': {},
+        'bounded_response_time': dict(source='gateway', dest='productpage', max_latency='60s'),
+        'http_success_status': {},
+        'http_status': dict(source='productpage', dest='reviews', status=200,
+                            req_id=answered_req_id(log, count)),
+        'bounded_retries': dict(source='productpage', dest='reviews', retries=log.retries,
+                                wait_time='{}s'.format(log.retry_wait)),
+        'circuit_breaker': dict(source='productpage', dest='reviews', closed_attempts=log.closed_attempts,
+                                reset_time='{}s'.format(log.reset_time), headerprefix=log.headerprefix,
+                                halfopen_attempts=log.halfopen_attempts, by_instance=True),
+        'at_most_requests': dict(source='productpage', dest='reviews', num_requests=log.retries + 1),
+        'bounded_percentile_latency': dict(source='gateway', dest='productpage', max_latency='60s', percentile=99),
+        'automaton': breaker_automaton(log),
+    }
+
+
+# 只查询违例的检查，通过时没有命中，由测试的事件数确认找到了日志
+violation_checks = ('no_proxy_errors', 'at_most_requests')
+
+
+def breaker_automaton(log: SyntheticLog) -> dict:
+    """与 circuit_breaker 检查(by_instance)相同的断路器，写成自动机"""
+    failed_response = {"msg": "Response", "status": {"ne": 200}}
+    faulted_request = {"msg": "Request", "actions": {"regex": "^\\[.+\\]$"}}
+    closed_attempts = log.closed_attempts
+    return dict(
+        label='circuit breaker', source='productpage', dest='reviews', headerprefix=log.headerprefix,
+        key=['source', 'host'], initial='closed', counters=['failures', 'successes'],
+        transitions=[
+            {"from": "closed", "on": failed_response, "if": {"failures": {"ge": closed_attempts}}, "to": "open",
+             "reset": ["successes"]},
+            {"from": "closed", "on": failed_response, "inc": ["failures"]},
+            {"from": "closed", "on": faulted_request, "if": {"failures": {"ge": closed_attempts}}, "to": "open",
+             "reset": ["successes"]},
+            {"from": "closed", "on": faulted_request, "inc": ["failures"]},
+            {"from": "open", "if": {"elapsed": {"ge": "{}s".format(log.reset_time)}}, "to": "half-open",
+             "reset": ["failures"]},
+            {"from": "open", "on": {"msg": "Request"},
+             "fail": "{key} -> reviews - request {reqID} sent {elapsed} after the breaker opened"},
+            {"from": "half-open", "on": failed_response, "to": "open", "reset": ["successes"]},
+            {"from": "half-open", "on": {"msg": "Request", "actions": {"contains": "abort"}}, "to": "open",
+             "reset": ["successes"]},
+            {"from": "half-open", "on": {"msg": "Response"}, "if": {"successes": {"ge": log.halfopen_attempts}},
+             "to": "closed", "reset": ["failures", "successes"]},
+            {"from": "half-open", "on": {"msg": "Response"}, "inc": ["successes"]},
+        ])
+
+
+def load_backend(name: str, path: str, workdir: str):
+    if name == 'ndjson':
+        return NDJSONSource(path)
+    if name == 'store':
+        store = EventStore()
+    elif name == 'segments':
+        store = SegmentStore(tempfile.mkdtemp(prefix='segments-', dir=workdir))
+    else:
+        raise ValueError("Unknown backend {}".format(name))
+    with open(path) as fp:
+        for line in fp:
+            store.add(json.loads(line))
+    if name == 'segments':
+        store.flush()
+    return store
+
+
+def run(sizes: list[int], backend: str, workdir: str, seed: int, checks: list[str] or None, memory: bool) -> list[dict]:
+    results = []
+    for size in sizes:
+        log = SyntheticLog(seed=seed)
+        path = os.path.join(workdir, "synthetic-{}-{}.ndjson".format(size, seed))
+        if not os.path.exists(path):
+            start = time.perf_counter()
+            log.write_ndjson(path, size)
+            print("generated %d events in %.1fs" % (size, time.perf_counter() - start))
+        start = time.perf_counter()
+        source = load_backend(backend, path, workdir)
+        print("loaded %s backend in %.1fs" % (backend, time.perf_counter() - start))
+
+        ac = AssertionChecker(source, log.test_id)
+        found = ac.wait_until_ingested(expected_count=size, timeout=1)
+        assert found == size, "found {} of {} events".format(found, size)
+        kwargs = check_kwargs(log, size)
+        for name in ac.functiondict:
+            if checks is not None and name not in checks:
+                continue
+            if name not in kwargs:
+                print("%s: no benchmark parameters, skipped" % name)
+                continue
+            start = time.perf_counter()
+            result = ac.check_assertion(name=name, **kwargs[name])
+            elapsed = time.perf_counter() - start
+            # 参数与日志相符，检查失败或没有命中说明基准测的不是完整的检查
+            assert result.success, "{}: {}".format(name, result.errormsg)
+            assert name in violation_checks or result.profile.hits + result.profile.buckets > 0, \
+                "{}: no events found".format(name)
+            peak = None
+            if memory:
+                # 单独运行一次测量内存，tracemalloc 会明显拖慢检查
+                tracemalloc.start()
+                ac.check_assertion(name=name, **kwargs[name])
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            row = {
+                "events": size,
+                "check": name,
+                "success": result.success,
+                "seconds": elapsed,
+                "events_per_second": size / elapsed if elapsed > 0 else None,
+                "peak_bytes": peak,
+            }
+            results.append(row)
+            print("%10d %-28s %-5s %9.3fs %12.0f ev/s %10s" % (
+                size, name, "PASS" if result.success else "FAIL", elapsed, row["events_per_second"] or 0,
+                "%.1fMiB" % (peak / 1024 / 1024) if peak is not None else "-"))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AssertionChecker throughput benchmark")
+    parser.add_argument('--sizes', default="10k,100k,1m", help="事件数，逗号分隔，如 10k,100k,1m,10m")
+    parser.add_argument('--backend', default='ndjson', choices=['ndjson', 'store', 'segments'])
+    parser.add_argument('--checks', help="只运行这些检查，逗号分隔")
+    parser.add_argument('--workdir', help="生成日志的目录，已存在的日志会重复使用，缺省为临时目录")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', action='store_true', help="不测量峰值内存")
+    parser.add_argument('--json', help="结果写入 JSON 文件")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='gremlin-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    results = run([parse_size(s) for s in args.sizes.split(',')], args.backend, workdir, args.seed,
+                  args.checks.split(',') if args.checks else None, not args.no_memory)
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(results, fp, indent=2)
+
+
+if __name__ == '__main__':
+    main()
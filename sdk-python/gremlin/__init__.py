@@ -1,5 +1,21 @@
 # coding utf-8
 
 from .failuregenerator import *
+from .patterns import *
 from .assertionchecker import *
 from .applicationgraph import *
+from .events import *
+from .circuitbreaker import *
+from .automaton import *
+from .metrics import *
+from .eventsource import *
+from .multicluster import *
+from .querycache import *
+from .sketch import *
+from .transport import *
+from .profiling import *
+from .trafficgenerator import *
+from .collector import *
+from .segmentstore import *
+from .replay import *
+from .synthetic import *
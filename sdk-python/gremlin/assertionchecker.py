@@ -2,18 +2,29 @@
 # -*- coding: utf-8 -*-
 
 import datetime
+import functools
 import pprint
 import re
 import time
 from collections import defaultdict, namedtuple
 
-import isodate
-from elasticsearch import Elasticsearch
+from .automaton import Automaton, run_automata
+from .circuitbreaker import CircuitBreaker, breaker_sequences
+from .events import REQUEST, RESPONSE, Event, _format_duration, _format_ts, decode_events
+from .metrics import ResilienceMetrics, latency_buckets
+from .eventsource import EventSource, ElasticsearchSource
+from .multicluster import MultiClusterSource
+from .profiling import CheckProfile, QueryStats
+from .querycache import QueryCache
+from .sketch import QuantileSketch
 
 GremlinTestResult = namedtuple('GremlinTestResult', ['success', 'errormsg'])
-AssertionResult = namedtuple('AssertionResult', ['name', 'info', 'success', 'errormsg'])
+AssertionResult = namedtuple('AssertionResult', ['name', 'info', 'success', 'errormsg', 'profile'], defaults=(None,))
 
 max_query_results = 2 ** 31 - 1
+page_size = 10000  # 分页读取事件时每页的数量
+ts_format = "%Y-%m-%dT%H:%M:%S.%f"  # 代理日志中 ts 的格式，代理按 UTC 记录不带时区的时间
+time_window_slack = datetime.timedelta(seconds=1)  # 测试时间窗口两端放宽的时间，容忍时钟误差
 
 
 def _parse_duration(s: str) -> datetime.timedelta:
@@ -72,6 +83,50 @@ def _check_value_recursively(key, val, haystack) -> bool:
         return False
 
 
+def _over_limit_terms(field: str, limit: int) -> dict:
+    """按 field 分桶，只返回文档数超过 limit 的桶
+    terms aggregation that returns every bucket with more than *limit* documents and nothing else.
+    size 0 asks for all buckets (the default is only the top 10), min_doc_count keeps the
+    response down to the violating keys.
+    """
+    return {
+        "terms": {
+            "field": field,
+            "size": 0,
+            "min_doc_count": limit + 1
+        }
+    }
+
+
+def _decoded(responses: list[dict]) -> list[dict]:
+    """把结果中的命中解码为 Event，检查不再引用原来的命中字典"""
+    return [dict(response, hits=dict(response["hits"], hits=decode_events(response["hits"]["hits"])))
+            if response["hits"]["hits"] else response for response in responses]
+
+
+def _projected(bodies: list[dict], fields: tuple or None) -> list[dict]:
+    """让查询只返回检查需要的字段，不返回命中(size 0)或已经指定 _source 的查询不变"""
+    if fields is None:
+        return bodies
+    return [body if "_source" in body or body.get("size") == 0 else dict(body, _source=list(fields))
+            for body in bodies]
+
+
+def _ts_page(query: dict, window: dict or None, size: int) -> dict:
+    """按 ts 排序读取 query 匹配的 ts 和 duration，window 为 ts 的 range 条件，None 时从头读取"""
+    return {
+        "size": size,
+        "sort": [{"ts": {"order": "asc"}}],
+        "_source": ["ts", "duration"],
+        "query": {
+            "filtered": {
+                "query": query,
+                "filter": {"range": {"ts": window}} if window is not None else {"exists": {"field": "ts"}}
+            }
+        }
+    }
+
+
 def _get_by(key, val, l):
     """
     Out of list *l* return all elements that have *key=val*
@@ -88,18 +143,72 @@ def _get_by_id(ID, l):
     return _get_by("reqID", ID, l)
 
 
+def _batched(fields: tuple = None):
+    """检查以生成器编写：每次 yield 一组查询体，收到对应的一组结果，最后 return 检查结果。
+    包装后直接调用仍然同步返回 GremlinTestResult，check_assertions 通过 steps 取得生成器，
+    把多个检查的查询合并成一次 msearch。
+
+    Args:
+        fields: 检查读取的事件字段，查询只返回这些字段的 _source，结果中的命中解码为 Event;
+            None 表示返回完整的命中字典
+    """
+
+    def decorator(check):
+        @functools.wraps(check)
+        def wrapper(self, *args, **kwargs) -> GremlinTestResult:
+            return self._run(check(self, *args, **kwargs), fields)
+
+        wrapper.steps = check
+        wrapper.fields = fields
+        return wrapper
+
+    return decorator
+
+
 class AssertionChecker(object):
     """断言检查器 The assertion checker"""
 
-    def __init__(self, host, test_id, debug=False):
+    def __init__(self, host, test_id, debug=False, cache: QueryCache = None, finished: bool = False,
+                 start_time: datetime.datetime = None, end_time: datetime.datetime = None, index: str = None,
+                 log_timezone: datetime.tzinfo = datetime.timezone.utc, transport_options: dict = None,
+                 clusters: list = None):
         """
         Args:
-            host: the elasticsearch host
+            host: the elasticsearch host, 或同一集群的节点地址列表,
+                或者一个 EventSource 实例(如 NDJSONSource 读取本地日志、MultiClusterSource 查询多个集群)
             test_id: id of the test to which we are restricting the queries
+            cache: 可选 查询结果缓存，只在测试结束后使用
+            finished: 测试是否已经结束，也可以之后调用 finish()
+            start_time: 可选 测试开始时间，给出后所有查询只匹配测试时间窗口内的事件;
+                带时区的时间按其时区，不带时区的时间视为本机本地时间
+            end_time: 可选 测试结束时间，时区同 start_time，给出时测试视为已经结束
+            index: 可选 查询的索引，可以包含 strftime 日期格式(如 logstash-%Y.%m.%d)，
+                此时只查询覆盖测试时间窗口的索引; 缺省查询所有索引
+            log_timezone: 代理日志中 ts 的时区，时间窗口转换到这个时区后与 ts 比较; 代理按 UTC 记录
+            transport_options: 可选 到 ElasticSearch 的连接参数，如 {"pool_maxsize": 20, "compress_requests": True}，
+                见 ElasticsearchTransport; 同一进程内同一地址的连接共享，参数必须一致
+            clusters: 可选 多个集群的地址列表(每个元素是一个集群的地址或节点列表)，并发查询所有集群并合并结果，
+                此时 host 为 None; 用完后调用 close() 停止查询线程
         """
-        self._es = Elasticsearch(host)
+        if clusters is not None:
+            assert host is None, "pass either host or clusters"
+            self._backend: EventSource = MultiClusterSource(
+                [ElasticsearchSource(cluster, **(transport_options or {})) for cluster in clusters])
+        elif isinstance(host, EventSource):
+            self._backend: EventSource = host
+        else:
+            self._backend: EventSource = ElasticsearchSource(host, **(transport_options or {}))
+        self._owns_backend: bool = clusters is not None  # 传入的 EventSource 由调用者关闭
         self._id = test_id
         self.debug = debug
+        self._cache: QueryCache or None = cache
+        self._finished: bool = finished or end_time is not None
+        self.start_time: datetime.datetime or None = start_time
+        self.end_time: datetime.datetime or None = end_time
+        self._index: str or None = index
+        self.log_timezone: datetime.tzinfo = log_timezone
+        self._hooks: list = []
+        self._cache_invalidated: bool = False
         self.functiondict = {
             'no_proxy_errors': self.check_no_proxy_errors,
             'bounded_response_time': self.check_bounded_response_time,
@@ -107,7 +216,9 @@ class AssertionChecker(object):
             'http_status': self.check_http_status,
             'bounded_retries': self.check_bounded_retries,
             'circuit_breaker': self.check_circuit_breaker,
-            'at_most_requests': self.check_at_most_requests
+            'at_most_requests': self.check_at_most_requests,
+            'bounded_percentile_latency': self.check_bounded_percentile_latency,
+            'automaton': self.check_automaton
         }
 
     def _check_non_zero_results(self, data) -> bool:
@@ -115,11 +226,12 @@ class AssertionChecker(object):
         return data["hits"]["total"] != 0 and len(data["hits"]["hits"]) != 0
 
     # was ProxyErrorsBad
+    @_batched()
     def check_no_proxy_errors(self, **kwargs) -> GremlinTestResult:
         """代理本身相关的主要错误
         Helper method to determine if the proxies logged any major errors related to the functioning of the proxy itself
         """
-        data = self._es.search(body={
+        data, = yield [{
             "size": max_query_results,
             "query": {
                 "filtered": {
@@ -133,16 +245,17 @@ class AssertionChecker(object):
                     }
                 }
             }
-        })
+        }]
         #        if self.debug:
         #            print(data)
         return GremlinTestResult(data["hits"]["total"] == 0, data)
 
     # was ProxyErrors
+    @_batched()
     def get_requests_with_errors(self) -> GremlinTestResult:
         """ 代理传递的请求的错误
         Helper method to determine if proxies logged any error related to the requests passing through"""
-        data = self._es.search(body={
+        data, = yield [{
             "size": max_query_results,
             "query": {
                 "filtered": {
@@ -156,9 +269,10 @@ class AssertionChecker(object):
                     }
                 }
             }
-        })
+        }]
         return GremlinTestResult(False, data)
 
+    @_batched(fields=("reqID", "duration"))
     def check_bounded_response_time(self, **kwargs) -> GremlinTestResult:
         """检查返回时间
         对于当前测试，对指定起点、终点和时间限制，返回未超时 或 超时回复的相关信息，多个超时返回最后一个
@@ -166,8 +280,8 @@ class AssertionChecker(object):
         assert 'source' in kwargs and 'dest' in kwargs and 'max_latency' in kwargs
         dest = kwargs['dest']
         source = kwargs['source']
-        max_latency = _parse_duration(kwargs['max_latency'])
-        data = self._es.search(body={
+        max_latency = _parse_duration(kwargs['max_latency']) // datetime.timedelta(microseconds=1)
+        data, = yield [{
             "size": max_query_results,
             "query": {
                 "filtered": {
@@ -186,7 +300,7 @@ class AssertionChecker(object):
                     }
                 }
             }
-        })
+        }]
         if self.debug:
             pprint.pprint(data)
 
@@ -197,19 +311,111 @@ class AssertionChecker(object):
             errormsg = "No log entries found"
             return GremlinTestResult(result, errormsg)
 
-        for message in data["hits"]["hits"]:
-            if _parse_duration(message['_source']["duration"]) > max_latency:
+        for event in data["hits"]["hits"]:
+            if event.duration > max_latency:
                 result = False
                 # Request ID from service did not
                 errormsg = "{} did not reply in time for request {}, {}".format(
-                    dest, message['_source']["reqID"], message['_source']["duration"])
+                    dest, event.reqID, _format_duration(event.duration))
                 if self.debug:
                     print(errormsg)
         return GremlinTestResult(result, errormsg)
 
+    @_batched(fields=("ts", "duration"))
+    def check_bounded_percentile_latency(self, **kwargs) -> GremlinTestResult:
+        """检查回复时间的分位数，如 p99 < 200ms
+        Check that the given percentile of the response times from source to dest is within max_latency
+
+        有数值型的延迟字段(latency_field,毫秒)时使用 ElasticSearch percentiles 聚合，
+        否则按 ts 顺序分页读取 duration，用固定内存的 QuantileSketch 估计分位数。
+        每页从上一页最后一毫秒开始(ts 范围过滤，而不是 from 偏移)，这一毫秒的事件留到下一页一起读取，
+        分页在 ElasticSearch 排序不稳定时也不会重复或遗漏事件，每页的代价与已读取的事件数无关。
+        """
+        assert 'source' in kwargs and 'dest' in kwargs and 'max_latency' in kwargs
+        source = kwargs['source']
+        dest = kwargs['dest']
+        max_latency = _parse_duration(kwargs['max_latency'])
+        percentile = float(kwargs.get('percentile', 99))
+        latency_field = kwargs.get('latency_field')
+        assert 0.0 <= percentile <= 100.0
+
+        query = {
+            "filtered": {
+                "query": {
+                    "match_all": {}
+                },
+                "filter": {
+                    "bool": {
+                        "must": [
+                            {"term": {"msg": "Response"}},
+                            {"term": {"source": source}},
+                            {"term": {"dest": dest}},
+                            {"term": {"testid": self._id}}
+                        ]
+                    }
+                }
+            }
+        }
+
+        if latency_field is not None:
+            data, = yield [{
+                "size": 0,
+                "query": query,
+                "aggs": {
+                    "latency": {
+                        "percentiles": {
+                            "field": latency_field,
+                            "percents": [percentile]
+                        }
+                    }
+                }
+            }]
+            total = data["hits"]["total"]
+            value = next(iter(data["aggregations"]["latency"]["values"].values()))
+        else:
+            sketch = QuantileSketch()
+            after = None  # 下一页开始的毫秒，包括这一毫秒
+            while True:
+                window = {"gte": _format_ts(after * 1000)} if after is not None else None
+                data, = yield [_ts_page(query, window, page_size)]
+                hits = data["hits"]["hits"]
+                if len(hits) < page_size:
+                    for event in hits:
+                        sketch.add(event.duration / 1000)
+                    break
+                # ElasticSearch 的 ts 精确到毫秒，同一毫秒内的顺序不确定，最后一毫秒的事件下一页重新读取
+                last = hits[-1].ts // 1000
+                tail = len(hits)
+                while tail > 0 and hits[tail - 1].ts // 1000 == last:
+                    tail -= 1
+                if tail == 0:
+                    # 一毫秒内的事件超过一页，单独读取这一毫秒
+                    window = {"gte": _format_ts(last * 1000), "lt": _format_ts((last + 1) * 1000)}
+                    data, = yield [_ts_page(query, window, max_query_results)]
+                    hits = data["hits"]["hits"]
+                    tail = len(hits)
+                    last += 1
+                for event in hits[:tail]:
+                    sketch.add(event.duration / 1000)
+                after = last
+            total = sketch.count
+            value = sketch.quantile(percentile / 100)
+
+        if total == 0 or value is None:
+            return GremlinTestResult(False, "No log entries found")
+
+        observed = datetime.timedelta(milliseconds=value)
+        if self.debug:
+            print("%s -> %s p%g = %s" % (source, dest, percentile, observed))
+        if observed > max_latency:
+            return GremlinTestResult(False, "{} -> {} - p{:g} latency {} exceeds {}".format(
+                source, dest, percentile, observed, max_latency))
+        return GremlinTestResult(True, "")
+
+    @_batched(fields=("status",))
     def check_http_success_status(self, **kwargs) -> GremlinTestResult:
         """检查HTTP请求均成功返回200"""  # FIXME 成功且返回其他值?
-        data = self._es.search(body={
+        data, = yield [{
             "size": max_query_results,
             "query": {
                 "filtered": {
@@ -222,7 +428,7 @@ class AssertionChecker(object):
                         }
                     }
                 }
-            }})
+            }}]
         result = True
         errormsg = ""
         if not self._check_non_zero_results(data):
@@ -230,14 +436,15 @@ class AssertionChecker(object):
             errormsg = "No log entries found"
             return GremlinTestResult(result, errormsg)
 
-        for message in data["hits"]["hits"]:
-            if message['_source']["status"] != 200:
+        for event in data["hits"]["hits"]:
+            if event.status != 200:
                 if self.debug:
-                    print(message['_source'])
+                    print(event)
                 result = False
         return GremlinTestResult(result, errormsg)
 
     # check if the interaction between a given pair of services resulted in the required response status
+    @_batched(fields=("status",))
     def check_http_status(self, **kwargs) -> GremlinTestResult:
         """检查指定起点、终点和请求ID，是否均返回指定 HTTP 状态"""
         assert 'source' in kwargs and 'dest' in kwargs and 'status' in kwargs and 'req_id' in kwargs
@@ -245,7 +452,7 @@ class AssertionChecker(object):
         dest = kwargs['dest']
         status = kwargs['status']
         req_id = kwargs['req_id']
-        data = self._es.search(body={
+        data, = yield [{
             "size": max_query_results,
             "query": {
                 "filtered": {
@@ -258,14 +465,14 @@ class AssertionChecker(object):
                                 {"term": {"msg": "Response"}},
                                 {"term": {"source": source}},
                                 {"term": {"dest": dest}},
-                                {"term": {"req_id": req_id}},
+                                {"term": {"reqID": req_id}},
                                 {"term": {"protocol": "http"}},
                                 {"term": {"testid": self._id}}
                             ]
                         }
                     }
                 }
-            }})
+            }}]
 
         result = True
         errormsg = ""
@@ -274,13 +481,14 @@ class AssertionChecker(object):
             errormsg = "No log entries found"
             return GremlinTestResult(result, errormsg)
 
-        for message in data["hits"]["hits"]:
-            if message['_source']["status"] != status:
+        for event in data["hits"]["hits"]:
+            if event.status != status:
                 if self.debug:
-                    print(message['_source'])
+                    print(event)
                 result = False
         return GremlinTestResult(result, errormsg)
 
+    @_batched()
     def check_at_most_requests(self, source, dest, num_requests, **kwargs) -> GremlinTestResult:
         """起点到终点，不同请求ID的HTTP请求数，均不超过指定值
         Check that source service sent at most num_request to the dest service
@@ -295,8 +503,8 @@ class AssertionChecker(object):
             print('in check_at_most_requests (%s, %s, %s, %s)' % (source, dest, num_requests, self._id))
 
         # Fetch requests for src->dst
-        data = self._es.search(body={
-            "size": max_query_results,
+        data, = yield [{
+            "size": 0,  # 只需要聚合
             "query": {
                 "filtered": {
                     "query": {
@@ -316,16 +524,9 @@ class AssertionChecker(object):
                 }
             },
             "aggs": {
-                # Need size, otherwise only top buckets are returned
-                # "size": max_query_results,
-                # FIXME:所以现在只返回一个reqID?
-                "byid": {
-                    "terms": {
-                        "field": "reqID",
-                    }
-                }
+                "byid": _over_limit_terms("reqID", num_requests + 1)
             }
-        })
+        }]
         # 返回值格式参考: https://www.elastic.co/guide/cn/elasticsearch/guide/current/_aggregation_test_drive.html
 
         if self.debug:
@@ -333,12 +534,12 @@ class AssertionChecker(object):
 
         result = True
         errormsg = ""
-        if not self._check_non_zero_results(data):
+        if data["hits"]["total"] == 0:
             result = False
             errormsg = "No log entries found"
             return GremlinTestResult(result, errormsg)
 
-        # Check number of requests in each bucket
+        # Check number of requests in each bucket, only buckets over the limit are returned
         for bucket in data["aggregations"]["byid"]["buckets"]:
             if bucket["doc_count"] > (num_requests + 1):
                 errormsg = "{} -> {} - expected {} requests, but found {} " \
@@ -350,6 +551,7 @@ class AssertionChecker(object):
                 return GremlinTestResult(result, errormsg)
         return GremlinTestResult(result, errormsg)
 
+    @_batched(fields=("ts", "reqID", "uri"))
     def check_bounded_retries(self, **kwargs):
         """有界重试"""
         assert 'source' in kwargs and 'dest' in kwargs and 'retries' in kwargs
@@ -359,12 +561,13 @@ class AssertionChecker(object):
         wait_time = kwargs.pop('wait_time', None)  # 重试间隔时间
         errdelta = kwargs.pop('errdelta', datetime.timedelta(milliseconds=10))  # 重试间隔时间允许的+-误差
         by_uri = kwargs.pop('by_uri', False)
+        key_field = "reqID" if not by_uri else "uri"
 
         if self.debug:
             print('in bounded retries (%s, %s, %s)' % (source, dest, retries))
 
-        data = self._es.search(body={
-            "size": max_query_results,
+        data, = yield [{
+            "size": max_query_results if wait_time is not None else 0,  # 只需要聚合，检查重试间隔时才需要命中
             "query": {
                 "filtered": {
                     "query": {
@@ -383,25 +586,21 @@ class AssertionChecker(object):
                 }
             },
             "aggs": {
-                "byid": {
-                    "terms": {
-                        "field": "reqID" if not by_uri else "uri",
-                    }
-                }
+                "byid": _over_limit_terms(key_field, retries + 1)
             }
-        })
+        }]
 
         if self.debug:
             pprint.pprint(data)
 
         result = True
         errormsg = ""
-        if not self._check_non_zero_results(data):
+        if data["hits"]["total"] == 0:
             result = False
             errormsg = "No log entries found"
             return GremlinTestResult(result, errormsg)
 
-        # Check number of req first
+        # Check number of req first, only buckets over the limit are returned
         for bucket in data["aggregations"]["byid"]["buckets"]:
             if bucket["doc_count"] > (retries + 1):
                 errormsg = "{} -> {} - expected {} retries, but found {} retries for request {}".format(
@@ -414,16 +613,16 @@ class AssertionChecker(object):
             return GremlinTestResult(result, errormsg)
 
         wait_time = _parse_duration(wait_time)
-        # Now we have to check the timestamps
-        for bucket in data["aggregations"]["byid"]["buckets"]:
-            req_id = bucket["key"]
-            req_seq = _get_by_id(req_id, data["hits"]["hits"])
+        # Now we have to check the timestamps, 一次遍历按请求ID分组
+        req_seqs = defaultdict(list)
+        for event in data["hits"]["hits"]:
+            req_seqs[getattr(event, key_field)].append(event)
+        for req_id, req_seq in req_seqs.items():
             # 按时间升序排序
-            req_seq.sort(key=lambda x: isodate.parse_datetime(x['_source']["ts"]))
+            req_seq.sort(key=lambda x: x.ts)
             for i in range(len(req_seq) - 1):
                 # 检查重试间隔
-                observed = isodate.parse_datetime(req_seq[i + 1]['_source']["ts"]) - \
-                           isodate.parse_datetime(req_seq[i]['_source']["ts"])
+                observed = datetime.timedelta(microseconds=req_seq[i + 1].ts - req_seq[i].ts)
                 if not (((wait_time - errdelta) <= observed) or (observed <= (wait_time + errdelta))):
                     errormsg = "{} -> {} - expected {}+/-{}ms spacing for retry attempt {}, " \
                                "but request {} had a spacing of {}ms".format(
@@ -437,28 +636,35 @@ class AssertionChecker(object):
 
     # remove_retries is a boolean argument.
     # Set to true if reties are attempted inside circuit breaker logic, else set to false
+    @_batched(fields=("ts", "reqID", "msg", "status", "actions", "source", "dest", "host"))
     def check_circuit_breaker(self, **kwargs):  # dest, closed_attempts, reset_time, halfopen_attempts):
-        """断路器"""
-        assert 'dest' in kwargs and 'source' in kwargs and 'closed_attempts' in kwargs and 'reset_time' in kwargs and 'headerprefix' in kwargs
+        """断路器
+        每个调用方(by_instance 时每个调用方实例)独立运行一个 闭合/断开/半断开 状态机。
+        不指定 source 时检查 dest 的所有调用方。
+        """
+        assert 'dest' in kwargs and 'closed_attempts' in kwargs and 'reset_time' in kwargs and 'headerprefix' in kwargs
 
         dest = kwargs['dest']
-        source = kwargs['source']
+        source = kwargs.get('source')
         closed_attempts = kwargs['closed_attempts']
         reset_time = kwargs['reset_time']
         headerprefix = kwargs['headerprefix']
-        if 'halfopen_attempts' not in kwargs:
-            halfopen_attempts = 1
-        else:
-            halfopen_attempts = kwargs['halfopen_attempts']
-        if 'remove_retries' not in kwargs:
-            remove_retries = False
-        else:
-            remove_retries = kwargs['remove_retries']
+        halfopen_attempts = kwargs.get('halfopen_attempts', 1)
+        remove_retries = kwargs.get('remove_retries', False)
+        by_instance = kwargs.get('by_instance', False)  # 按代理实例(host)分别检查
+
+        must = [
+            {"term": {"dest": dest}},
+            {"prefix": {"reqID": headerprefix}},
+            {"term": {"testid": self._id}}
+        ]
+        if source is not None:
+            must.insert(0, {"term": {"source": source}})
 
         # TODO: 已针对阈值进行了测试，但未针对恢复进行测试
         #  this has been tested for thresholds but not for recovery
         # timeouts
-        data = self._es.search(body={
+        data, = yield [{
             "size": max_query_results,
             "query": {
                 "filtered": {
@@ -470,12 +676,7 @@ class AssertionChecker(object):
                             # FIXME 并列的must和should是逻辑与的关系，should必须匹配minimum_should_match个，
                             #  但只有HTTP请求有reqID,且HTTP msg必为Request/Response，不影响正确性
                             #  可能不同版本ES不同
-                            "must": [
-                                {"term": {"source": source}},
-                                {"term": {"dest": dest}},
-                                {"prefix": {"reqID": headerprefix}},
-                                {"term": {"testid": self._id}}
-                            ],
+                            "must": must,
                             "should": [
                                 {"term": {"msg": "Request"}},
                                 {"term": {"msg": "Response"}},
@@ -483,19 +684,11 @@ class AssertionChecker(object):
                         }
                     }
                 }
-            },
-            "aggs": {
-                "bysource": {
-                    "terms": {
-                        "field": "source",
-                    }
-                }
             }
-        })
+        }]
 
         if self.debug:
-            # pprint.pprint(data)
-            pprint.pprint(data["aggregations"]["bysource"]["buckets"])
+            pprint.pprint(data)
 
         result = True
         errormsg = ""
@@ -505,91 +698,31 @@ class AssertionChecker(object):
             return GremlinTestResult(result, errormsg)
 
         reset_time = _parse_duration(reset_time)
-        circuit_mode = "closed"  # 断路器状态
-
-        # TODO - remove aggregations
-        for bucket in data["aggregations"]["bysource"]["buckets"]:
-            req_seq = _get_by("source", source, data["hits"]["hits"])
-            req_seq.sort(key=lambda x: isodate.parse_datetime(x['_source']["ts"]))
-
-            # 移除reqID重复的请求 Remove duplicate retries
-            if remove_retries:
-                req_seq_dup = []
-                for i in range(len(req_seq)):
-                    if i == len(req_seq) - 1:
-                        req_seq_dup.append(req_seq[i])
-                    elif req_seq[i]['_source']['reqID'] != req_seq[i + 1]['_source']['reqID']:
-                        req_seq_dup.append(req_seq[i])
-
-                req_seq = req_seq_dup
-
-            failures = 0  # 闭合时失败次数
-            circuit_open_ts = None  # 当前断开状态的开始时间
-            successes = 0  # 半断开时成功次数
-            print("starting " + circuit_mode)
-            for req in req_seq:
-                if circuit_mode == "open":  # circuit_open_ts is not None:
-                    req_spacing = isodate.parse_datetime(req['_source']["ts"]) - circuit_open_ts
-                    # 重置时间后，进入半断开模式 Restore to half-open
-                    if req_spacing >= reset_time:
-                        circuit_open_ts = None
-                        circuit_mode = "half-open"
-                        if self.debug:
-                            print("%d: open -> half-open" % (failures + 1))
-                        failures = 0  # -1
-                    else:  # We are in open state
-                        # 出错：断开时不应该进行请求 this is an assertion fail, no requests in open state
-                        if req['_source']["msg"] == "Request":
-                            if self.debug:
-                                print("%d: open -> failure" % (failures + 1))
-                            if self.debug:
-                                print("Service %s failed to trip circuit breaker" % source)
-                            errormsg = "{} -> {} - new request was issued at ({}s) before reset_timer ({}s)expired".format(
-                                source, dest, req_spacing, reset_time)  # req['_source'])
-                            result = False
-                            break
-
-                elif circuit_mode == "half-open":
-                    if ((req['_source']["msg"] == "Response" and req['_source']["status"] != 200)
-                            or (req['_source']["msg"] == "Request" and ("abort" in req['_source']["actions"]))):
-                        # 半断开时请求中止 或 回复错误，断开
-                        if self.debug:
-                            print("half-open -> open")
-                        circuit_mode = "open"
-                        circuit_open_ts = isodate.parse_datetime(req['_source']["ts"])
-                        successes = 0
-                    elif req['_source']["msg"] == "Response" and req['_source']["status"] == 200:
-                        # 半断开时回复成功，成功计数+1
-                        successes += 1
-                        if self.debug:
-                            print("half-open -> half-open (%d)" % successes)
-                        # 半断开成功一定次数，重新闭合 If over threshold, return to closed state
-                        if successes > halfopen_attempts:
-                            if self.debug:
-                                print("half-open -> closed")
-                            circuit_mode = "closed"
-                            failures = 0
-                            circuit_open_ts = None
-
-                elif circuit_mode == "closed":
-                    if ((req['_source']["msg"] == "Response" and req['_source']["status"] != 200)
-                            or (req['_source']["msg"] == "Request" and len(req['_source']["actions"]) > 0)):
-                        # 闭合时回复失败 或 请求中止，累计失败次数 Increment failures
-                        failures += 1
-                        if self.debug:
-                            print("%d: closed->closed" % failures)
-                        # print(failures)
-                        # 失败超过门槛，断开 Trip CB, go to open state
-                        if failures > closed_attempts:
-                            if self.debug:
-                                print("%d: closed->open" % failures)
-                            circuit_open_ts = isodate.parse_datetime(req['_source']["ts"])
-                            successes = 0
-                            circuit_mode = "open"
-
-        # pprint.pprint(data)
+        reset_us = reset_time // datetime.timedelta(microseconds=1)
+
+        # 一次遍历按调用方分区
+        partitions = breaker_sequences(data["hits"]["hits"], dest, headerprefix, source, by_instance, remove_retries)
+        for key in sorted(partitions, key=str):
+            caller = "/".join(str(k) for k in key)
+            breaker = CircuitBreaker(closed_attempts, reset_us, halfopen_attempts)
+            if self.debug:
+                print("starting %s %s" % (caller, breaker.mode))
+            for req in partitions[key]:
+                transition = breaker.step(req)
+                if transition is not None and self.debug:
+                    print("%s: %s (failures %d, successes %d)" % (caller, transition, breaker.failures,
+                                                                  breaker.successes))
+                if transition == "open->failure":
+                    # 出错：断开时不应该进行请求 this is an assertion fail, no requests in open state
+                    if self.debug:
+                        print("Service %s failed to trip circuit breaker" % caller)
+                    req_spacing = datetime.timedelta(microseconds=req.ts - breaker.opened)
+                    return GremlinTestResult(False, "{} -> {} - new request was issued at ({}s) before reset_timer "
+                                                    "({}s)expired".format(caller, dest, req_spacing, reset_time))
+
         return GremlinTestResult(result, errormsg)
 
+    @_batched()
     def check_num_requests(self, source: str, dest: str, num_requests: int, **kwargs) -> GremlinTestResult:
         """检查所有请求头，起点到终点的总请求数 TODO 未使用
         Check that source service sent at exactly num_request to the dest service, in total, for all request headers
@@ -606,8 +739,8 @@ class AssertionChecker(object):
             print('in check_num_requests (%s, %s, %s, %s)' % (source, dest, num_requests, self._id))
 
         # Fetch requests for src->dst
-        data = self._es.search(body={
-            "size": max_query_results,
+        data, = yield [{
+            "size": 0,  # 只需要聚合
             "query": {
                 "filtered": {
                     "query": {
@@ -633,7 +766,7 @@ class AssertionChecker(object):
                     }
                 }
             }
-        })
+        }]
 
         if self.debug:
             pprint.pprint(data)
@@ -641,7 +774,7 @@ class AssertionChecker(object):
 
         result = True
         errormsg = ""
-        if not self._check_non_zero_results(data):
+        if data["hits"]["total"] == 0:
             result = False
             errormsg = "No log entries found"
             return GremlinTestResult(result, errormsg)
@@ -658,6 +791,7 @@ class AssertionChecker(object):
                 return GremlinTestResult(result, errormsg)
         return GremlinTestResult(result, errormsg)
 
+    @_batched(fields=("ts", "source"))
     def check_bulkhead(self, source, dependencies, slow_dest, rate) -> GremlinTestResult:
         """检查隔板bulkhead,部分依赖变慢时，对其它依赖的请求速度不变 TODO 未使用
         Asserts bulkheads by ensuring that the rate of requests to other dests is kept when slow_dest is slow
@@ -672,7 +806,7 @@ class AssertionChecker(object):
             检查结果
         """
         # Remove slow dest
-        dependencies.remove(slow_dest)
+        dependencies = [dest for dest in dependencies if dest != slow_dest]
 
         s = str(float(1) / float(rate))
         max_spacing = _parse_duration(s + 's')
@@ -680,28 +814,29 @@ class AssertionChecker(object):
         result: bool = True
         errormsg: str = ''
 
-        for dest in dependencies:
-            data = self._es.search(body={
-                "size": max_query_results,
-                "query": {
-                    "filtered": {
-                        "query": {
-                            "match_all": {}
-                        },
-                        "filter": {
-                            "bool": {
-                                "must": [
-                                    {"term": {"msg": "Request"}},
-                                    {"term": {"source": source}},
-                                    {"term": {"dest": dest}},
-                                    {"term": {"testid": self._id}}
-                                ]
-                            }
+        # 所有依赖的查询在一次往返中发出
+        responses = yield [{
+            "size": max_query_results,
+            "query": {
+                "filtered": {
+                    "query": {
+                        "match_all": {}
+                    },
+                    "filter": {
+                        "bool": {
+                            "must": [
+                                {"term": {"msg": "Request"}},
+                                {"term": {"source": source}},
+                                {"term": {"dest": dest}},
+                                {"term": {"testid": self._id}}
+                            ]
                         }
                     }
                 }
-            })
+            }
+        } for dest in dependencies]
 
+        for dest, data in zip(dependencies, responses):
             if self.debug:
                 pprint.pprint(data)
 
@@ -710,14 +845,14 @@ class AssertionChecker(object):
                 errormsg = "No log entries found"
                 return GremlinTestResult(result, errormsg)
 
-            req_seq = _get_by("source", source, data["hits"]["hits"])
-            req_seq.sort(key=lambda x: isodate.parse_datetime(x['_source']["ts"]))
+            req_seq = [event for event in data["hits"]["hits"] if event.source == source]
+            req_seq.sort(key=lambda x: x.ts)
 
-            last_request = isodate.parse_datetime(req_seq[0]['_source']["ts"])
+            last_request = req_seq[0].ts
 
             for req in req_seq:
-                req_spacing = isodate.parse_datetime(req['_source']["ts"]) - last_request
-                last_request = isodate.parse_datetime(req['_source']["ts"])
+                req_spacing = datetime.timedelta(microseconds=req.ts - last_request)
+                last_request = req.ts
                 if self.debug:
                     print("spacing", req_spacing, max_spacing)
                 if req_spacing > max_spacing:
@@ -731,6 +866,273 @@ class AssertionChecker(object):
 
         return GremlinTestResult(result, errormsg)
 
+    @_batched(fields=Event.__slots__)
+    def check_automaton(self, **kwargs) -> GremlinTestResult:
+        """按声明的自动机检查事件序列，规格见 Automaton
+        Check the event stream against a declarative automaton spec
+
+        check_assertions 中所有 automaton 检查共用一次查询和一次遍历。
+        """
+        results = yield from self._automata_steps([Automaton(kwargs)])
+        return results[0]
+
+    def _automata_steps(self, automata: list[Automaton]):
+        """查询所有自动机的事件，在一次按时间顺序的遍历中运行，返回与 automata 一一对应的结果"""
+        scopes = [automaton.query_filters() for automaton in automata]
+        must = [{"term": {"testid": self._id}}]
+        if all(scopes):
+            # 所有自动机共同的条件直接放在 must 中(可以使用索引)，其余的至少满足一个
+            common = [clause for clause in scopes[0] if all(clause in scope for scope in scopes[1:])]
+            rest = []
+            for scope in scopes:
+                scope = [clause for clause in scope if clause not in common]
+                if scope not in rest:
+                    rest.append(scope)
+            must += common
+            if all(rest):
+                must.append({"bool": {"should": [{"bool": {"must": scope}} for scope in rest]}})
+        data, = yield [{
+            "size": max_query_results,
+            "_source": sorted({field for automaton in automata for field in automaton.fields}),
+            "query": {
+                "filtered": {
+                    "query": {
+                        "match_all": {}
+                    },
+                    "filter": {
+                        "bool": {
+                            "must": must
+                        }
+                    }
+                }
+            }
+        }]
+        return [GremlinTestResult(not errormsg, errormsg)
+                for errormsg in run_automata(automata, data["hits"]["hits"], self.debug)]
+
+    @_batched(fields=("ts", "msg", "status", "source", "dest", "reqID", "host", "actions", "duration"))
+    def collect_metrics(self, checklist: dict = None, buckets: tuple = latency_buckets) -> ResilienceMetrics:
+        """统计测试中每条调用边的弹性指标 Per-edge resilience metrics of the test
+
+        一次查询取得测试的所有事件，在一次遍历中统计请求数、回复状态、回复时间直方图、重试和注入的故障。
+        checklist 中有 circuit_breaker 检查时，按检查的参数统计对应调用边的断路器断开次数。
+
+        Args:
+            checklist: 可选 checklist.json 的内容
+            buckets: 回复时间直方图的桶上界(秒)
+
+        Returns:
+            ResilienceMetrics，to_dict() 为 JSON，to_prometheus() 为 Prometheus 文本格式
+        """
+        breakers = [check for check in (checklist or {}).get('checks', []) if check.get('name') == 'circuit_breaker']
+        data, = yield [{
+            "size": max_query_results,
+            "query": {
+                "filtered": {
+                    "query": {
+                        "match_all": {}
+                    },
+                    "filter": {
+                        "term": {"testid": self._id}
+                    }
+                }
+            }
+        }]
+        metrics = ResilienceMetrics(self._id, buckets)
+        metrics.add_events(data["hits"]["hits"], breakers)
+        if self.debug:
+            print(metrics.to_prometheus())
+        return metrics
+
+    def _run(self, steps, fields: tuple = None, profile: CheckProfile = None) -> GremlinTestResult:
+        """驱动一个检查：发出它产生的查询，把结果送回，直到检查返回结果"""
+        if profile is None:
+            profile = CheckProfile("")
+        start = time.perf_counter()
+        try:
+            bodies = next(steps)
+            profile.build += time.perf_counter() - start
+            while True:
+                stats = QueryStats()
+                responses = self._msearch(_projected(bodies, fields), stats)
+                profile.add_responses(responses)
+                profile.add_stats(stats)
+                evaluate_start = time.perf_counter()
+                try:
+                    bodies = steps.send(_decoded(responses) if fields is not None else responses)
+                finally:
+                    profile.evaluate += time.perf_counter() - evaluate_start
+        except StopIteration as stop:
+            return stop.value
+        finally:
+            profile.elapsed = time.perf_counter() - start
+
+    def close(self):
+        """释放检查器创建的事件来源的资源(如 clusters 的查询线程)，传入的 EventSource 由调用者关闭"""
+        if self._owns_backend and isinstance(self._backend, MultiClusterSource):
+            self._backend.close()
+
+    def __enter__(self) -> 'AssertionChecker':
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def finish(self):
+        """标记测试已结束，之后日志不再变化，查询结果可以缓存。没有给出结束时间时以当前时间为结束时间"""
+        self._finished = True
+        if self.end_time is None:
+            self.end_time = datetime.datetime.now(datetime.timezone.utc)
+
+    def wait_until_ingested(self, expected_count: int = None, quiet_period: str or float = "2s",
+                            timeout: str or float = "60s", min_interval: float = 0.1,
+                            max_interval: float = 2.0) -> int:
+        """等待测试的日志进入日志服务器，代替检查前固定的等待或手动确认
+        Ingestion barrier: poll the event count of the test until it settles
+
+        日志经过 代理 -> UDP -> Logstash -> ElasticSearch 才能被查询，过早检查会得到 "No log entries found"。
+        反复查询测试ID的事件数(_count，不返回命中)，事件数变化时缩短查询间隔，不变时间隔加倍直到 max_interval。
+
+        Args:
+            expected_count: 可选 预期的事件数，达到后立即返回
+            quiet_period: 没有给出 expected_count 时，事件数大于0且保持不变这么久后返回，秒或时间字符串如 "2s"
+            timeout: 最长等待时间，秒或时间字符串
+            min_interval: 最短查询间隔(秒)
+            max_interval: 最长查询间隔(秒)
+
+        Returns:
+            最后一次查询到的事件数，超时时可能小于 expected_count
+        """
+        if isinstance(quiet_period, str):
+            quiet_period = _parse_duration(quiet_period).total_seconds()
+        if isinstance(timeout, str):
+            timeout = _parse_duration(timeout).total_seconds()
+        assert 0 < min_interval <= max_interval
+
+        body = self._scoped({
+            "query": {
+                "filtered": {
+                    "query": {
+                        "match_all": {}
+                    },
+                    "filter": {
+                        "term": {"testid": self._id}
+                    }
+                }
+            }
+        })
+        index = self._indices()
+        start = time.monotonic()
+        deadline = start + timeout
+        interval = min_interval
+        count = -1
+        changed = start
+        while True:
+            now = time.monotonic()
+            current = self._backend.count(body, index)
+            if current != count:
+                count = current
+                changed = now
+                interval = min_interval
+            else:
+                interval = min(interval * 2, max_interval)
+            if expected_count is not None:
+                if count >= expected_count:
+                    break
+            elif count > 0 and now - changed >= quiet_period:
+                break
+            if now >= deadline:
+                if self.debug:
+                    print("wait_until_ingested: timed out after %.1fs with %d events" % (now - start, count))
+                break
+            time.sleep(max(0.0, min(interval, deadline - time.monotonic())))
+        if self.debug:
+            print("wait_until_ingested: %d events after %.1fs" % (count, time.monotonic() - start))
+        return count
+
+    def _scoped(self, body: dict) -> dict:
+        """给查询加上测试时间窗口的 ts 范围过滤"""
+        if self.start_time is None:
+            return body
+        window = {"gte": self._log_time(self.start_time - time_window_slack)}
+        if self.end_time is not None:
+            window["lte"] = self._log_time(self.end_time + time_window_slack)
+        body = dict(body)
+        body["query"] = {
+            "filtered": {
+                "query": body.get("query", {"match_all": {}}),
+                "filter": {
+                    "range": {
+                        "ts": window
+                    }
+                }
+            }
+        }
+        return body
+
+    def _log_time(self, t: datetime.datetime) -> str:
+        """把时间转换为代理日志 ts 的时区和格式，不带时区的时间视为本地时间"""
+        return t.astimezone(self.log_timezone).strftime(ts_format)
+
+    def _indices(self) -> str or None:
+        """覆盖测试时间窗口的索引，Logstash 按 UTC 日期建立索引"""
+        if self._index is None or '%' not in self._index or self.start_time is None:
+            return self._index
+        end_time = self.end_time or datetime.datetime.now(datetime.timezone.utc)
+        # 转换为 UTC 日期
+        day = (self.start_time - time_window_slack).astimezone(datetime.timezone.utc).date()
+        last = (end_time + time_window_slack).astimezone(datetime.timezone.utc).date()
+        indices = []
+        while day <= last:
+            indices.append(day.strftime(self._index))
+            day += datetime.timedelta(days=1)
+        return ",".join(indices)
+
+    def _msearch(self, bodies: list[dict], stats: QueryStats = None) -> list[dict]:
+        """执行一组查询，测试结束后先查缓存"""
+        bodies = [self._scoped(body) for body in bodies]
+        if self._cache is None:
+            return self._query(bodies, stats)
+
+        host = self._backend.cache_key()
+        if not self._finished:
+            # 测试仍在进行，之前缓存的结果已经过时
+            if not self._cache_invalidated:
+                self._cache.invalidate(host, self._id)
+                self._cache_invalidated = True
+            return self._query(bodies, stats)
+
+        responses = [self._cache.get(host, self._id, body) for body in bodies]
+        missing = [i for i, response in enumerate(responses) if response is None]
+        if missing:
+            for i, response in zip(missing, self._query([bodies[i] for i in missing], stats)):
+                self._cache.put(host, self._id, bodies[i], response)
+                responses[i] = response
+        return responses
+
+    def _query(self, bodies: list[dict], stats: QueryStats = None) -> list[dict]:
+        """在一次往返中执行一组查询"""
+        index = self._indices()
+        if len(bodies) == 1:
+            return [self._backend.search(bodies[0], index, stats)]
+        return self._backend.msearch(bodies, index, stats)
+
+    def add_hook(self, hook):
+        """添加检查完成时调用的钩子，参数为带 profile 的 AssertionResult，可用于记录耗时回归"""
+        self._hooks.append(hook)
+
+    def _assertion_result(self, name: str, kwargs: dict, gremlin_test_result: GremlinTestResult,
+                          profile: CheckProfile = None) -> AssertionResult:
+        if self.debug and not gremlin_test_result.success:
+            print(gremlin_test_result.errormsg)
+        if self.debug and profile is not None:
+            print(profile)
+
+        result = AssertionResult(name, str(kwargs), gremlin_test_result.success, gremlin_test_result.errormsg, profile)
+        for hook in self._hooks:
+            hook(result)
+        return result
+
     def check_assertion(self, name=None, **kwargs) -> AssertionResult:
         """检查断言"""
         # assertion is something like {"name": "bounded_response_time",
@@ -738,27 +1140,90 @@ class AssertionChecker(object):
         #                              "max_latency": "100ms"}
 
         assert name is not None and name in self.functiondict
-        gremlin_test_result = self.functiondict[name](**kwargs)
-
-        if self.debug and not gremlin_test_result.success:
-            print(gremlin_test_result.errormsg)
-
-        return AssertionResult(name, str(kwargs), gremlin_test_result.success, gremlin_test_result.errormsg)
+        check = self.functiondict[name]
+        profile = CheckProfile(name)
+        gremlin_test_result = self._run(check.steps(self, **kwargs), check.fields, profile)
+        return self._assertion_result(name, kwargs, gremlin_test_result, profile)
 
     def check_assertions(self, checklist: dict, all: bool = False) -> list[AssertionResult]:
         """检查断言集Check a set of assertions
 
+        所有检查同时进行，每一轮把各个检查等待的查询合并为一次 msearch 发出，再把结果分发回各个检查。
+        all 为 False 时，一个检查失败后排在它之后的检查不再发出查询，排在它之前的检查继续进行。
+
         Args:
             checklist: ElasticSearch地址和断言信息
-            all: False发现出错立即返回, True即使出错也全部检查完才返回
+            all: False返回到第一个出错的断言为止, True返回全部断言的结果
         """
 
         assert isinstance(checklist, dict) and 'checks' in checklist
 
-        retlist: list[AssertionResult] = []
-
+        checks: list[tuple[str, dict]] = []
         for assertion in checklist['checks']:
-            retval = self.check_assertion(**assertion)
+            kwargs = dict(assertion)
+            name = kwargs.pop('name', None)
+            assert name is not None and name in self.functiondict
+            checks.append((name, kwargs))
+
+        results: list[GremlinTestResult or None] = [None] * len(checks)
+        profiles: list[CheckProfile] = [CheckProfile(name) for name, _ in checks]
+        waiting: dict = {}  # 等待查询结果的检查 序号 -> (steps, bodies)
+        # 所有 automaton 检查合并为一个，由第一个的序号代表
+        automata = [i for i, (name, _) in enumerate(checks) if name == 'automaton']
+        first_failure = len(checks)  # 已失败的检查中排在最前的序号
+        start = time.perf_counter()
+
+        def advance(i, steps, responses):
+            nonlocal first_failure
+            step_start = time.perf_counter()
+            try:
+                if responses is not None and self.functiondict[checks[i][0]].fields is not None:
+                    responses = _decoded(responses)
+                waiting[i] = (steps, steps.send(responses))
+            except StopIteration as stop:
+                finished = zip(automata, stop.value) if automata and i == automata[0] else [(i, stop.value)]
+                for j, result in finished:
+                    results[j] = result
+                    if not result.success:
+                        first_failure = min(first_failure, j)
+                profiles[i].elapsed = time.perf_counter() - start
+            finally:
+                if responses is None:
+                    profiles[i].build += time.perf_counter() - step_start
+                else:
+                    profiles[i].evaluate += time.perf_counter() - step_start
+
+        for i, (name, kwargs) in enumerate(checks):
+            if name != 'automaton':
+                advance(i, self.functiondict[name].steps(self, **kwargs), None)
+        if automata:
+            advance(automata[0], self._automata_steps([Automaton(checks[i][1]) for i in automata]), None)
+
+        while waiting:
+            if not all:
+                # 结果只返回到第一个失败的检查为止，之后的检查不再需要
+                for i in [i for i in waiting if i > first_failure]:
+                    waiting.pop(i)[0].close()
+                if not waiting:
+                    break
+            batch = list(waiting.items())
+            waiting.clear()
+            stats = QueryStats()
+            responses = self._msearch([body for i, (_, bodies) in batch
+                                       for body in _projected(bodies, self.functiondict[checks[i][0]].fields)],
+                                      stats)
+            offset = 0
+            for i, (steps, bodies) in batch:
+                profiles[i].add_responses(responses[offset:offset + len(bodies)])
+                profiles[i].add_stats(stats, len(bodies) / len(responses))
+                advance(i, steps, responses[offset:offset + len(bodies)])
+                offset += len(bodies)
+        for i in automata[1:]:
+            profiles[i] = profiles[automata[0]]
+
+        retlist: list[AssertionResult] = []
+        for (name, kwargs), gremlin_test_result, profile in zip(checks, results, profiles):
+            retval = self._assertion_result(name, kwargs, gremlin_test_result, profile)
             retlist.append(retval)
             if not retval.success and not all:
                 print("Error message:", retval[3])
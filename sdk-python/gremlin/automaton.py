@@ -0,0 +1,384 @@
+# coding=utf-8
+
+import operator
+import string
+
+from .events import Event, _format_duration, _msg_index, _parse_duration_us, msg_kinds
+from .patterns import compile_pattern
+
+# 比较运算 op -> (事件或状态的值, 规格中的值) -> bool
+_ops = {
+    "eq": operator.eq,
+    "ne": operator.ne,
+    "lt": operator.lt,
+    "le": operator.le,
+    "gt": operator.gt,
+    "ge": operator.ge,
+    "in": lambda value, expected: value in expected,
+    "not_in": lambda value, expected: value not in expected,
+    "prefix": lambda value, expected: value.startswith(expected),
+    "contains": lambda value, expected: expected in value,
+    "regex": lambda value, expected: expected.search(value) is not None,
+}
+# 守卫中可以使用的时间: 在当前状态停留的时间，距离该分区上一个事件的时间
+_timers = ("elapsed", "gap")
+# 错误信息模板中除计数器和事件字段外可以使用的名字
+_template_names = ("label", "key", "state") + _timers
+
+
+def _spec_value(field: str, value):
+    """把规格中的值转换为 Event 中的表示: msg 为序号，duration 和时间为微秒"""
+    if isinstance(value, (list, tuple)):
+        return tuple(_spec_value(field, v) for v in value)
+    if field == "msg":
+        assert value in _msg_index, "Unknown msg {!r}, expected one of {}".format(value, msg_kinds)
+        return _msg_index[value]
+    if field == "duration" or field in _timers:
+        assert isinstance(value, str), "{} must be a duration string such as '200ms'".format(field)
+        return _parse_duration_us(value)
+    return value
+
+
+def _compile_test(field: str, condition) -> tuple:
+    """一个字段的条件编译为 (字段, [(运算, 值)])，不是运算字典的值表示相等"""
+    if not isinstance(condition, dict):
+        condition = {"eq": condition}
+    tests = []
+    for op, value in condition.items():
+        assert op in _ops, "Unknown operator {!r} for {}, expected one of {}".format(op, field, list(_ops))
+        if op == "regex":
+            value = compile_pattern(value)
+        elif op not in ("prefix", "contains"):
+            value = _spec_value(field, value)
+        tests.append((op, value))
+    return field, tests
+
+
+def _getter(name: str, counter_index: dict):
+    """(事件, 分区状态) -> 事件字段、计数器或计时器的值"""
+    if name == "elapsed":
+        return lambda event, run: event.ts - run.entered
+    if name == "gap":
+        return lambda event, run: event.ts - run.last if run.last is not None else None
+    if name in counter_index:
+        i = counter_index[name]
+        return lambda event, run: run.counters[i]
+    return lambda event, run: getattr(event, name)
+
+
+def _predicate(name: str, tests: list, counter_index: dict):
+    """一个值的条件编译为 (事件, 分区状态) -> bool，常见的单个相等条件直接比较
+
+    值缺失(None)时条件不成立，ne 和 not_in 也一样，请求事件没有 status 不会被当作失败。
+    """
+    if len(tests) == 1 and tests[0][0] == "eq" and name not in counter_index and name not in _timers:
+        expected = tests[0][1]
+        return lambda event, run: getattr(event, name) == expected
+    get = _getter(name, counter_index)
+    checks = [(_ops[op], expected) for op, expected in tests]
+    if len(checks) == 1:
+        fn, expected = checks[0]
+
+        def test(event, run) -> bool:
+            value = get(event, run)
+            return value is not None and fn(value, expected)
+        return test
+
+    def test(event, run) -> bool:
+        value = get(event, run)
+        return value is not None and all(fn(value, expected) for fn, expected in checks)
+    return test
+
+
+def _conjunction(predicates: list):
+    """多个条件的与，没有条件时为 None(总是成立)"""
+    if not predicates:
+        return None
+    if len(predicates) == 1:
+        return predicates[0]
+
+    def test(event, run) -> bool:
+        for predicate in predicates:
+            if not predicate(event, run):
+                return False
+        return True
+    return test
+
+
+class _Transition(object):
+    """编译后的转移"""
+
+    __slots__ = ('test', 'inc', 'reset', 'to', 'fail', 'cont')
+
+    def __init__(self, test, inc: list, reset: list, to: int or None, fail: str or None, cont: bool):
+        self.test = test  # (事件, 分区状态) -> bool，事件条件在前，守卫在后; None 表示总是成立
+        self.inc = inc  # 计数器序号
+        self.reset = reset
+        self.to = to  # 目标状态序号，None 表示不变
+        self.fail = fail  # 错误信息模板
+        self.cont = cont  # 转移后是否继续用同一个事件匹配新状态的转移
+
+
+class _Run(object):
+    """一个分区上自动机的状态"""
+
+    __slots__ = ('state', 'entered', 'last', 'counters')
+
+    def __init__(self, state: int, ts: int, counters: int):
+        self.state = state
+        self.entered = ts  # 进入当前状态的时间
+        self.last = None  # 上一个事件的时间
+        self.counters = [0] * counters
+
+
+class Automaton(object):
+    """声明式的状态检查 Declarative stateful assertion compiled to an automaton
+
+    断路器、有界重试这样的检查都是按时间顺序扫描事件的状态机，新的弹性模式(限流、对冲请求、降级缓存等)
+    可以在 checklist.json 中声明，不需要再写一个扫描。规格::
+
+        {
+          "name": "automaton",
+          "label": "circuit breaker",
+          "source": "productpage", "dest": "reviews", "headerprefix": "testUser-",
+          "key": ["source", "host"],
+          "initial": "closed",
+          "counters": ["failures"],
+          "transitions": [
+            {"from": "closed", "on": {"msg": "Response", "status": {"ne": 200}},
+             "if": {"failures": {"ge": 2}}, "to": "open", "reset": ["failures"]},
+            {"from": "closed", "on": {"msg": "Response", "status": {"ne": 200}}, "inc": ["failures"]},
+            {"from": "closed", "on": {"msg": "Response", "status": 200}, "reset": ["failures"]},
+            {"from": "open", "if": {"elapsed": {"ge": "1s"}}, "to": "closed", "continue": true},
+            {"from": "open", "on": {"msg": "Request"},
+             "fail": "{key}: request {reqID} sent {elapsed} after the breaker opened"}
+          ]
+        }
+
+    连续3个失败回复后断路器断开，成功回复清零失败计数，断开后1秒内不应再有请求。
+
+    source / dest / headerprefix 限定检查的事件，key 中的字段把事件分区，每个分区独立运行一个自动机。
+    每个事件只触发当前状态第一条满足条件的转移:
+
+    * from: 起始状态，状态列表，或 "*" 表示任意状态
+    * on: 事件字段的条件，字段为 Event 的属性，值为相等或 {运算: 值}，
+      运算有 eq ne lt le gt ge in not_in prefix contains regex; msg 用名字，duration 用时间字符串;
+      事件缺少该字段时条件不成立
+    * if: 计数器和计时器的条件，计时器 elapsed 是在当前状态停留的时间，gap 是距离分区上一个事件的时间
+    * inc / reset: 加一 / 清零的计数器; to: 目标状态，转移到自身时重新开始计时
+    * fail: 错误信息，可以引用 label key state elapsed gap、计数器和事件字段，检查在第一个错误处结束
+    * continue: 转移后继续用同一个事件匹配新状态的转移
+
+    事件结束时分区的状态不在 accept 中(给出时)也是错误。
+    """
+
+    def __init__(self, spec: dict):
+        """
+        Args:
+            spec: checklist.json 中的检查，name 之外的字段
+        """
+        spec = dict(spec)
+        spec.pop("name", None)
+        self.label: str = spec.get("label", "automaton")
+        self.source: str or None = spec.get("source")
+        self.dest: str or None = spec.get("dest")
+        self.headerprefix: str or None = spec.get("headerprefix")
+        self.key: tuple = tuple(spec.get("key", ()))
+        assert "initial" in spec and "transitions" in spec, "automaton needs initial and transitions"
+
+        self.states: list[str] = [spec["initial"]]
+        self._state_index: dict[str, int] = {spec["initial"]: 0}
+        self.counters: list[str] = list(spec.get("counters", []))
+        counter_index = {name: i for i, name in enumerate(self.counters)}
+        assert not set(counter_index) & set(_timers), "counters can not be named {}".format(_timers)
+
+        fields = {"ts"} | set(self.key)
+        if self.source is not None or self.dest is not None:
+            fields |= {"source", "dest"}
+        if self.headerprefix is not None:
+            fields.add("reqID")
+
+        compiled = []
+        for transition in spec["transitions"]:
+            unknown = set(transition) - {"from", "on", "if", "inc", "reset", "to", "fail", "continue"}
+            assert not unknown, "Unknown transition keys {}".format(sorted(unknown))
+            on = [_compile_test(field, condition) for field, condition in transition.get("on", {}).items()]
+            for field, _ in on:
+                # 拼错的字段总是缺失，条件永远不成立，转移也就不会触发
+                assert field in Event.__slots__, \
+                    "Unknown event field {!r} in 'on', expected one of {}".format(field, Event.__slots__)
+            fields |= {field for field, _ in on}
+            # msg 的相等条件由转移表分派，不再逐个测试
+            msgs = None
+            for field, tests in on:
+                if field == "msg" and len(tests) == 1 and tests[0][0] in ("eq", "in"):
+                    msgs = set(tests[0][1]) if tests[0][0] == "in" else {tests[0][1]}
+                    on.remove((field, tests))
+                    break
+            guards = []
+            for name, condition in transition.get("if", {}).items():
+                assert name in counter_index or name in _timers, "Unknown counter {!r}".format(name)
+                guards.append(_compile_test(name, condition))
+            for name in transition.get("inc", []) + transition.get("reset", []):
+                assert name in counter_index, "Unknown counter {!r}".format(name)
+            fail = transition.get("fail")
+            if fail is not None:
+                for _, name, _, _ in string.Formatter().parse(fail):
+                    if name is None:
+                        continue
+                    assert name in _template_names or name in counter_index or name in Event.__slots__, \
+                        "Unknown name {{{}}} in {!r}".format(name, fail)
+                    if name in Event.__slots__:
+                        fields.add(name)
+            origins = transition.get("from", "*")
+            origins = [origins] if isinstance(origins, str) else list(origins)
+            compiled.append((origins, msgs, _Transition(
+                _conjunction([_predicate(field, tests, {}) for field, tests in on] +
+                             [_predicate(name, tests, counter_index) for name, tests in guards]),
+                [counter_index[name] for name in transition.get("inc", [])],
+                [counter_index[name] for name in transition.get("reset", [])],
+                self._state(transition["to"]) if "to" in transition else None, fail,
+                bool(transition.get("continue", False)))))
+        self.accept: frozenset or None = frozenset(self._state(state) for state in spec["accept"]) \
+            if "accept" in spec else None
+
+        unknown = fields - set(Event.__slots__)
+        assert not unknown, "Unknown event fields {}, expected {}".format(sorted(unknown), Event.__slots__)
+        self.fields: tuple = tuple(sorted(fields))
+
+        # 转移表: 状态 -> msg 序号 -> 可能触发的转移，保持规格中的顺序; 最后一项用于没有 msg 的事件
+        self._table: list[list[list[_Transition]]] = [[[] for _ in range(len(msg_kinds) + 1)] for _ in self.states]
+        for origins, msgs, transition in compiled:
+            for state in origins:
+                assert state == "*" or state in self._state_index, "Unknown state {!r}".format(state)
+            for state in (range(len(self.states)) if "*" in origins else [self._state_index[s] for s in origins]):
+                for msg, transitions in enumerate(self._table[state]):
+                    if msgs is None or msg in msgs:
+                        transitions.append(transition)
+        if len(self.key) == 1:
+            field, = self.key
+            self._key = lambda event: (getattr(event, field),)
+        else:
+            self._key = operator.attrgetter(*self.key) if self.key else lambda event: ()
+        # 一个事件最多连续触发的转移数，防止 continue 形成环
+        self._max_chain = len(compiled)
+
+    def _state(self, name: str) -> int:
+        if name not in self._state_index:
+            self._state_index[name] = len(self.states)
+            self.states.append(name)
+        return self._state_index[name]
+
+    def query_filters(self) -> list[dict]:
+        """限定检查事件的过滤条件，没有限定时为空"""
+        must = []
+        if self.source is not None:
+            must.append({"term": {"source": self.source}})
+        if self.dest is not None:
+            must.append({"term": {"dest": self.dest}})
+        if self.headerprefix is not None:
+            must.append({"prefix": {"reqID": self.headerprefix}})
+        return must
+
+    def _message(self, template: str, key: tuple, run: _Run, event: Event) -> str:
+        values = {name: getattr(event, name) for name in Event.__slots__}
+        values.update(event.to_dict())
+        values.update(zip(self.counters, run.counters))
+        values.update(label=self.label, key="/".join(str(k) for k in key), state=self.states[run.state],
+                      elapsed=_format_duration(event.ts - run.entered),
+                      gap=_format_duration(event.ts - run.last) if run.last is not None else None)
+        return template.format_map(values)
+
+    def _step(self, key: tuple, run: _Run, event: Event, debug: bool) -> str:
+        """用一个事件推进自动机，返回错误信息，没有错误时为空串"""
+        ts = event.ts
+        for _ in range(self._max_chain):
+            for transition in self._table[run.state][event.msg if event.msg is not None else -1]:
+                if transition.test is None or transition.test(event, run):
+                    break
+            else:
+                break
+            if transition.fail is not None:
+                return self._message(transition.fail, key, run, event)
+            for i in transition.inc:
+                run.counters[i] += 1
+            for i in transition.reset:
+                run.counters[i] = 0
+            if transition.to is not None:
+                if debug:
+                    print("%s %s: %s -> %s" % (self.label, "/".join(str(k) for k in key),
+                                               self.states[run.state], self.states[transition.to]))
+                run.state = transition.to
+                run.entered = ts
+            if not transition.cont:
+                break
+        run.last = ts
+        return ""
+
+
+def run_automata(automata: list[Automaton], events: list[Event], debug: bool = False) -> list[str]:
+    """在一次按时间顺序的遍历中运行所有自动机 Evaluate many automata in one ordered pass
+
+    Args:
+        automata: 编译后的自动机
+        events: 包含所有自动机所需字段的事件，不要求有序，没有 ts 的事件被忽略
+
+    Returns:
+        与 automata 一一对应的错误信息，通过时为空串
+    """
+    errors: list[str or None] = [None] * len(automata)  # None 表示还没有看到事件
+    runs: list[dict] = [{} for _ in automata]
+    # 按 (source, dest) 分派事件，不限定的一侧为 None
+    routes: dict[tuple, list[int]] = {}
+    for i, automaton in enumerate(automata):
+        routes.setdefault((automaton.source, automaton.dest), []).append(i)
+    wildcard_source = any(source is None for source, _ in routes)
+    wildcard_dest = any(dest is None for _, dest in routes)
+    dispatch: dict[tuple, list[int]] = {}  # (事件的 source, dest) -> 自动机序号
+    active = len(automata)
+
+    # 没有 ts 的事件无法排序，也不能计时
+    for event in sorted((event for event in events if event.ts is not None), key=lambda e: e.ts):
+        candidates = dispatch.get((event.source, event.dest))
+        if candidates is None:
+            # 事件缺少 source 或 dest 时只匹配不限定这一侧的自动机，每条路由只取一次
+            keys = {(event.source, event.dest)}
+            if wildcard_source:
+                keys.add((None, event.dest))
+            if wildcard_dest:
+                keys.add((event.source, None))
+                if wildcard_source:
+                    keys.add((None, None))
+            candidates = dispatch[(event.source, event.dest)] = sorted(i for key in keys for i in routes.get(key, []))
+        for i in candidates:
+            if errors[i]:
+                continue
+            automaton = automata[i]
+            if automaton.headerprefix is not None and \
+                    (event.reqID is None or not event.reqID.startswith(automaton.headerprefix)):
+                continue
+            key = automaton._key(event)
+            run = runs[i].get(key)
+            if run is None:
+                run = runs[i][key] = _Run(0, event.ts, len(automaton.counters))
+                if debug:
+                    print("%s %s: starting %s" % (automaton.label, "/".join(str(k) for k in key), automaton.states[0]))
+            errors[i] = automaton._step(key, run, event, debug)
+            if errors[i]:
+                if debug:
+                    print(errors[i])
+                active -= 1
+        if active == 0:
+            break
+
+    for i, automaton in enumerate(automata):
+        if errors[i] is None:
+            errors[i] = "No log entries found"
+        elif not errors[i] and automaton.accept is not None:
+            for key in sorted(runs[i], key=str):
+                run = runs[i][key]
+                if run.state not in automaton.accept:
+                    errors[i] = "{} {} - ended in state {}".format(
+                        automaton.label, "/".join(str(k) for k in key), automaton.states[run.state])
+                    break
+    return errors
@@ -0,0 +1,105 @@
+# coding=utf-8
+
+from .events import REQUEST, RESPONSE, Event
+
+
+def _has_actions(actions) -> bool:
+    """代理记录的 actions 是 "[delay,abort]" 形式的字符串，"[]" 表示没有注入故障"""
+    return actions is not None and len(actions) > 0 and actions != "[]"
+
+
+class CircuitBreaker(object):
+    """一个调用方的断路器状态机 Closed / open / half-open state machine of one caller
+
+    circuit_breaker 检查和断路器断开次数指标共用同一个状态机，对同一事件序列的判断一致:
+    闭合时回复错误或请求被注入故障计为失败，失败超过 closed_attempts 次断开;
+    断开 reset_time 后半断开，半断开时回复错误或请求被中止(abort)重新断开，成功超过 halfopen_attempts 次重新闭合。
+    """
+
+    __slots__ = ('closed_attempts', 'reset_us', 'halfopen_attempts', 'mode', 'failures', 'successes', 'opened')
+
+    def __init__(self, closed_attempts: int, reset_us: int, halfopen_attempts: int = 1):
+        """
+        Args:
+            closed_attempts: 闭合时允许的失败次数
+            reset_us: 断开到半断开的时间(微秒)
+            halfopen_attempts: 半断开时重新闭合需要的成功次数
+        """
+        self.closed_attempts: int = closed_attempts
+        self.reset_us: int = reset_us
+        self.halfopen_attempts: int = halfopen_attempts
+        self.mode: str = "closed"  # 断路器状态
+        self.failures: int = 0  # 闭合时失败次数
+        self.successes: int = 0  # 半断开时成功次数
+        self.opened: int or None = None  # 当前断开状态的开始时间(微秒)
+
+    def step(self, event: Event) -> str or None:
+        """按时间顺序输入一个事件
+
+        Returns:
+            发生的转移，如 "closed->open"; 断开期间发出请求(违反断路器行为)时为 "open->failure";
+            状态和计数都没有变化时为 None
+        """
+        if self.mode == "open":
+            # 重置时间后，进入半断开模式 Restore to half-open
+            if event.ts - self.opened >= self.reset_us:
+                self.mode, self.opened, self.failures = "half-open", None, 0
+                return "open->half-open"
+            # 断开时不应该进行请求 no requests in open state
+            return "open->failure" if event.msg == REQUEST else None
+
+        if self.mode == "half-open":
+            if (event.msg == RESPONSE and event.status != 200) or \
+                    (event.msg == REQUEST and event.actions is not None and "abort" in event.actions):
+                # 半断开时请求中止 或 回复错误，断开
+                self.mode, self.opened, self.successes = "open", event.ts, 0
+                return "half-open->open"
+            if event.msg == RESPONSE:
+                # 半断开成功一定次数，重新闭合 If over threshold, return to closed state
+                self.successes += 1
+                if self.successes > self.halfopen_attempts:
+                    self.mode, self.failures, self.opened = "closed", 0, None
+                    return "half-open->closed"
+                return "half-open->half-open"
+            return None
+
+        if (event.msg == RESPONSE and event.status != 200) or (event.msg == REQUEST and _has_actions(event.actions)):
+            # 闭合时回复失败 或 请求被注入故障，失败超过门槛时断开 Trip CB, go to open state
+            self.failures += 1
+            if self.failures > self.closed_attempts:
+                self.mode, self.opened, self.successes = "open", event.ts, 0
+                return "closed->open"
+            return "closed->closed"
+        return None
+
+
+def breaker_sequences(events: list[Event], dest: str, headerprefix: str, source: str = None,
+                      by_instance: bool = False, remove_retries: bool = False) -> dict[tuple, list[Event]]:
+    """把断路器相关的事件按调用方分区，每个分区按时间排序
+
+    Args:
+        events: 事件，只使用调用 dest、reqID 以 headerprefix 开头的请求和回复
+        source: 可选 只使用这个调用方的事件
+        by_instance: 按调用方实例 (source, host) 分区，否则按 (source,) 分区
+        remove_retries: 移除 reqID 相同的连续事件，只保留最后一个
+
+    Returns:
+        分区 -> 事件序列
+    """
+    partitions = {}
+    for event in events:
+        if event.dest != dest or (source is not None and event.source != source) or \
+                event.reqID is None or not event.reqID.startswith(headerprefix) or \
+                event.msg not in (REQUEST, RESPONSE):
+            continue
+        key = (event.source, event.host) if by_instance else (event.source,)
+        seq = partitions.get(key)
+        if seq is None:
+            seq = partitions[key] = []
+        seq.append(event)
+    for key, seq in partitions.items():
+        seq.sort(key=lambda e: e.ts)
+        # 移除reqID重复的请求 Remove duplicate retries
+        if remove_retries:
+            partitions[key] = [seq[i] for i in range(len(seq)) if i == len(seq) - 1 or seq[i].reqID != seq[i + 1].reqID]
+    return partitions
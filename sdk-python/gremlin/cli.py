@@ -0,0 +1,349 @@
+# coding=utf-8
+
+import argparse
+import datetime
+import json
+import os
+import sys
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from .applicationgraph import ApplicationGraph
+from .assertionchecker import AssertionChecker, AssertionResult
+from .collector import LogCollector
+from .eventsource import EventSource
+from .failuregenerator import FailureGenerator
+from .metrics import prometheus_text
+from .trafficgenerator import TrafficReport, run_traffic
+from .transport import close_transports
+
+Recipe = tuple[str, str, str]  # (checklist.json, gremlins_*.json, topology.json)
+
+
+def find_recipes(paths: list[str], topology: str = None) -> list[Recipe]:
+    """找出故障方案 Find recipes below the given paths
+
+    包含 checklist.json 的目录是一个方案目录，目录中每个 gremlins_*.json 是一次测试，
+    与同目录的 topology.json (或给出的 topology) 和 checklist.json 一起运行。
+
+    Args:
+        paths: 方案目录或其上级目录
+        topology: 可选 所有方案共用的拓扑文件
+    """
+    recipes: list[Recipe] = []
+    for path in paths:
+        assert os.path.isdir(path), "Recipe directory {} not found".format(path)
+        for directory, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            if 'checklist.json' not in filenames:
+                continue
+            topology_path = topology or os.path.join(directory, 'topology.json')
+            assert os.path.isfile(topology_path), "Topology file {} not found".format(topology_path)
+            for name in sorted(filenames):
+                if name.startswith('gremlins') and name.endswith('.json'):
+                    recipes.append((os.path.join(directory, 'checklist.json'), os.path.join(directory, name),
+                                    topology_path))
+    return recipes
+
+
+def _load(path: str) -> dict:
+    with open(path) as fp:
+        return json.load(fp)
+
+
+def _traffic_dict(report: TrafficReport) -> dict:
+    return {
+        "sent": report.sent,
+        "completed": report.completed,
+        "errors": report.errors,
+        "dropped": report.dropped,
+        "statuses": {str(status): count for status, count in report.statuses.items()},
+        "duration": report.duration,
+        "p50": report.latency.quantile(0.5),
+        "p99": report.latency.quantile(0.99),
+    }
+
+
+class RecipeRunner(object):
+    """非交互地依次运行多个故障方案 Run recipes back to back without prompts
+
+    拓扑相同的方案共用一个 ApplicationGraph 和 FailureGenerator(及其到代理的 keep-alive 连接)，
+    在本进程中检查断言时所有方案共用到日志服务器的连接池。
+    """
+
+    def __init__(self, log_server: str or list[str] or EventSource = None, quiet_period: str = "2s",
+                 ingest_timeout: str = "60s", traffic: bool = True, debug: bool = False, metrics: bool = False,
+                 clusters: list = None):
+        """
+        Args:
+            log_server: 可选 代替 checklist.json 中的 log_server，可以是同一集群的节点地址列表，
+                或 EventSource 实例(如 LogCollector 的 store)
+            clusters: 可选 多个集群的地址列表，代替 log_server，并发查询所有集群并合并结果
+            quiet_period: 等待日志入库时，事件数保持不变多久视为入库完成
+            ingest_timeout: 等待日志入库的最长时间
+            traffic: 是否按 checklist.json 中的 traffic 配置发送测试流量
+            metrics: 是否统计每条调用边的弹性指标，结果中的 metrics 为 ResilienceMetrics.to_dict()
+        """
+        self.log_server = log_server
+        self.quiet_period = quiet_period
+        self.ingest_timeout = ingest_timeout
+        self.traffic = traffic
+        self.debug = debug
+        self.metrics = metrics
+        self.clusters = clusters
+        self._generators: dict[str, FailureGenerator] = {}  # 规范化的拓扑 -> 故障生成器
+
+    def _failure_generator(self, topology: dict) -> FailureGenerator:
+        key = json.dumps(topology, sort_keys=True)
+        fg = self._generators.get(key)
+        if fg is None:
+            app = ApplicationGraph(topology)
+            if self.debug:
+                print("Using topology:\n", app, file=sys.stderr)
+            fg = self._generators[key] = FailureGenerator(app, debug=self.debug)
+        return fg
+
+    def _test(self, result: dict, checklist: dict, gremlins: dict, topology: dict) -> AssertionChecker:
+        """测试阶段：注入故障、发送流量、等待日志入库。代理同时只能进行一个测试，各方案的测试阶段依次进行
+
+        Returns:
+            测试已结束的 AssertionChecker
+        """
+        fg = self._failure_generator(topology)
+        # 所有代理同时切换到新规则和新测试ID，失败时恢复原来的规则
+        result["test_id"] = test_id = fg.start_test(gremlins)
+
+        # 发送流量或等待入库失败时也要清除故障，否则代理会一直注入故障
+        try:
+            if self.traffic and 'traffic' in checklist:
+                result["traffic"] = _traffic_dict(run_traffic(checklist['traffic'], gremlins, debug=self.debug))
+            elif self.debug:
+                print("%s: no traffic configured, checking existing logs" % result["gremlins"], file=sys.stderr)
+
+            ac = _checker(self._log_server(checklist), self.clusters, test_id, self.debug, fg.get_test_start_time())
+            try:
+                result["events"] = ac.wait_until_ingested(quiet_period=self.quiet_period,
+                                                          timeout=self.ingest_timeout)
+                ac.finish()
+            except BaseException:
+                ac.close()
+                raise
+        finally:
+            fg.clear_rules_from_all_proxies()
+        return ac
+
+    def _log_server(self, checklist: dict) -> str or list[str] or EventSource or None:
+        """方案使用的日志服务器，给出 clusters 时为 None"""
+        if self.clusters is not None:
+            return None
+        return self.log_server or checklist['log_server']
+
+    def run(self, checklist_path: str, gremlins_path: str, topology_path: str) -> dict:
+        """运行一个方案：注入故障、发送流量、等待日志入库、检查断言
+
+        Returns:
+            方案结果，出错时 error 为错误信息
+        """
+        start = time.perf_counter()
+        result = _new_result(checklist_path, gremlins_path)
+        try:
+            checklist = _load(checklist_path)
+            with self._test(result, checklist, _load(gremlins_path), _load(topology_path)) as ac:
+                _set_checks(result, [_check_dict(check) for check in ac.check_assertions(checklist, all=True)])
+                if self.metrics:
+                    result["metrics"] = ac.collect_metrics(checklist).to_dict()
+        except Exception as e:
+            result["error"] = "{}: {}".format(type(e).__name__, e)
+        result["elapsed"] = time.perf_counter() - start
+        return result
+
+    def run_all(self, recipes: list[Recipe], jobs: int = 1) -> list[dict]:
+        """运行多个方案，jobs 大于1时在进程池中检查断言
+        Run recipes, sharding the check phase across a process pool
+
+        测试阶段依次进行；每个方案测试阶段结束后，其断言分成至多 jobs 组(automaton 检查在同一组)提交到进程池，
+        与后续方案的测试阶段同时进行。每个工作进程有自己的 AssertionChecker 和到日志服务器的连接，
+        各组结果按断言原来的顺序合并。
+
+        Args:
+            recipes: find_recipes 找到的方案
+            jobs: 工作进程数
+
+        Returns:
+            与 recipes 一一对应的方案结果
+        """
+        if jobs <= 1 or isinstance(self.log_server, EventSource):
+            # 进程内的事件来源不能与工作进程共享
+            return [self.run(*recipe) for recipe in recipes]
+
+        pending: list[tuple[dict, float, list[tuple[list[int], Future]], Future or None]] = []
+        with ProcessPoolExecutor(jobs, initializer=close_transports) as pool:
+            for checklist_path, gremlins_path, topology_path in recipes:
+                start = time.perf_counter()
+                result = _new_result(checklist_path, gremlins_path)
+                futures: list[tuple[list[int], Future]] = []
+                metrics: Future or None = None
+                try:
+                    checklist = _load(checklist_path)
+                    ac = self._test(result, checklist, _load(gremlins_path), _load(topology_path))
+                    ac.close()
+                    checks = checklist['checks']
+                    # automaton 检查共用一次遍历，放在同一组中
+                    automata = [i for i, check in enumerate(checks) if check.get('name') == 'automaton']
+                    others = [i for i, check in enumerate(checks) if check.get('name') != 'automaton']
+                    shards = [automata] if automata else []
+                    size = max(1, -(-len(others) // max(1, jobs - len(shards))))  # 向上取整
+                    shards += [others[i:i + size] for i in range(0, len(others), size)]
+                    for shard in shards:
+                        futures.append((shard, pool.submit(_check_shard, self._log_server(checklist), self.clusters,
+                                                           result["test_id"], [checks[i] for i in shard],
+                                                           ac.start_time, ac.end_time, self.debug)))
+                    if self.metrics:
+                        metrics = pool.submit(_metrics_shard, self._log_server(checklist), self.clusters,
+                                              result["test_id"], checklist, ac.start_time, ac.end_time, self.debug)
+                except Exception as e:
+                    result["error"] = "{}: {}".format(type(e).__name__, e)
+                pending.append((result, start, futures, metrics))
+
+            results = []
+            for result, start, futures, metrics in pending:
+                if result["error"] is None:
+                    try:
+                        ordered = sorted((i, check) for shard, future in futures
+                                         for i, check in zip(shard, future.result()))
+                        _set_checks(result, [check for _, check in ordered])
+                        if metrics is not None:
+                            result["metrics"] = metrics.result()
+                    except Exception as e:
+                        result["error"] = "{}: {}".format(type(e).__name__, e)
+                result["elapsed"] = time.perf_counter() - start
+                results.append(result)
+        return results
+
+
+def _new_result(checklist_path: str, gremlins_path: str) -> dict:
+    return {
+        "recipe": os.path.dirname(checklist_path),
+        "gremlins": os.path.basename(gremlins_path),
+        "test_id": None,
+        "success": False,
+        "traffic": None,
+        "events": None,
+        "checks": [],
+        "metrics": None,
+        "error": None,
+    }
+
+
+def _check_dict(check: AssertionResult) -> dict:
+    return {
+        "name": check.name,
+        "info": check.info,
+        "success": check.success,
+        "errormsg": check.errormsg,
+        "profile": check.profile.to_dict() if check.profile is not None else None,
+    }
+
+
+def _set_checks(result: dict, checks: list[dict]):
+    result["checks"] = checks
+    result["success"] = all(check["success"] for check in checks)
+
+
+def _checker(log_server: str or list[str] or EventSource or None, clusters: list or None, test_id: str, debug: bool,
+             start_time: datetime.datetime, end_time: datetime.datetime = None) -> AssertionChecker:
+    return AssertionChecker(log_server, test_id, debug=debug, start_time=start_time, end_time=end_time,
+                            clusters=clusters)
+
+
+def _check_shard(log_server: str or list[str] or None, clusters: list or None, test_id: str, checks: list[dict],
+                 start_time: datetime.datetime, end_time: datetime.datetime, debug: bool) -> list[dict]:
+    """在工作进程中检查一组断言，工作进程内的检查共用该进程到日志服务器的连接"""
+    with _checker(log_server, clusters, test_id, debug, start_time, end_time) as ac:
+        return [_check_dict(check) for check in ac.check_assertions({'checks': checks}, all=True)]
+
+
+def _metrics_shard(log_server: str or list[str] or None, clusters: list or None, test_id: str, checklist: dict,
+                   start_time: datetime.datetime, end_time: datetime.datetime, debug: bool) -> dict:
+    """在工作进程中统计弹性指标"""
+    with _checker(log_server, clusters, test_id, debug, start_time, end_time) as ac:
+        return ac.collect_metrics(checklist).to_dict()
+
+
+def _run(args) -> int:
+    try:
+        recipes = find_recipes(args.paths, args.topology)
+    except AssertionError as e:
+        print(e, file=sys.stderr)
+        return 2
+    if not recipes:
+        print("No recipes found", file=sys.stderr)
+        return 2
+
+    log_server = args.log_server.split(',') if args.log_server and ',' in args.log_server else args.log_server
+    clusters = [cluster.split(',') if ',' in cluster else cluster for cluster in args.log_cluster] \
+        if args.log_cluster else None
+    collector = None
+    if args.collect is not None:
+        host, _, port = args.collect.rpartition(':')
+        collector = LogCollector(host or "0.0.0.0", int(port)).start()
+        log_server = collector.store
+        clusters = None
+        print("collecting proxy logs on %s" % collector.address, file=sys.stderr)
+
+    runner = RecipeRunner(log_server, args.quiet_period, args.ingest_timeout, not args.no_traffic, args.debug,
+                          args.metrics is not None, clusters)
+    try:
+        results = runner.run_all(recipes, args.jobs or os.cpu_count())
+        for result in results:
+            print("%s %s %s" % ("PASS" if result["success"] else "FAIL", result["recipe"], result["gremlins"]),
+                  file=sys.stderr)
+            if result["error"] is not None:
+                print("\t%s" % result["error"], file=sys.stderr)
+            for check in result["checks"]:
+                if not check["success"]:
+                    print("\tCheck %s %s FAIL" % (check["name"], check["info"]), file=sys.stderr)
+    finally:
+        close_transports()
+        if collector is not None:
+            collector.stop()
+
+    if args.metrics is not None:
+        with open(args.metrics, 'w') as fp:
+            fp.write(prometheus_text([result["metrics"] for result in results if result["metrics"] is not None]))
+
+    report = {"success": all(result["success"] for result in results), "recipes": results}
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2, ensure_ascii=False)
+        sys.stdout.write("\n")
+    else:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=2, ensure_ascii=False)
+    return 0 if report["success"] else 1
+
+
+def main(argv: list[str] = None) -> int:
+    """命令行入口 gremlin run <recipe dir>..."""
+    parser = argparse.ArgumentParser(prog='gremlin', description="a microservice test tool")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run = subparsers.add_parser('run', help="非交互地运行方案目录下的所有故障方案，结果以 JSON 输出")
+    run.add_argument('paths', nargs='+', help="方案目录(含 checklist.json, gremlins_*.json, topology.json)或其上级目录")
+    run.add_argument('--topology', help="所有方案共用的拓扑文件，缺省使用方案目录中的 topology.json")
+    run.add_argument('--log-server', help="代替 checklist.json 中的 log_server，同一集群的多个节点用逗号分隔")
+    run.add_argument('--log-cluster', action='append', metavar='HOST[,HOST...]',
+                     help="同时查询多个集群并合并结果，每个集群一个 --log-cluster，集群的多个节点用逗号分隔")
+    run.add_argument('--collect', metavar='[HOST:]PORT',
+                     help="在本进程中接收代理的 UDP 日志并检查，代替 Logstash + ElasticSearch，如 8092")
+    run.add_argument('--output', '-o', help="结果写入文件，缺省输出到标准输出")
+    run.add_argument('--quiet-period', default="2s", help="事件数保持不变多久视为日志入库完成")
+    run.add_argument('--ingest-timeout', default="60s", help="等待日志入库的最长时间")
+    run.add_argument('--jobs', '-j', type=int, default=1, help="检查断言的工作进程数，0 为 CPU 核数")
+    run.add_argument('--metrics', metavar='FILE',
+                     help="统计每条调用边的弹性指标，以 Prometheus 文本格式写入文件，JSON 格式在结果的 metrics 中")
+    run.add_argument('--no-traffic', action='store_true', help="不发送 checklist.json 中配置的测试流量")
+    run.add_argument('--debug', action='store_true', default=os.getenv('GREMLINSDK_DEBUG', "") != "")
+    run.set_defaults(func=_run)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
@@ -0,0 +1,189 @@
+# coding=utf-8
+
+import asyncio
+import json
+import socket
+import threading
+import time
+
+from .eventsource import EventSource, _match, _required_terms, _respond
+from .profiling import QueryStats
+
+
+class EventStore(EventSource):
+    """内存中的代理日志事件 In-memory event store indexed for the assertion checker
+
+    事件按测试ID、(source, dest) 和 reqID 建立索引，查询时从条件最严格的索引中取候选事件，
+    再按查询语义筛选，不需要 ElasticSearch。
+    """
+
+    def __init__(self):
+        self._events: list[dict] = []
+        self._by_test: dict[str, list[int]] = {}
+        self._by_edge: dict[tuple[str, str], list[int]] = {}
+        self._by_req: dict[str, list[int]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._events)
+
+    def add(self, event: dict):
+        """加入一个事件"""
+        with self._lock:
+            i = len(self._events)
+            self._events.append(event)
+            if "testid" in event:
+                self._by_test.setdefault(event["testid"], []).append(i)
+            if "source" in event and "dest" in event:
+                self._by_edge.setdefault((event["source"], event["dest"]), []).append(i)
+            if "reqID" in event:
+                self._by_req.setdefault(event["reqID"], []).append(i)
+
+    def clear(self):
+        """删除所有事件"""
+        with self._lock:
+            self._events = []
+            self._by_test = {}
+            self._by_edge = {}
+            self._by_req = {}
+
+    def _candidates(self, query: dict) -> list[dict]:
+        """按查询要求的 term 条件选出最小的候选事件集"""
+        terms = {}
+        for name, value in _required_terms(query):
+            terms.setdefault(name, value)
+        with self._lock:
+            indexes = []
+            if "testid" in terms:
+                indexes.append(self._by_test.get(terms["testid"], []))
+            if "source" in terms and "dest" in terms:
+                indexes.append(self._by_edge.get((terms["source"], terms["dest"]), []))
+            if "reqID" in terms:
+                indexes.append(self._by_req.get(terms["reqID"], []))
+            if not indexes:
+                return list(self._events)
+            events = self._events
+            return [events[i] for i in min(indexes, key=len)]
+
+    def search(self, body: dict, index: str = None, stats: QueryStats = None) -> dict:
+        start = time.time()
+        query = body.get("query", {"match_all": {}})
+        hits = [{"_source": event} for event in self._candidates(query) if _match(query, event)]
+        return _respond(body, hits, start)
+
+    def count(self, body: dict, index: str = None) -> int:
+        query = body.get("query", {"match_all": {}})
+        return sum(1 for event in self._candidates(query) if _match(query, event))
+
+
+class _CollectorProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, collector: 'LogCollector'):
+        self.collector = collector
+
+    def datagram_received(self, data: bytes, addr):
+        self.collector.received += 1
+        for line in data.splitlines():
+            if not line.strip():
+                continue
+            try:
+                event = json.loads(line)
+            except ValueError:
+                self.collector.malformed += 1
+                continue
+            if not isinstance(event, dict):
+                self.collector.malformed += 1
+                continue
+            # 与 Logstash udp 输入一样记录发送方地址，用于按代理实例区分事件
+            event.setdefault("host", addr[0])
+            self.collector.store.add(event)
+
+
+class LogCollector(object):
+    """接收代理通过 UDP 发送的日志，代替 Logstash + ElasticSearch
+    Embedded UDP log collector for small clusters and CI
+
+    代理配置的 LogstashHost 指向收集器地址，收集到的事件保存在 store 中，
+    store 可以直接作为 AssertionChecker 的事件来源:
+
+        collector = LogCollector(port=8092).start()
+        ...
+        ac = AssertionChecker(collector.store, test_id)
+    """
+
+    def __init__(self, host: str = "0.0.0.0", port: int = 8092, store: EventSource = None,
+                 recv_buffer: int = 4 * 1024 * 1024):
+        """
+        Args:
+            host: 监听地址
+            port: 监听端口，0 时由系统分配
+            store: 可选 保存事件的存储，需要有 add(event)，如长时间测试使用 SegmentStore; 缺省为 EventStore
+            recv_buffer: 套接字接收缓冲区大小，突发流量时减少丢包
+        """
+        self.host = host
+        self.port = port
+        self.store: EventSource = store if store is not None else EventStore()
+        self.recv_buffer = recv_buffer
+        self.received = 0  # 收到的数据报数
+        self.malformed = 0  # 无法解析的行数
+        self._transport: asyncio.DatagramTransport or None = None
+        self._loop: asyncio.AbstractEventLoop or None = None
+        self._thread: threading.Thread or None = None
+
+    async def serve(self) -> asyncio.DatagramTransport:
+        """在当前事件循环中开始接收日志"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.recv_buffer)
+        sock.bind((self.host, self.port))
+        self.port = sock.getsockname()[1]
+        self._transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: _CollectorProtocol(self), sock=sock)
+        return self._transport
+
+    def start(self) -> 'LogCollector':
+        """在后台线程中开始接收日志，绑定端口后返回"""
+        assert self._thread is None
+        self._loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        error = []
+
+        def run():
+            asyncio.set_event_loop(self._loop)
+            try:
+                self._loop.run_until_complete(self.serve())
+            except OSError as e:
+                error.append(e)
+                ready.set()
+                return
+            ready.set()
+            self._loop.run_forever()
+            self._transport.close()
+            self._loop.run_until_complete(asyncio.sleep(0))
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, name="gremlin-log-collector", daemon=True)
+        self._thread.start()
+        ready.wait()
+        if error:
+            self._thread = None
+            raise error[0]
+        return self
+
+    def stop(self):
+        """停止后台接收线程"""
+        if self._thread is None:
+            return
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._thread = None
+
+    @property
+    def address(self) -> str:
+        """代理配置中 LogstashHost 使用的地址"""
+        return "{}:{}".format(self.host, self.port)
+
+    def __enter__(self) -> 'LogCollector':
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
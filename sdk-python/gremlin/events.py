@@ -0,0 +1,124 @@
+# coding=utf-8
+
+import datetime
+import re
+import sys
+
+import isodate
+
+msg_kinds = ("Request", "Response", "Stream", "Test start", "Test stop")
+REQUEST, RESPONSE = 0, 1  # msg_kinds 中的序号
+_msg_index = {kind: i for i, kind in enumerate(msg_kinds)}
+
+_epoch = datetime.datetime(1970, 1, 1)
+_epoch_ordinal = _epoch.toordinal()
+# Go time.Duration.String() 的单位，长的单位在前以免 ms 被当作 m
+_duration_re = re.compile(r"(\d+(?:\.\d*)?|\.\d+)(ms|us|µs|ns|h|m|s)")
+_unit_us = {"h": 3600e6, "m": 60e6, "s": 1e6, "ms": 1e3, "us": 1.0, "µs": 1.0, "ns": 1e-3}
+
+
+def _parse_ts(ts: str) -> int:
+    """代理日志的 ts (小数秒位数不定) 转为微秒"""
+    try:
+        value = datetime.datetime.fromisoformat(ts)
+    except ValueError:
+        value = isodate.parse_datetime(ts)
+    # 不经过 timedelta 直接计算，快几倍; 带时区时与 replace(tzinfo=None) 相同按本地时间计算
+    return ((value.toordinal() - _epoch_ordinal) * 86400 + value.hour * 3600 + value.minute * 60 + value.second) \
+        * 1000000 + value.microsecond
+
+
+def _parse_duration_us(s: str) -> int:
+    """Go 格式的时间段(如 137.5ms, 1m30s)转为微秒"""
+    if s.endswith("ms"):
+        try:
+            return round(float(s[:-2]) * 1000)
+        except ValueError:
+            pass
+    return round(sum(float(value) * _unit_us[unit] for value, unit in _duration_re.findall(s)))
+
+
+def _format_ts(us: int) -> str:
+    """微秒转为代理日志的 ts 格式"""
+    return (_epoch + datetime.timedelta(microseconds=us)).strftime("%Y-%m-%dT%H:%M:%S.%f")
+
+
+def _format_duration(us: int) -> str:
+    """按 Go time.Duration 的格式输出，如 137ms, 1.5s"""
+    if us == 0:
+        return "0s"
+    if us >= 1000000:
+        return "{:.6f}".format(us / 1000000).rstrip('0').rstrip('.') + "s"
+    if us >= 1000:
+        return "{:.3f}".format(us / 1000).rstrip('0').rstrip('.') + "ms"
+    return "{}µs".format(us)
+
+
+class Event(object):
+    """检查使用的紧凑事件 Compact proxy log event shared by all checks
+
+    查询结果中的命中只解码一次：ts 和 duration 为微秒整数，msg 为 msg_kinds 中的序号(REQUEST, RESPONSE)，
+    服务名、实例、uri 和 actions 的字符串是驻留的，相同的值只保存一份。缺少的字段为 None。
+    """
+
+    __slots__ = ('ts', 'msg', 'status', 'source', 'dest', 'reqID', 'host', 'uri', 'actions', 'duration')
+
+    def __init__(self, ts: int = None, msg: int = None, status: int = None, source: str = None, dest: str = None,
+                 reqID: str = None, host: str = None, uri: str = None, actions: str = None, duration: int = None):
+        self.ts = ts
+        self.msg = msg
+        self.status = status
+        self.source = source
+        self.dest = dest
+        self.reqID = reqID
+        self.host = host
+        self.uri = uri
+        self.actions = actions
+        self.duration = duration
+
+    def to_dict(self) -> dict:
+        """转换回代理日志的格式，只包含存在的字段"""
+        event = {}
+        for name in self.__slots__:
+            value = getattr(self, name)
+            if value is None:
+                continue
+            if name == "ts":
+                value = _format_ts(value)
+            elif name == "duration":
+                value = _format_duration(value)
+            elif name == "msg":
+                value = msg_kinds[value]
+            event[name] = value
+        return event
+
+    def __repr__(self) -> str:
+        return "Event({})".format(self.to_dict())
+
+
+def decode_events(hits: list[dict]) -> list[Event]:
+    """把 ElasticSearch 命中(或事件字典)解码为 Event"""
+    intern = sys.intern
+    events = []
+    for hit in hits:
+        source = hit.get("_source", hit)
+        ts = source.get("ts")
+        msg = source.get("msg")
+        duration = source.get("duration")
+        src = source.get("source")
+        dest = source.get("dest")
+        host = source.get("host")
+        uri = source.get("uri")
+        actions = source.get("actions")
+        events.append(Event(
+            _parse_ts(ts) if ts is not None else None,
+            _msg_index.get(msg) if msg is not None else None,
+            source.get("status"),
+            intern(src) if src is not None else None,
+            intern(dest) if dest is not None else None,
+            source.get("reqID"),
+            intern(host) if host is not None else None,
+            intern(uri) if uri is not None else None,
+            intern(actions) if actions is not None else None,
+            _parse_duration_us(duration) if duration is not None else None))
+    return events
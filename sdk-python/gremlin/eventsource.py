@@ -0,0 +1,445 @@
+# coding=utf-8
+
+import bisect
+import datetime
+import heapq
+import itertools
+import json
+import mmap
+import os
+import time
+
+import isodate
+
+from .events import _parse_ts
+from .profiling import QueryStats
+from .transport import ElasticsearchTransport, get_transport
+
+
+class EventSource(object):
+    """日志事件来源 Backend the assertion checker reads proxy log events from
+
+    search 接受 AssertionChecker 使用的 ElasticSearch 查询子集，并返回 ElasticSearch 格式的结果，
+    因此各个检查不关心事件实际存放在哪里。
+    """
+
+    def search(self, body: dict, index: str = None, stats: QueryStats = None) -> dict:
+        """执行一次查询
+
+        Args:
+            body: ElasticSearch 查询体
+            index: 可选 逗号分隔的索引名，只对按索引存储事件的来源有意义
+            stats: 可选 累计传输统计
+
+        Returns:
+            ElasticSearch 格式的查询结果
+        """
+        raise NotImplementedError
+
+    def msearch(self, bodies: list[dict], index: str = None, stats: QueryStats = None) -> list[dict]:
+        """在一次往返中执行多个查询，结果与查询体一一对应"""
+        return [self.search(body, index, stats) for body in bodies]
+
+    def count(self, body: dict, index: str = None) -> int:
+        """统计匹配查询的事件数，不返回命中"""
+        return self.search(dict(body, size=0), index)["hits"]["total"]
+
+    def cache_key(self) -> str:
+        """标识事件来源，用于查询结果缓存"""
+        return type(self).__name__
+
+
+class ElasticsearchSource(EventSource):
+    """从 ElasticSearch 读取事件 Events indexed by Logstash into ElasticSearch
+
+    同一进程内到同一地址的所有 ElasticsearchSource 共享一个连接池。
+    """
+
+    def __init__(self, host, **transport_options):
+        """
+        Args:
+            host: the elasticsearch host，或同一集群的节点地址列表
+            transport_options: 传给 ElasticsearchTransport 的参数，如 pool_maxsize, compress_requests, max_retries;
+                与已经存在的共享连接的参数不同时 ValueError
+        """
+        self.host = host
+        self._transport: ElasticsearchTransport = get_transport(host, **transport_options)
+
+    def search(self, body: dict, index: str = None, stats: QueryStats = None) -> dict:
+        if index is None:
+            return self._transport.request("POST", "/_search", json.dumps(body).encode(), stats=stats)
+        return self._transport.request("POST", "/{}/_search".format(index), json.dumps(body).encode(),
+                                       params={"ignore_unavailable": "true"}, stats=stats)
+
+    def msearch(self, bodies: list[dict], index: str = None, stats: QueryStats = None) -> list[dict]:
+        header = json.dumps({} if index is None else {"index": index, "ignore_unavailable": True})
+        lines = []
+        for body in bodies:
+            lines.append(header)
+            lines.append(json.dumps(body))
+        data = ("\n".join(lines) + "\n").encode()
+        responses = self._transport.request("POST", "/_msearch", data,
+                                            content_type="application/x-ndjson", stats=stats)["responses"]
+        for response in responses:
+            if "error" in response:
+                raise RuntimeError("msearch failed: {}".format(response["error"]))
+        return responses
+
+    def count(self, body: dict, index: str = None) -> int:
+        data = json.dumps({"query": body.get("query", {"match_all": {}})}).encode()
+        if index is None:
+            return self._transport.request("POST", "/_count", data)["count"]
+        return self._transport.request("POST", "/{}/_count".format(index), data,
+                                       params={"ignore_unavailable": "true"})["count"]
+
+    def cache_key(self) -> str:
+        return str(self.host)
+
+
+def _field(doc: dict, name: str):
+    """取文档中的字段，支持 a.b 形式的嵌套字段，不存在时返回 None"""
+    value = doc
+    for part in name.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+    return value
+
+
+def _compare(left, right) -> int:
+    """range 比较，字符串时间戳按时间比较"""
+    if isinstance(left, str) and isinstance(right, str):
+        try:
+            left, right = _parse_ts(left), _parse_ts(right)
+        except ValueError:
+            pass
+    return (left > right) - (left < right)
+
+
+def _sort_value(value):
+    """排序用的值，字符串时间戳按时间排序"""
+    if isinstance(value, str):
+        try:
+            return datetime.datetime.fromisoformat(value).replace(tzinfo=None)
+        except ValueError:
+            try:
+                return isodate.parse_datetime(value).replace(tzinfo=None)
+            except ValueError:
+                pass
+    return value
+
+
+class _Descending(object):
+    """降序排序的键"""
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other: '_Descending') -> bool:
+        return other.value < self.value
+
+    def __eq__(self, other: '_Descending') -> bool:
+        return self.value == other.value
+
+
+def _sort_key(sort):
+    """sort 对应的命中排序键，缺少字段的命中排在最后"""
+    if isinstance(sort, (str, dict)):
+        sort = [sort]
+    specs = []
+    for spec in sort:
+        if isinstance(spec, str):
+            name, order = spec, "asc"
+        else:
+            (name, order), = spec.items()
+            if isinstance(order, dict):
+                order = order.get("order", "asc")
+        specs.append((name, order == "desc"))
+
+    def key(hit: dict) -> tuple:
+        values = []
+        for name, descending in specs:
+            value = _field(hit["_source"], name)
+            if value is None:
+                values.append((1, None))
+            else:
+                value = _sort_value(value)
+                values.append((0, _Descending(value) if descending else value))
+        return tuple(values)
+
+    return key
+
+
+def _clauses(clause: dict, *keys: str) -> list[dict]:
+    """bool 查询的子句可以是单个对象或列表"""
+    result = []
+    for key in keys:
+        value = clause.get(key, [])
+        result.extend([value] if isinstance(value, dict) else value)
+    return result
+
+
+def _match(query: dict, doc: dict) -> bool:
+    """按 ElasticSearch 查询语义判断文档是否匹配
+    Evaluate the subset of the query DSL used by AssertionChecker against one event
+    """
+    (kind, clause), = query.items()
+    if kind == "match_all":
+        return True
+    if kind == "filtered":
+        return _match(clause.get("query", {"match_all": {}}), doc) and \
+            _match(clause.get("filter", {"match_all": {}}), doc)
+    if kind == "bool":
+        if not all(_match(q, doc) for q in _clauses(clause, "must", "filter")):
+            return False
+        if any(_match(q, doc) for q in _clauses(clause, "must_not")):
+            return False
+        should = _clauses(clause, "should")
+        # 过滤上下文中 should 至少匹配 minimum_should_match 个
+        if should:
+            return sum(_match(q, doc) for q in should) >= clause.get("minimum_should_match", 1)
+        return True
+    if kind == "term":
+        (name, value), = clause.items()
+        if isinstance(value, dict):
+            value = value["value"]
+        return _field(doc, name) == value
+    if kind == "terms":
+        (name, values), = clause.items()
+        return _field(doc, name) in values
+    if kind == "prefix":
+        (name, value), = clause.items()
+        if isinstance(value, dict):
+            value = value["value"]
+        field = _field(doc, name)
+        return isinstance(field, str) and field.startswith(value)
+    if kind == "exists":
+        return _field(doc, clause["field"]) is not None
+    if kind == "range":
+        (name, bounds), = clause.items()
+        field = _field(doc, name)
+        if field is None:
+            return False
+        for op, bound in bounds.items():
+            c = _compare(field, bound)
+            if (op == "gte" and c < 0) or (op == "gt" and c <= 0) or \
+                    (op == "lte" and c > 0) or (op == "lt" and c >= 0):
+                return False
+        return True
+    raise ValueError("Unsupported query: {}".format(kind))
+
+
+def _required_terms(query: dict) -> list[tuple[str, any]]:
+    """收集文档必须满足的 term 条件 (字段, 值)，用于预筛选行或选择索引"""
+    (kind, clause), = query.items()
+    if kind == "filtered":
+        return _required_terms(clause.get("query", {"match_all": {}})) + \
+            _required_terms(clause.get("filter", {"match_all": {}}))
+    if kind == "bool":
+        return [value for q in _clauses(clause, "must", "filter") for value in _required_terms(q)]
+    if kind == "term":
+        (name, value), = clause.items()
+        if isinstance(value, dict):
+            value = value["value"]
+        return [(name, value)]
+    return []
+
+
+class _Aggregator(object):
+    """遍历命中时计算聚合，目前支持 terms, percentiles, range 和 value_count
+
+    percentiles 和 range 按不同的值计数，内存与命中数无关。
+    """
+
+    def __init__(self, aggs: dict):
+        self.aggs = aggs
+        self._fields: list[tuple[str, str, str]] = []  # (聚合名, 类型, 字段)
+        self.counts: dict[str, dict] = {}  # 聚合名 -> 值 -> 文档数
+        for name, agg in aggs.items():
+            kind = next((kind for kind in ("value_count", "percentiles", "range", "terms") if kind in agg), None)
+            if kind is None:
+                raise ValueError("Unsupported aggregation: {}".format(list(agg)))
+            self._fields.append((name, kind, agg[kind]["field"]))
+            self.counts[name] = {}
+
+    def add(self, source: dict):
+        for name, kind, field in self._fields:
+            value = _field(source, field)
+            if value is None or (kind in ("percentiles", "range") and not isinstance(value, (int, float))):
+                continue
+            if kind == "value_count":
+                value = None
+            counts = self.counts[name]
+            counts[value] = counts.get(value, 0) + 1
+
+    def result(self) -> dict:
+        result = {}
+        for name, agg in self.aggs.items():
+            counts = self.counts[name]
+            if "value_count" in agg:
+                result[name] = {"value": counts.get(None, 0)}
+            elif "percentiles" in agg:
+                result[name] = {"values": _percentiles(
+                    counts, agg["percentiles"].get("percents", [1, 5, 25, 50, 75, 95, 99]))}
+            elif "range" in agg:
+                result[name] = {"buckets": _ranges(counts, agg["range"]["ranges"])}
+            else:
+                terms = agg["terms"]
+                min_doc_count = terms.get("min_doc_count", 1)
+                buckets = sorted(((k, c) for k, c in counts.items() if c >= min_doc_count),
+                                 key=lambda kv: (-kv[1], kv[0]))
+                # size 0 表示返回全部桶
+                if terms.get("size", 10) != 0:
+                    buckets = buckets[:terms.get("size", 10)]
+                result[name] = {"buckets": [{"key": k, "doc_count": c} for k, c in buckets]}
+        return result
+
+
+def _percentiles(counts: dict, percents: list) -> dict:
+    """按值的文档数计算百分位，取最近的秩"""
+    values = sorted(counts)
+    total = sum(counts.values())
+    result = {}
+    for p in percents:
+        if not values:
+            result[str(float(p))] = None
+            continue
+        rank = int(round(p / 100 * (total - 1)))
+        seen = 0
+        for value in values:
+            seen += counts[value]
+            if rank < seen:
+                break
+        result[str(float(p))] = value
+    return result
+
+
+def _ranges(counts: dict, ranges: list[dict]) -> list[dict]:
+    """按值的文档数计算 range 聚合的桶，from 包含在桶内，to 不包含"""
+    values = sorted(counts)
+    cumulative = list(itertools.accumulate(counts[value] for value in values))
+
+    def below(bound) -> int:
+        index = bisect.bisect_left(values, bound)
+        return cumulative[index - 1] if index > 0 else 0
+
+    total = cumulative[-1] if cumulative else 0
+    buckets = []
+    for spec in ranges:
+        low, high = spec.get("from"), spec.get("to")
+        bucket = {"key": "{}-{}".format("*" if low is None else low, "*" if high is None else high)}
+        if low is not None:
+            bucket["from"] = low
+        if high is not None:
+            bucket["to"] = high
+        bucket["doc_count"] = (below(high) if high is not None else total) - (below(low) if low is not None else 0)
+        buckets.append(bucket)
+    return buckets
+
+
+def _respond(body: dict, hits, start: float) -> dict:
+    """把匹配的命中组装成 ElasticSearch 格式的结果
+
+    hits 可以是迭代器，只遍历一次: 只保留要返回的一页(有 sort 时用 from+size 大小的堆)，
+    聚合在遍历时计算，内存与匹配的命中数无关。
+    """
+    offset = body.get("from", 0)
+    size = body.get("size", 10)
+    aggs = body.get("aggs", body.get("aggregations"))
+    aggregator = _Aggregator(aggs) if aggs is not None else None
+    total = 0
+
+    def counted():
+        nonlocal total
+        for hit in hits:
+            total += 1
+            if aggregator is not None:
+                aggregator.add(hit["_source"])
+            yield hit
+
+    stream = counted()
+    if "sort" in body:
+        page = heapq.nsmallest(offset + size, stream, key=_sort_key(body["sort"]))[offset:]
+    else:
+        page = list(itertools.islice(stream, offset, offset + size))
+        for _ in stream:  # 页之后的命中只计数
+            pass
+    includes = body.get("_source")
+    if isinstance(includes, dict):
+        includes = includes.get("include", includes.get("includes"))
+    if isinstance(includes, str):
+        includes = [includes]
+    if isinstance(includes, list):
+        page = [dict(hit, _source={name: hit["_source"][name] for name in includes if name in hit["_source"]})
+                for hit in page]
+    data = {
+        "took": int((time.time() - start) * 1000),
+        "timed_out": False,
+        "hits": {
+            "total": total,
+            "hits": page
+        }
+    }
+    if aggregator is not None:
+        data["aggregations"] = aggregator.result()
+    return data
+
+
+class NDJSONSource(EventSource):
+    """从本地 NDJSON 文件读取事件 Events captured as newline delimited JSON files
+
+    每行一个代理日志事件，或一个带 _source 的 ElasticSearch 命中。
+    文件通过 mmap 扫描，先在原始字节中查找查询要求的 term 值，只解析可能匹配的行。
+    """
+
+    def __init__(self, *paths: str):
+        """
+        Args:
+            paths: NDJSON 文件或包含 *.json / *.ndjson / *.log 文件的目录
+        """
+        self._paths: list[str] = []
+        for path in paths:
+            if os.path.isdir(path):
+                self._paths.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+                                          if name.endswith(('.json', '.ndjson', '.log'))))
+            else:
+                self._paths.append(path)
+
+    def cache_key(self) -> str:
+        return ",".join(os.path.abspath(path) for path in self._paths)
+
+    def _scan(self, needles: list[bytes]):
+        """逐行扫描所有文件，返回包含全部 needles 的行解析出的命中"""
+        for path in self._paths:
+            with open(path, 'rb') as fp:
+                if os.fstat(fp.fileno()).st_size == 0:
+                    continue
+                with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    size = len(mm)
+                    start = 0
+                    while start < size:
+                        end = mm.find(b'\n', start)
+                        if end == -1:
+                            end = size
+                        if all(mm.find(needle, start, end) != -1 for needle in needles):
+                            line = mm[start:end].strip()
+                            if line:
+                                doc = json.loads(line)
+                                yield doc if "_source" in doc else {"_source": doc}
+                        start = end + 1
+
+    def search(self, body: dict, index: str = None, stats: QueryStats = None) -> dict:
+        start = time.time()
+        query = body.get("query", {"match_all": {}})
+        needles = []
+        for _, value in _required_terms(query):
+            if isinstance(value, str):
+                encoded = json.dumps(value)
+                # 只有不需要转义的字符串在文件中的形式是确定的
+                if encoded == '"{}"'.format(value) and value.isascii():
+                    needles.append(encoded.encode())
+            elif isinstance(value, int) and not isinstance(value, bool):
+                needles.append(str(value).encode())
+        return _respond(body, (hit for hit in self._scan(needles) if _match(query, hit["_source"])), start)
@@ -1,17 +1,36 @@
 # coding=utf-8
 
+import asyncio
+import datetime
 import json
 import logging
+import time
 import uuid
+from collections import namedtuple
+
 import requests
 
 # import httplib
 
 from .applicationgraph import ApplicationGraph
+from .assertionchecker import _parse_duration
+from .patterns import analyze_pattern
+from .profiling import ProxyStats
+from .transport import ProxyConnection
 
 logging.basicConfig()
 requests_log = logging.getLogger("requests.packages.urllib3")
 
+# 故障计划中一个阶段的实际生效情况，时间为相对计划开始的秒数
+# activated: 代理地址 -> 该代理清除旧规则并加入全部新规则完成的时间
+# skew: 最早和最晚生效的代理之差; lateness: 最晚生效的代理比计划时间晚多少
+# errors: 代理地址 -> 错误信息
+PhaseActivation = namedtuple('PhaseActivation', ['index', 'planned', 'started', 'activated', 'skew', 'lateness',
+                                                 'errors'])
+# 两阶段启动测试的结果 activated: 代理地址 -> 该代理替换规则并设置测试ID完成的时间(相对激活开始的秒数)
+# skew: 最早和最晚生效的代理之差
+TestActivation = namedtuple('TestActivation', ['test_id', 'activated', 'skew'])
+
 
 class Rule(object):
 
@@ -77,7 +96,12 @@ class FailureGenerator(object):
         self.app: ApplicationGraph = app
         self.debug: bool = debug
         self._id: str or None = None
+        self._start_time: datetime.datetime or None = None
         self._queue: list[Rule] = list[Rule]()
+        self._proxy_stats: dict[tuple[str, str], ProxyStats] = {}  # (操作, 代理实例) -> 统计
+        self._hooks: list = []
+        self._reported_patterns: set[tuple[str, str]] = set()
+        self._session = requests.Session()  # 到各代理的 keep-alive 连接，多次测试复用
         # some common scenarios
         self.functiondict = {
             'abort_requests': self.abort_requests,
@@ -94,14 +118,49 @@ class FailureGenerator(object):
             requests_log.setLevel(logging.DEBUG)
             requests_log.propagate = True
 
+    def _request(self, operation: str, method: str, instance: str, path: str, **kwargs) -> requests.Response:
+        """向代理发送控制请求，记录每个代理每种操作的往返时间和错误数
+
+        Args:
+            operation: 操作名，如 start_test, clear_rules, list_rules, push_rule, replace_rules
+            method: HTTP 方法
+            instance: 代理地址
+            path: 请求路径
+        """
+        start = time.perf_counter()
+        try:
+            resp = self._session.request(method, "http://{}{}".format(instance, path), **kwargs)
+        except requests.exceptions.RequestException:
+            self._record(operation, instance, time.perf_counter() - start, True)
+            raise
+        self._record(operation, instance, time.perf_counter() - start, resp.status_code >= 400)
+        return resp
+
+    def _record(self, operation: str, instance: str, rtt: float, error: bool):
+        stats = self._proxy_stats.get((operation, instance))
+        if stats is None:
+            stats = self._proxy_stats[(operation, instance)] = ProxyStats()
+        stats.add(rtt, error)
+        for hook in self._hooks:
+            hook(operation, instance, rtt, error)
+
+    def add_hook(self, hook):
+        """添加每次控制请求完成时调用的钩子 hook(operation, instance, rtt, error)"""
+        self._hooks.append(hook)
+
+    def get_proxy_stats(self) -> dict[tuple[str, str], ProxyStats]:
+        """每个代理每种操作的请求数、错误数和往返时间 (operation, instance) -> ProxyStats"""
+        return dict(self._proxy_stats)
+
     def start_new_test(self) -> str:
         """开始新测试，对所有已知代理设置新的随机测试ID"""
         self._id = uuid.uuid4().hex
+        self._start_time = datetime.datetime.now(datetime.timezone.utc)
         for service in self.app.get_services():
             if self.debug:
                 print(service)
             for instance in self.app.get_service_instances(service):
-                resp = requests.put("http://{}/gremlin/v1/test/{}".format(instance, self._id))
+                resp = self._request("start_test", "PUT", instance, "/gremlin/v1/test/{}".format(self._id))
                 resp.raise_for_status()
         return self._id
 
@@ -109,10 +168,18 @@ class FailureGenerator(object):
         """当前测试ID"""
         return self._id
 
+    def get_test_start_time(self) -> datetime.datetime or None:
+        """当前测试开始时间(UTC，带时区)，可以传给 AssertionChecker 限定查询的时间窗口"""
+        return self._start_time
+
     def add_rule(self, rule: Rule):
         """增加规则"""
         self._queue.append(rule)
 
+    def get_rules(self) -> list[Rule]:
+        """待添加到代理的规则，可以用 ReplayEngine 离线回放"""
+        return list(self._queue)
+
     def clear_rules_from_all_proxies(self):
         """清除已知代理之前注入的故障 Clear fault injection rules from all known service proxies."""
         self._queue = list[Rule]()
@@ -122,7 +189,7 @@ class FailureGenerator(object):
             for instance in self.app.get_service_instances(service):
                 if self.debug:
                     print('Clearing rules for %s - instance %s' % (service, instance))
-                resp = requests.delete("http://{}/gremlin/v1/rules".format(instance))
+                resp = self._request("clear_rules", "DELETE", instance, "/gremlin/v1/rules")
                 if resp.status_code != 200:
                     print('Failed to clear rules for %s - instance %s' % (service, instance))
 
@@ -142,7 +209,7 @@ class FailureGenerator(object):
             rules[service] = {}
             for instance in self.app.get_service_instances(service):
                 rules[service][instance] = {}
-                resp = requests.get("http://{}/gremlin/v1/rules/list".format(instance))
+                resp = self._request("list_rules", "GET", instance, "/gremlin/v1/rules/list")
                 if resp.status_code != 200:
                     print('Failed to fetch rules from %s - instance %s' % (service, instance))
                     continue
@@ -161,16 +228,321 @@ class FailureGenerator(object):
             instances = self.app.get_service_instances(rule.source)
             for instance in instances:
                 try:
-                    resp = requests.post("http://{}/gremlin/v1/rules/add".format(instance),
+                    resp = self._request("push_rule", "POST", instance, "/gremlin/v1/rules/add",
                                          headers={"Content-Type": "application/json"},
                                          data=json.dumps(rule.to_dict()))
                     resp.raise_for_status()
                 except requests.exceptions.ConnectionError as e:
-                    print("FAILURE: Could not add rule to instance %s of service %s" % (instance, rule["source"]))
+                    print("FAILURE: Could not add rule to instance %s of service %s" % (instance, rule.source))
                     print(e)
                     if not continue_on_errors:
                         raise e
 
+    def _phase_rules(self, gremlins: list[dict[str, any]]) -> list[Rule]:
+        """生成一个阶段的规则，不影响待添加的规则"""
+        queue = self._queue
+        self._queue = list[Rule]()
+        try:
+            for gremlin in gremlins:
+                self.setup_failure(**gremlin)
+            return self._queue
+        finally:
+            self._queue = queue
+
+    async def _pipeline(self, operation: str, conn: ProxyConnection, data: bytes, count: int,
+                        idempotent: bool = False) -> tuple[float, list[tuple[int, bytes]]]:
+        """向一个代理写出一组请求，记录往返时间; 连接失败时 ConnectionError，任一请求失败时 HTTPError
+        idempotent 见 ProxyConnection.pipeline
+
+        Returns:
+            (完成的时间 perf_counter, 每个请求的 (状态码, 回复体))
+        """
+        sent = time.perf_counter()
+        try:
+            responses = await conn.pipeline(data, count, idempotent)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                ValueError) as e:
+            self._record(operation, conn.instance, time.perf_counter() - sent, True)
+            raise ConnectionError("{}: {!r}".format(conn.instance, e))
+        done = time.perf_counter()
+        failed = [(status, body) for status, body in responses if status >= 400]
+        self._record(operation, conn.instance, done - sent, bool(failed))
+        if failed:
+            raise requests.exceptions.HTTPError("{}: HTTP {} {}".format(
+                conn.instance, failed[0][0], failed[0][1].decode(errors="replace").strip()))
+        return done, responses
+
+    async def apply_schedule(self, phases: list[dict[str, any]], continue_on_errors=False,
+                             timeout: float = 10.0) -> list[PhaseActivation]:
+        """按时间计划切换故障规则 Apply timed phases of gremlins across all affected proxies
+
+        每个阶段在计划时间用新规则替换旧规则，受影响的代理是本阶段或上一阶段有规则的服务的所有实例。
+        开始前生成所有阶段的规则、编码好每个代理的请求并建立到所有代理的连接，
+        阶段切换时向每个代理一次写出清除规则和加入新规则的请求(HTTP 流水线)，并发等待回复，
+        记录每个代理实际生效的时间。上一阶段未完成时下一阶段等待，不会同时修改同一个代理。
+        代理没有原子替换规则的接口，清除和加入之间的极短时间内没有规则。
+
+        Args:
+            phases: 阶段列表，如 [{"at": "0s", "gremlins": [...]}, {"at": "5m", "gremlins": [...]}]，
+                at 为相对开始的时间(Go 格式字符串或秒数)，必须递增; gremlins 与 gremlins.json 中的格式相同，
+                空列表表示清除规则
+            continue_on_errors: 代理请求失败时是否继续，否则在该阶段所有代理完成后抛出第一个异常
+            timeout: 每个代理每个阶段的超时时间(秒)
+
+        Returns:
+            每个阶段的实际生效情况
+        """
+        planned = []
+        for phase in phases:
+            at = phase["at"]
+            planned.append(_parse_duration(at).total_seconds() if isinstance(at, str) else float(at))
+        assert all(a < b for a, b in zip(planned, planned[1:])), "phases must be in increasing order of 'at'"
+
+        # 开始之前生成所有阶段的规则和请求，参数错误时不会执行到一半
+        connections: dict[str, ProxyConnection] = {}
+        phase_rules: list[list[Rule]] = []
+        payloads: list[dict[str, tuple[bytes, int]]] = []  # 代理 -> (请求, 请求数)
+        previous_sources: set[str] = set()
+        for phase in phases:
+            rules = self._phase_rules(phase["gremlins"])
+            sources = {rule.source for rule in rules}
+            by_instance: dict[str, list[Rule]] = {}
+            for service in sources | previous_sources:
+                for instance in self.app.get_service_instances(service):
+                    by_instance.setdefault(instance, [])
+            for rule in rules:
+                for instance in self.app.get_service_instances(rule.source):
+                    by_instance[instance].append(rule)
+            payload = {}
+            for instance, instance_rules in by_instance.items():
+                conn = connections.get(instance)
+                if conn is None:
+                    conn = connections[instance] = ProxyConnection(instance, timeout)
+                data = conn.encode("DELETE", "/gremlin/v1/rules")
+                for rule in instance_rules:
+                    data += conn.encode("POST", "/gremlin/v1/rules/add", json.dumps(rule.to_dict()).encode())
+                payload[instance] = (data, 1 + len(instance_rules))
+            phase_rules.append(rules)
+            payloads.append(payload)
+            previous_sources = sources
+
+        async def replace(instance: str, data: bytes, count: int) -> float:
+            """替换一个代理上的规则，返回完成的时间"""
+            done, _ = await self._pipeline("replace_rules", connections[instance], data, count)
+            return done
+
+        # 提前建立连接，阶段切换时不需要握手
+        results = await asyncio.gather(*(conn.connect() for conn in connections.values()), return_exceptions=True)
+        for instance, result in zip(connections, results):
+            if isinstance(result, BaseException):
+                print("FAILURE: Could not connect to instance %s: %r" % (instance, result))
+                if not continue_on_errors:
+                    for conn in connections.values():
+                        conn.close()
+                    raise ConnectionError("{}: {!r}".format(instance, result))
+
+        activations = []
+        try:
+            start = time.perf_counter()
+            for index, (at, rules, payload) in enumerate(zip(planned, phase_rules, payloads)):
+                delay = start + at - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                started = time.perf_counter() - start
+                results = await asyncio.gather(*(replace(instance, data, count)
+                                                 for instance, (data, count) in payload.items()),
+                                               return_exceptions=True)
+                activated, errors = {}, {}
+                first_error = None
+                for instance, result in zip(payload, results):
+                    if isinstance(result, BaseException):
+                        errors[instance] = str(result)
+                        first_error = first_error or result
+                    else:
+                        activated[instance] = result - start
+                times = list(activated.values())
+                activation = PhaseActivation(index, at, started, activated,
+                                             max(times) - min(times) if times else 0.0,
+                                             max(times) - at if times else 0.0, errors)
+                activations.append(activation)
+                self._queue = list(rules)
+                if self.debug:
+                    print("phase %d at %.3fs: %d proxies, skew %.1fms, lateness %.1fms, %d errors" % (
+                        index, at, len(activated), activation.skew * 1000, activation.lateness * 1000, len(errors)))
+                if first_error is not None:
+                    for error in errors.values():
+                        print("FAILURE: Could not apply phase %d to instance %s" % (index, error))
+                    if not continue_on_errors:
+                        raise first_error
+        finally:
+            for conn in connections.values():
+                conn.close()
+        return activations
+
+    def run_schedule(self, phases: list[dict[str, any]], continue_on_errors=False,
+                     timeout: float = 10.0) -> list[PhaseActivation]:
+        """在新的事件循环中执行 apply_schedule，最后一个阶段生效后返回"""
+        return asyncio.run(self.apply_schedule(phases, continue_on_errors, timeout))
+
+    async def apply_test(self, gremlins: dict[str, list[dict[str, any]]] = None,
+                         timeout: float = 10.0) -> TestActivation:
+        """两阶段启动新测试 Stage then activate the rule set and a new test ID on every proxy
+
+        逐个代理执行 clear_rules_from_all_proxies、push_rules、start_new_test 时，一部分代理已经是新规则和新测试ID，
+        另一部分还是旧的，这段时间随代理数线性增长。这里分两个阶段:
+
+        * 准备: 建立到所有已知代理的连接，读取每个代理当前的规则和测试ID(GET /gremlin/v1/test)作为快照，
+          编码好每个代理的激活请求(清除规则、加入该代理的全部新规则、设置新测试ID)和回滚请求(恢复快照)。
+          任一代理失败时抛出异常，此时还没有修改任何代理
+        * 激活: 向所有代理并发地一次写出激活请求(HTTP 流水线)，不一致的时间约为一次往返。
+          任一代理失败时向所有代理写出回滚请求，然后抛出异常，异常信息列出每个代理回滚后的状态;
+          本对象的测试ID和待添加的规则不变
+
+        较早的代理没有 GET /gremlin/v1/test，无法得知之前的测试ID，回滚时只恢复规则，不猜测测试ID，
+        这些代理在异常信息中列出。
+
+        同一个代理上测试ID在规则之后设置，带新测试ID的事件都经过全部新规则。
+
+        Args:
+            gremlins: 可选 gremlins.json 的内容，给出时代替之前 setup_failure 添加的规则
+            timeout: 每个代理每个阶段的超时时间(秒)
+
+        Returns:
+            激活结果，新测试ID同时保存在 get_test_id()
+        """
+        if gremlins is not None:
+            assert isinstance(gremlins, dict) and isinstance(gremlins.get('gremlins'), list)
+            rules = self._phase_rules(gremlins['gremlins'])
+        else:
+            rules = list(self._queue)
+        test_id = uuid.uuid4().hex
+        instances: dict[str, list[Rule]] = {}
+        for service in self.app.get_services():
+            for instance in self.app.get_service_instances(service):
+                instances.setdefault(instance, [])
+        for rule in rules:
+            for instance in self.app.get_service_instances(rule.source):
+                instances[instance].append(rule)
+        connections = {instance: ProxyConnection(instance, timeout) for instance in instances}
+
+        async def each(operation: str, payloads: dict[str, tuple[bytes, int]],
+                       idempotent: bool = False) -> tuple[dict, dict]:
+            """并发地向每个代理写出请求，返回 (代理 -> (完成时间, 回复), 代理 -> 异常)"""
+            results = await asyncio.gather(*(self._pipeline(operation, connections[instance], data, count, idempotent)
+                                             for instance, (data, count) in payloads.items()),
+                                           return_exceptions=True)
+            done, errors = {}, {}
+            for instance, result in zip(payloads, results):
+                if isinstance(result, BaseException):
+                    errors[instance] = result
+                else:
+                    done[instance] = result
+            return done, errors
+
+        async def current_test_id(conn: ProxyConnection) -> str or None:
+            """代理当前的测试ID，"" 表示没有，None 表示代理没有这个接口无法得知"""
+            try:
+                _, ((_, body),) = await self._pipeline("snapshot_test", conn,
+                                                       conn.encode("GET", "/gremlin/v1/test"), 1, True)
+            except requests.exceptions.HTTPError:
+                return None
+            return body.decode()
+
+        try:
+            # 准备阶段: 连接并读取规则和测试ID的快照
+            snapshots, errors = await each("snapshot_rules", {
+                instance: (conn.encode("GET", "/gremlin/v1/rules/list"), 1) for instance, conn in connections.items()},
+                idempotent=True)
+            if errors:
+                for error in errors.values():
+                    print("FAILURE: Could not stage test on instance %s" % error)
+                raise next(iter(errors.values()))
+            previous_ids: dict[str, str or None] = dict(zip(connections, await asyncio.gather(
+                *(current_test_id(conn) for conn in connections.values()))))
+            activate, rollback = {}, {}
+            for instance, conn in connections.items():
+                data = conn.encode("DELETE", "/gremlin/v1/rules")
+                for rule in instances[instance]:
+                    data += conn.encode("POST", "/gremlin/v1/rules/add", json.dumps(rule.to_dict()).encode())
+                data += conn.encode("PUT", "/gremlin/v1/test/{}".format(test_id))
+                activate[instance] = (data, len(instances[instance]) + 2)
+
+                _, responses = snapshots[instance]
+                previous = json.loads(responses[0][1] or b"null") or []  # 没有规则时代理返回 null
+                data = conn.encode("DELETE", "/gremlin/v1/rules")
+                for rule in previous:
+                    data += conn.encode("POST", "/gremlin/v1/rules/add", json.dumps(rule).encode())
+                count = len(previous) + 1
+                if previous_ids[instance]:
+                    data += conn.encode("PUT", "/gremlin/v1/test/{}".format(previous_ids[instance]))
+                    count += 1
+                elif previous_ids[instance] == "":
+                    data += conn.encode("DELETE", "/gremlin/v1/test/{}".format(test_id))
+                    count += 1
+                rollback[instance] = (data, count)
+
+            # 激活阶段
+            start_time = datetime.datetime.now(datetime.timezone.utc)
+            start = time.perf_counter()
+            done, errors = await each("activate_test", activate)
+            if errors:
+                for error in errors.values():
+                    print("FAILURE: Could not activate test on instance %s" % error)
+                _, rollback_errors = await each("rollback_test", rollback)
+                for error in rollback_errors.values():
+                    print("FAILURE: Could not roll back instance %s" % error)
+                unknown = sorted(instance for instance in rollback
+                                 if previous_ids[instance] is None and instance not in rollback_errors)
+                states = ["rolled back {} of {}".format(len(rollback) - len(rollback_errors) - len(unknown),
+                                                        len(rollback))]
+                if unknown:
+                    states.append("rules restored but test id possibly left as {} (previous test id unknown) on {}"
+                                  .format(test_id, ", ".join(unknown)))
+                if rollback_errors:
+                    states.append("state unknown on {}".format(", ".join(sorted(rollback_errors))))
+                first = next(iter(errors.values()))
+                raise type(first)("activation failed on {} of {} proxies, {}: {}".format(
+                    len(errors), len(activate), "; ".join(states), first))
+        finally:
+            for conn in connections.values():
+                conn.close()
+
+        self._id = test_id
+        self._start_time = start_time
+        self._queue = list(rules)
+        activated = {instance: finished - start for instance, (finished, _) in done.items()}
+        times = list(activated.values())
+        activation = TestActivation(test_id, activated, max(times) - min(times) if times else 0.0)
+        if self.debug:
+            print("test %s activated on %d proxies, skew %.1fms" % (test_id, len(activated), activation.skew * 1000))
+        return activation
+
+    def start_test(self, gremlins: dict[str, list[dict[str, any]]] = None, timeout: float = 10.0) -> str:
+        """在新的事件循环中执行 apply_test，代替 clear_rules_from_all_proxies + setup_failures + start_new_test
+
+        Returns:
+            新测试ID
+        """
+        return asyncio.run(self.apply_test(gremlins, timeout)).test_id
+
+    def _check_pattern(self, name: str, pattern: str):
+        """检查规则中的正则，代理无法编译时 AssertionError，可能回溯爆炸时打印警告
+
+        每个正则只分析一次; 调试模式下同时打印写法上的问题和对代理更便宜的写法。
+        """
+        report = analyze_pattern(pattern, header=name == 'headerpattern')
+        assert report.error is None, "invalid {} {!r}: {}".format(name, pattern, report.error)
+        if (name, pattern) in self._reported_patterns:
+            return
+        self._reported_patterns.add((name, pattern))
+        for warning in report.warnings:
+            print("WARNING: %s %r: %s" % (name, pattern, warning))
+        if self.debug:
+            for note in report.notes:
+                print("%s %r: %s" % (name, pattern, note))
+            if report.suggestion is not None:
+                print("%s %r: consider %r" % (name, pattern, report.suggestion))
+
     def _generate_and_add_rules(self, rtypes: list[str], **args):
         """生成故障
         Args:
@@ -224,6 +596,8 @@ class FailureGenerator(object):
         bodypattern: str = args['bodypattern']
         assert isinstance(headerpattern, str)
         assert isinstance(bodypattern, str)
+        self._check_pattern('headerpattern', headerpattern)
+        self._check_pattern('bodypattern', bodypattern)
 
         assert len(rtypes) != 0
         for rtype in rtypes:
@@ -255,6 +629,7 @@ class FailureGenerator(object):
             assert isinstance(mangledistribution, str) and mangledistribution in ['uniform', 'exponential', 'normal']
             searchstring: str = args['searchstring']
             assert isinstance(searchstring, str) and searchstring != ''
+            self._check_pattern('searchstring', searchstring)
             replacestring: str = args['replacestring']
             assert isinstance(replacestring, str)
 
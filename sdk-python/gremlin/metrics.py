@@ -0,0 +1,202 @@
+# coding=utf-8
+
+import bisect
+from collections import Counter
+
+from .circuitbreaker import CircuitBreaker, breaker_sequences
+from .events import REQUEST, RESPONSE, Event, _parse_duration_us
+
+# 回复时间直方图的桶上界(秒)，与 Prometheus 客户端的缺省值相同，最后还有一个 +Inf 桶
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class EdgeMetrics(object):
+    """一条调用边 (source, dest) 的弹性指标 Resilience aggregates of one caller -> callee edge"""
+
+    __slots__ = ('source', 'dest', 'requests', 'responses', 'statuses', 'faults', 'retries', 'retried_requests',
+                 'breaker_trips', 'latency_counts', 'latency_sum', 'latency_count')
+
+    def __init__(self, source: str, dest: str, buckets: int):
+        self.source: str = source
+        self.dest: str = dest
+        self.requests: int = 0  # 请求数，包括重试
+        self.responses: int = 0
+        self.statuses: Counter = Counter()  # HTTP 状态 -> 回复数
+        self.faults: Counter = Counter()  # 注入的故障 abort / delay / mangle -> 请求数
+        self.retries: int = 0  # 同一请求ID第一次之后的请求数
+        self.retried_requests: int = 0  # 有重试的请求ID数
+        self.breaker_trips: int or None = None  # 断路器断开次数，没有断路器配置时为 None
+        self.latency_counts: list[int] = [0] * (buckets + 1)  # 每个桶(不累积)的回复数，最后一个为 +Inf
+        self.latency_sum: int = 0  # 微秒
+        self.latency_count: int = 0
+
+    def to_dict(self) -> dict:
+        return {
+            "source": self.source,
+            "dest": self.dest,
+            "requests": self.requests,
+            "responses": self.responses,
+            "statuses": {str(status): count for status, count in sorted(self.statuses.items())},
+            "faults": dict(sorted(self.faults.items())),
+            "retries": self.retries,
+            "retried_requests": self.retried_requests,
+            "breaker_trips": self.breaker_trips,
+            "latency": {
+                "counts": list(self.latency_counts),
+                "sum": self.latency_sum / 1e6,
+                "count": self.latency_count,
+            },
+        }
+
+
+def _faults(actions: str, cache: dict) -> tuple:
+    """"[delay,abort]" -> ("delay", "abort")，actions 字符串是驻留的，按字符串缓存"""
+    faults = cache.get(actions)
+    if faults is None:
+        faults = cache[actions] = tuple(action for action in actions.strip("[]").split(",") if action)
+    return faults
+
+
+class ResilienceMetrics(object):
+    """一次测试每条调用边的弹性指标 Per-edge resilience metrics of one test
+
+    回复时间、重试、注入的故障和断路器断开次数在一次遍历中统计，可以导出为 JSON(to_dict)
+    或 Prometheus 文本格式(to_prometheus)，仪表盘按测试跟踪趋势，不需要直接查询日志索引。
+    """
+
+    def __init__(self, test_id: str, buckets: tuple = latency_buckets):
+        """
+        Args:
+            test_id: 测试ID
+            buckets: 回复时间直方图的桶上界(秒)，递增
+        """
+        assert list(buckets) == sorted(buckets) and len(set(buckets)) == len(buckets), "buckets must increase"
+        self.test_id: str = test_id
+        self.buckets: tuple = tuple(float(b) for b in buckets)
+        self._bounds: list[int] = [round(b * 1e6) for b in self.buckets]  # 微秒
+        self.edges: dict[tuple[str, str], EdgeMetrics] = {}
+
+    def edge(self, source: str, dest: str) -> EdgeMetrics:
+        edge = self.edges.get((source, dest))
+        if edge is None:
+            edge = self.edges[(source, dest)] = EdgeMetrics(source, dest, len(self.buckets))
+        return edge
+
+    def add_events(self, events: list[Event], breakers: list[dict] = ()):
+        """统计一次测试的事件
+
+        Args:
+            events: 包含 ts msg status source dest reqID host actions duration 的事件
+            breakers: 断路器配置，与 circuit_breaker 检查的参数相同(dest closed_attempts reset_time
+                headerprefix, 可选 source halfopen_attempts by_instance remove_retries)，
+                按配置统计对应调用边的断路器断开次数
+        """
+        attempts = Counter()  # (source, dest, reqID) -> 请求数
+        fault_cache = {}
+        for event in events:
+            if event.source is None or event.dest is None:
+                continue
+            edge = self.edge(event.source, event.dest)
+            if event.msg == REQUEST:
+                edge.requests += 1
+                if event.reqID is not None:
+                    attempts[(event.source, event.dest, event.reqID)] += 1
+                if event.actions:
+                    edge.faults.update(_faults(event.actions, fault_cache))
+            elif event.msg == RESPONSE:
+                edge.responses += 1
+                if event.status is not None:
+                    edge.statuses[event.status] += 1
+                if event.duration is not None:
+                    edge.latency_counts[bisect.bisect_left(self._bounds, event.duration)] += 1
+                    edge.latency_sum += event.duration
+                    edge.latency_count += 1
+        for (source, dest, _), count in attempts.items():
+            if count > 1:
+                edge = self.edges[(source, dest)]
+                edge.retries += count - 1
+                edge.retried_requests += 1
+
+        for breaker in breakers:
+            self._add_breaker_trips(events, breaker)
+
+    def _add_breaker_trips(self, events: list[Event], breaker: dict):
+        """按 circuit_breaker 检查的状态机和分区统计断开次数，断开时的请求不视为错误"""
+        dest = breaker['dest']
+        reset_us = _parse_duration_us(breaker['reset_time'])
+        partitions = breaker_sequences(events, dest, breaker['headerprefix'], breaker.get('source'),
+                                       breaker.get('by_instance', False), breaker.get('remove_retries', False))
+        for key, seq in partitions.items():
+            state = CircuitBreaker(breaker['closed_attempts'], reset_us, breaker.get('halfopen_attempts', 1))
+            trips = sum(1 for event in seq if state.step(event) in ("closed->open", "half-open->open"))
+            edge = self.edge(key[0], dest)
+            edge.breaker_trips = (edge.breaker_trips or 0) + trips
+
+    def to_dict(self) -> dict:
+        return {
+            "test_id": self.test_id,
+            "buckets": list(self.buckets),
+            "edges": [self.edges[key].to_dict() for key in sorted(self.edges)],
+        }
+
+    def to_prometheus(self) -> str:
+        """Prometheus 文本格式"""
+        return prometheus_text([self.to_dict()])
+
+
+def _label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(**labels) -> str:
+    return "{" + ",".join('{}="{}"'.format(name, _label_value(value)) for name, value in labels.items()) + "}"
+
+
+# (指标名, 类型, 说明)
+_families = (
+    ("gremlin_requests_total", "counter", "Requests sent from source to dest, including retries."),
+    ("gremlin_responses_total", "counter", "Responses received by source from dest, by HTTP status."),
+    ("gremlin_faults_total", "counter", "Requests with an injected fault, by fault action."),
+    ("gremlin_retries_total", "counter", "Requests beyond the first attempt of a request ID."),
+    ("gremlin_retried_requests_total", "counter", "Request IDs that were retried at least once."),
+    ("gremlin_breaker_trips_total", "counter", "Circuit breaker transitions to open, per configured breaker."),
+    ("gremlin_response_duration_seconds", "histogram", "Response time observed by the proxy."),
+)
+
+
+def prometheus_text(metrics: list[dict]) -> str:
+    """把多次测试的指标(ResilienceMetrics.to_dict() 的结果)输出为一份 Prometheus 文本格式
+
+    每个指标按 test_id, source, dest 区分，可以写入 node_exporter 的 textfile 目录或推送到 Pushgateway。
+    """
+    samples = {name: [] for name, _, _ in _families}
+    for test in metrics:
+        for edge in test["edges"]:
+            labels = dict(test_id=test["test_id"], source=edge["source"], dest=edge["dest"])
+            samples["gremlin_requests_total"].append((_labels(**labels), edge["requests"]))
+            for status, count in edge["statuses"].items():
+                samples["gremlin_responses_total"].append((_labels(**labels, code=status), count))
+            for action, count in edge["faults"].items():
+                samples["gremlin_faults_total"].append((_labels(**labels, action=action), count))
+            samples["gremlin_retries_total"].append((_labels(**labels), edge["retries"]))
+            samples["gremlin_retried_requests_total"].append((_labels(**labels), edge["retried_requests"]))
+            if edge["breaker_trips"] is not None:
+                samples["gremlin_breaker_trips_total"].append((_labels(**labels), edge["breaker_trips"]))
+            latency = edge["latency"]
+            histogram = samples["gremlin_response_duration_seconds"]
+            cumulative = 0
+            for bound, count in zip(test["buckets"] + ["+Inf"], latency["counts"]):
+                cumulative += count
+                histogram.append(("_bucket" + _labels(**labels, le=bound if bound == "+Inf" else repr(bound)),
+                                  cumulative))
+            histogram.append(("_sum" + _labels(**labels), repr(float(latency["sum"]))))
+            histogram.append(("_count" + _labels(**labels), latency["count"]))
+
+    lines = []
+    for name, kind, help_text in _families:
+        if not samples[name]:
+            continue
+        lines.append("# HELP {} {}".format(name, help_text))
+        lines.append("# TYPE {} {}".format(name, kind))
+        lines.extend("{}{} {}".format(name, labels, value) for labels, value in samples[name])
+    return "\n".join(lines) + "\n" if lines else ""
@@ -0,0 +1,180 @@
+# coding=utf-8
+
+import copy
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+
+from .eventsource import ElasticsearchSource, EventSource, _sort_key
+from .profiling import QueryStats
+from .sketch import QuantileSketch
+
+_ts_order = [{"ts": {"order": "asc"}}]  # 没有指定 sort 时合并命中的顺序
+
+
+def _sort_fields(sort) -> list[str]:
+    """sort 中的字段名"""
+    if isinstance(sort, (str, dict)):
+        sort = [sort]
+    return [spec if isinstance(spec, str) else next(iter(spec)) for spec in sort]
+
+
+class MultiClusterSource(EventSource):
+    """同时查询多个集群并合并结果 Fan-out event source over several regional log clusters
+
+    同一个测试在多个区域运行、每个区域有自己的 ElasticSearch 时，每个查询并发发给所有集群，
+    耗时取决于最慢的集群而不是所有集群之和。结果按 ElasticSearch 的语义合并:
+
+    * 命中数相加，每个集群按 sort(缺省 ts)排序返回前 size 条，归并后取前 size 条。
+      不支持 from 偏移，分页读取应像 bounded_percentile_latency 一样用 ts 范围过滤
+    * terms 聚合向每个集群请求全部桶，合并时相加文档数，再应用原来的 min_doc_count 和 size
+    * percentiles 聚合改为向每个集群请求按 QuantileSketch 的对数桶划分的 range 聚合，
+      合并各集群的桶计数后估计全局的百分位，相对误差不超过 percentile_accuracy(范围外的值按最近的桶计算)。
+      每个集群返回的桶数只取决于 percentile_range 和精度(缺省约 1150 个)，与事件数和不同的值的个数无关。
+      不合并各集群各自的百分位
+    """
+
+    def __init__(self, sources: list, percentile_accuracy: float = 0.01,
+                 percentile_range: tuple[float, float] = (1e-3, 1e7)):
+        """
+        Args:
+            sources: 每个集群的 ElasticSearch 地址(或同一集群的节点地址列表)或 EventSource 实例
+            percentile_accuracy: 合并 percentiles 聚合时百分位的相对误差上限
+            percentile_range: percentiles 聚合字段的取值范围，缺省为 1 微秒到约 2.8 小时(字段单位为毫秒)
+        """
+        assert len(sources) > 0, "MultiClusterSource needs at least one source"
+        self.sources: list[EventSource] = [source if isinstance(source, EventSource) else ElasticsearchSource(source)
+                                           for source in sources]
+        self.percentile_accuracy = percentile_accuracy
+        bounds = QuantileSketch(percentile_accuracy).bounds(*percentile_range)
+        self._percentile_ranges: list[dict] = [{"to": bounds[0]}] + \
+            [{"from": low, "to": high} for low, high in zip(bounds, bounds[1:])] + [{"from": bounds[-1]}]
+        self._executor: ThreadPoolExecutor or None = None
+
+    def cache_key(self) -> str:
+        return ",".join(source.cache_key() for source in self.sources)
+
+    def close(self):
+        """停止并发查询的线程，之后再查询时重新创建"""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def __enter__(self) -> 'MultiClusterSource':
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _each(self, fn, stats: QueryStats = None) -> list:
+        """在每个集群上并发执行 fn(source, stats)，结果与集群一一对应，任一集群失败时抛出异常"""
+        if len(self.sources) == 1:
+            return [fn(self.sources[0], stats)]
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(len(self.sources), thread_name_prefix="gremlin-fanout")
+        per_source = [QueryStats() if stats is not None else None for _ in self.sources]
+        futures = [self._executor.submit(fn, source, s) for source, s in zip(self.sources, per_source)]
+        results = [future.result() for future in futures]
+        if stats is not None:
+            for s in per_source:
+                stats.transfer_bytes += s.transfer_bytes
+                stats.decode += s.decode
+        return results
+
+    def search(self, body: dict, index: str = None, stats: QueryStats = None) -> dict:
+        return self.msearch([body], index, stats)[0]
+
+    def msearch(self, bodies: list[dict], index: str = None, stats: QueryStats = None) -> list[dict]:
+        if len(self.sources) == 1:
+            return self.sources[0].msearch(bodies, index, stats)
+        rewritten = [self._cluster_body(body) for body in bodies]
+
+        def run(source: EventSource, s: QueryStats) -> list[dict]:
+            if len(rewritten) == 1:
+                return [source.search(rewritten[0][0], index, s)]
+            return source.msearch([body for body, _ in rewritten], index, s)
+
+        per_source = self._each(run, stats)
+        return [self._merge(body, added, [responses[i] for responses in per_source])
+                for i, (body, (_, added)) in enumerate(zip(bodies, rewritten))]
+
+    def count(self, body: dict, index: str = None) -> int:
+        return sum(self._each(lambda source, _: source.count(body, index)))
+
+    def _cluster_body(self, body: dict) -> tuple[dict, list[str]]:
+        """发给每个集群的查询，以及为了归并在 _source 中加入的排序字段"""
+        if body.get("from", 0) != 0:
+            raise ValueError("MultiClusterSource does not support from, page with a ts range instead")
+        cluster = dict(body)
+        added = []
+        if body.get("size", 10) > 0:
+            sort = body.get("sort", _ts_order)
+            cluster["sort"] = sort
+            includes = body.get("_source")
+            if isinstance(includes, list):
+                added = [name for name in _sort_fields(sort) if name not in includes]
+                cluster["_source"] = includes + added
+        key = "aggs" if "aggs" in body else "aggregations"
+        if key in body:
+            aggs = {}
+            for name, agg in body[key].items():
+                if "terms" in agg:
+                    agg = copy.deepcopy(agg)
+                    agg["terms"]["size"] = 0
+                    agg["terms"]["min_doc_count"] = 1
+                elif "percentiles" in agg:
+                    # 各集群的桶计数可以相加，各集群的百分位不能
+                    agg = {"range": {"field": agg["percentiles"]["field"], "ranges": self._percentile_ranges}}
+                else:
+                    raise ValueError("Unsupported aggregation: {}".format(list(agg)))
+                aggs[name] = agg
+            cluster[key] = aggs
+        return cluster, added
+
+    def _merge(self, body: dict, added: list[str], responses: list[dict]) -> dict:
+        """按原查询合并每个集群的结果"""
+        size = body.get("size", 10)
+        hits = []
+        if size > 0:
+            merged = heapq.merge(*[response["hits"]["hits"] for response in responses],
+                                 key=_sort_key(body.get("sort", _ts_order)))
+            for hit in merged:
+                if len(hits) >= size:
+                    break
+                if added:
+                    hit = dict(hit, _source={k: v for k, v in hit["_source"].items() if k not in added})
+                hits.append(hit)
+        data = {
+            "took": max(response.get("took", 0) for response in responses),
+            "timed_out": any(response.get("timed_out", False) for response in responses),
+            "hits": {
+                "total": sum(response["hits"]["total"] for response in responses),
+                "hits": hits
+            }
+        }
+        key = "aggs" if "aggs" in body else "aggregations"
+        if key in body:
+            data["aggregations"] = {name: self._merge_aggregation(
+                name, agg, [response["aggregations"] for response in responses]) for name, agg in body[key].items()}
+        return data
+
+    def _merge_aggregation(self, name: str, agg: dict, results: list[dict]) -> dict:
+        if "terms" in agg:
+            terms = agg["terms"]
+            counts = {}
+            for result in results:
+                for bucket in result[name]["buckets"]:
+                    counts[bucket["key"]] = counts.get(bucket["key"], 0) + bucket["doc_count"]
+            min_doc_count = terms.get("min_doc_count", 1)
+            buckets = sorted(((k, c) for k, c in counts.items() if c >= min_doc_count),
+                             key=lambda kv: (-kv[1], kv[0]))
+            # size 0 表示返回全部桶
+            if terms.get("size", 10) != 0:
+                buckets = buckets[:terms.get("size", 10)]
+            return {"buckets": [{"key": k, "doc_count": c} for k, c in buckets]}
+
+        sketch = QuantileSketch(self.percentile_accuracy, max_buckets=len(self._percentile_ranges))
+        for result in results:
+            for bucket in result[name]["buckets"]:
+                sketch.add_range(bucket.get("from"), bucket.get("to"), bucket["doc_count"])
+        return {"values": {str(float(p)): sketch.quantile(p / 100)
+                           for p in agg["percentiles"].get("percents", [1, 5, 25, 50, 75, 95, 99])}}
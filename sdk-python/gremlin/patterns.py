@@ -0,0 +1,361 @@
+# coding=utf-8
+
+import functools
+import re
+import time
+from collections import namedtuple
+
+try:
+    from re import _constants as _sre, _parser as _sre_parse
+except ImportError:  # Python < 3.11
+    import sre_constants as _sre
+    import sre_parse as _sre_parse
+
+# error: 代理无法编译时的原因，否则为 None; warnings: 可能回溯爆炸的原因;
+# notes: 写法上可能的错误; suggestion: 对代理更便宜的写法，没有时为 None;
+# replayable: Python re 能否按 RE2 的语义执行，否则离线回放等客户端工具无法使用这个正则
+PatternReport = namedtuple('PatternReport', ['pattern', 'error', 'warnings', 'notes', 'suggestion', 'replayable'])
+
+# Go regexp 允许的最大重复次数
+_max_repeat_count = 1000
+# 一次探测超过这个时间(秒)视为灾难性回溯
+_probe_budget = 0.01
+_unbounded = (_sre.MAX_REPEAT, _sre.MIN_REPEAT)
+# RE2 的 POSIX 字符类 [[:alpha:]] 对应的 Python 字符类内容
+_posix_classes = {
+    "alnum": "0-9A-Za-z", "alpha": "A-Za-z", "ascii": "\\x00-\\x7f", "blank": "\\t ",
+    "cntrl": "\\x00-\\x1f\\x7f", "digit": "0-9", "graph": "!-~", "lower": "a-z", "print": " -~",
+    "punct": "!-/:-@\\[-`{-~", "space": "\\t\\n\\v\\f\\r ", "upper": "A-Z", "word": "0-9A-Za-z_",
+    "xdigit": "0-9A-Fa-f",
+}
+# Python re 的这些编译错误 RE2 同样会报，其余错误来自 Python re 不支持的写法
+_shared_errors = ("nothing to repeat", "multiple repeat", "missing ), unterminated subpattern",
+                  "unbalanced parenthesis", "unterminated character set", "bad character range",
+                  "bad escape", "min repeat greater than max repeat", "invalid group reference")
+
+
+class PatternNotReplayable(re.error):
+    """代理(RE2)可以编译，但 Python re 无法按相同语义执行的正则"""
+
+
+def _translate(pattern: str) -> tuple[str, bool]:
+    """把 RE2 写法转换为 Python re 的写法
+
+    \\z、POSIX 字符类、\\Q...\\E、\\x{...}、(?<name>...) 和表达式中间的 (?i) 等标志有等价写法;
+    \\p{...} Unicode 类、\\C 和 U 标志没有，用近似写法代替以便继续检查结构。
+    RE2 拒绝的 \\Z 抛出 re.error。
+
+    Returns:
+        (Python 正则, 是否与 RE2 语义相同)
+    """
+    out = []
+    exact = True
+    in_class = False
+    groups = []  # 每层未闭合的分组中，由表达式中间的标志打开、需要随分组闭合的 (?flags: 分组
+    flags = []  # 当前分组中的这类标志分组
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == "\\" and i + 1 < n:
+            e = pattern[i + 1]
+            i += 2
+            if e == "Z" and not in_class:
+                raise re.error(r"\Z is not supported by RE2, use \z", pattern, i - 2)
+            if e == "z" and not in_class:
+                out.append(r"\Z")
+            elif e in "pP":
+                # Unicode 类，Python re 不支持
+                if pattern.startswith("{", i):
+                    end = pattern.find("}", i)
+                    i = n if end == -1 else end + 1
+                else:
+                    i += 1
+                exact = False
+                out.append(r"\s\S" if in_class else r"[\s\S]")
+            elif e == "C":
+                exact = False
+                out.append(r"\s\S" if in_class else r"[\s\S]")
+            elif e == "Q":
+                end = pattern.find(r"\E", i)
+                end = n if end == -1 else end
+                out.append(re.escape(pattern[i:end]))
+                i = end + 2
+            elif e == "E":
+                pass
+            elif e == "x" and pattern.startswith("{", i):
+                end = pattern.find("}", i)
+                try:
+                    out.append(r"\U{:08x}".format(int(pattern[i + 1:end], 16)))
+                except ValueError:
+                    raise re.error(r"bad escape \x{...}", pattern, i - 2) from None
+                i = end + 1
+            else:
+                out.append(c + e)
+            continue
+        if in_class:
+            if pattern.startswith("[:", i):
+                end = pattern.find(":]", i + 2)
+                name = pattern[i + 2:end] if end != -1 else ""
+                if name.lstrip("^") in _posix_classes:
+                    if name.startswith("^"):
+                        # 字符类中取反的 POSIX 类在 Python re 中无法表示
+                        exact = False
+                        out.append(r"\s\S")
+                    else:
+                        out.append(_posix_classes[name])
+                    i = end + 2
+                    continue
+            if c == "]":
+                in_class = False
+                out.append(c)
+            else:
+                # RE2 中字符类里的 [ & ~ | 都是普通字符，Python re 会对它们发出 FutureWarning
+                out.append("\\" + c if c in "[&~|" else c)
+            i += 1
+            continue
+        if c == "[":
+            in_class = True
+            out.append(c)
+            i += 1
+            if pattern.startswith("^", i):
+                out.append("^")
+                i += 1
+            if pattern.startswith("]", i):
+                out.append(r"\]")
+                i += 1
+            continue
+        if c == "(":
+            m = re.match(r"\(\?([imsUxaLu]*(?:-[imsUxaLu]*)?)([:)])", pattern[i:])
+            if m is not None and m.group(1):
+                letters = m.group(1)
+                if "U" in letters:
+                    # 非贪婪模式，Python re 没有对应的标志
+                    exact = False
+                    letters = letters.replace("U", "")
+                if letters.endswith("-"):
+                    letters = letters[:-1]
+                i += m.end()
+                if m.group(2) == ":":
+                    groups.append(flags)
+                    flags = []
+                    out.append("(?{}:".format(letters) if letters else "(?:")
+                elif letters and not out and "-" not in letters:
+                    out.append("(?{})".format(letters))
+                elif letters:
+                    # 表达式中间的标志作用到所在分组结束，Python re 只允许在开头出现
+                    flags.append("(?{}:".format(letters))
+                    out.append(flags[-1])
+                continue
+            if pattern.startswith("(?<", i) and not pattern.startswith(("(?<=", "(?<!"), i):
+                out.append("(?P<")
+                i += 3
+            else:
+                out.append(c)
+                i += 1
+            groups.append(flags)
+            flags = []
+            continue
+        if c == ")":
+            out.append(")" * len(flags) + ")")
+            flags = groups.pop() if groups else []
+            i += 1
+            continue
+        if c == "|" and flags:
+            out.append(")" * len(flags) + "|" + "".join(flags))
+            i += 1
+            continue
+        out.append(c)
+        i += 1
+    out.append(")" * len(flags))
+    return "".join(out), exact
+
+
+def _compile(pattern: str) -> tuple[re.Pattern, list, bool]:
+    """编译 RE2 正则，返回 (Python 正则, 解析结果, 是否与 RE2 语义相同)
+
+    代理会拒绝时抛出 re.error，只有 Python re 无法编译时抛出 PatternNotReplayable。
+    """
+    if "(?#" in pattern:
+        raise re.error("comments are not supported by RE2", pattern)
+    translated, exact = _translate(pattern)
+    try:
+        compiled = re.compile(translated)
+    except re.error as e:
+        if e.msg.startswith(_shared_errors):
+            raise
+        raise PatternNotReplayable("Python re cannot compile {!r}: {}".format(pattern, e.msg), pattern) from e
+    parsed = _sre_parse.parse(translated)
+    error = _re2_error(parsed)
+    if error is not None:
+        raise re.error(error, pattern)
+    return compiled, parsed, exact
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_pattern(pattern: str) -> re.Pattern:
+    """编译并缓存规则中的正则(RE2 写法)
+
+    代理无法编译时抛出 re.error; 代理可以编译但 Python re 无法按相同语义执行时抛出 PatternNotReplayable。
+    """
+    compiled, _, exact = _compile(pattern)
+    if not exact:
+        raise PatternNotReplayable("{!r} uses RE2 syntax Python re cannot evaluate".format(pattern), pattern)
+    return compiled
+
+
+def _re2_error(parsed) -> str or None:
+    """Python re 接受但代理(Go regexp, RE2 语法)拒绝的写法"""
+    if parsed.state.flags & (re.VERBOSE | re.ASCII | re.LOCALE):
+        return "flags x, a and L are not supported by RE2"
+
+    def walk(items) -> str or None:
+        for op, av in items:
+            if op in (_sre.GROUPREF, _sre.GROUPREF_EXISTS):
+                return "backreferences are not supported by RE2"
+            if op in (_sre.ASSERT, _sre.ASSERT_NOT):
+                return "lookaround assertions are not supported by RE2"
+            if op.name in ("ATOMIC_GROUP", "POSSESSIVE_REPEAT"):
+                return "atomic groups and possessive quantifiers are not supported by RE2"
+            if op in _unbounded:
+                lo, hi, sub = av
+                if lo > _max_repeat_count or (hi != _sre.MAXREPEAT and hi > _max_repeat_count):
+                    return "repeat count above {} is not supported by RE2".format(_max_repeat_count)
+                error = walk(sub)
+            elif op == _sre.SUBPATTERN:
+                if av[1] & (re.VERBOSE | re.ASCII | re.LOCALE):
+                    return "flags x, a and L are not supported by RE2"
+                error = walk(av[-1])
+            elif op == _sre.BRANCH:
+                error = next((e for e in (walk(branch) for branch in av[1]) if e), None)
+            else:
+                error = None
+            if error:
+                return error
+        return None
+
+    return walk(parsed)
+
+
+def _static_warnings(parsed) -> list[str]:
+    """静态分析可能导致回溯爆炸的结构"""
+    warnings = []
+
+    def walk(items, in_repeat: bool):
+        dot_stars = 0
+        for op, av in items:
+            if op in _unbounded:
+                lo, hi, sub = av
+                unbounded = hi == _sre.MAXREPEAT
+                if unbounded and in_repeat:
+                    warnings.append("nested quantifiers")
+                if unbounded and len(sub) == 1 and sub[0][0] == _sre.ANY:
+                    dot_stars += 1
+                walk(sub, in_repeat or unbounded)
+            elif op == _sre.SUBPATTERN:
+                walk(av[-1], in_repeat)
+            elif op == _sre.BRANCH:
+                for branch in av[1]:
+                    walk(branch, in_repeat)
+        if dot_stars >= 3:
+            warnings.append("several .* in sequence")
+
+    walk(parsed, False)
+    return sorted(set(warnings))
+
+
+def _probe(compiled: re.Pattern, parsed) -> str or None:
+    """用重复字符加不匹配的结尾探测回溯，耗时随长度爆炸时返回说明"""
+    chars = []
+
+    def literals(items):
+        for op, av in items:
+            if op == _sre.LITERAL:
+                chars.append(chr(av))
+            elif op in _unbounded:
+                literals(av[2])
+            elif op == _sre.SUBPATTERN:
+                literals(av[-1])
+            elif op == _sre.BRANCH:
+                for branch in av[1]:
+                    literals(branch)
+
+    literals(parsed)
+    candidates = list(dict.fromkeys(chars + ['a', '0', ' ']))[:8]
+    for c in candidates:
+        for n in (8, 12, 16, 20, 24):
+            text = c * n + "\x00"
+            start = time.perf_counter()
+            compiled.search(text)
+            elapsed = time.perf_counter() - start
+            if elapsed > _probe_budget:
+                return "search took {:.0f}ms on {!r}*{}".format(elapsed * 1000, c, n)
+    return None
+
+
+def _suggestion(pattern: str, parsed, header: bool) -> tuple[str or None, list[str]]:
+    """更便宜的等价写法，以及写法上可能的错误"""
+    notes = []
+    items = list(parsed)
+    if not items or all(op in _unbounded and av[0] == 0 and len(av[2]) == 1 and av[2][0][0] == _sre.ANY
+                        for op, av in items):
+        return ('' if pattern != '' else None), notes
+    suggestion = pattern
+    # 不锚定的搜索中开头和结尾的 .* 是多余的
+    while suggestion.startswith(".*") and not suggestion.startswith(".*?"):
+        suggestion = suggestion[2:]
+    while suggestion.endswith(".*") and not suggestion.endswith("\\.*"):
+        suggestion = suggestion[:-2]
+    # testUser-* 这样的 glob 写法，* 只重复前一个字符
+    op, av = items[-1]
+    if op in _unbounded and av[0] == 0 and len(av[2]) == 1 and av[2][0][0] == _sre.LITERAL and \
+            suggestion.endswith(chr(av[2][0][1]) + "*"):
+        notes.append("trailing {!r} repeats {!r} zero or more times, did you mean '.*'?".format(
+            suggestion[-2:], suggestion[-2]))
+        suggestion = suggestion[:-2]
+    # 请求头值为 前缀+序号 时，锚定前缀可以在前几个字符就排除不匹配的消息
+    if header and suggestion and not suggestion.startswith("^") and items[0][0] == _sre.LITERAL:
+        suggestion = "^" + suggestion
+    if suggestion == pattern:
+        return None, notes
+    try:
+        compile_pattern(suggestion)
+    except re.error:
+        return None, notes
+    return suggestion, notes
+
+
+@functools.lru_cache(maxsize=1024)
+def analyze_pattern(pattern: str, header: bool = False, probe: bool = True) -> PatternReport:
+    """检查规则中的 headerpattern / bodypattern Validate and cost-check a rule pattern once
+
+    代理用 Go 的 regexp (RE2) 编译规则：语法错误和 RE2 不支持的写法(反向引用、环视、\\Z、占有量词等)
+    作为 error 返回。RE2 特有的写法(\\z、\\pL、[[:alpha:]] 等)先转换为 Python re 的写法再分析，
+    没有等价写法或 Python re 无法编译时 replayable 为 False，离线回放等客户端工具无法使用这个正则。
+    RE2 的匹配时间与输入长度成线性，但客户端工具使用 Python re，
+    嵌套的量词会导致回溯爆炸，通过静态分析和计时探测给出 warnings。
+    suggestion 是对代理更便宜的写法：去掉多余的 .*，请求头模式锚定前缀(值以该前缀开头时等价)，
+    不锚定时每条消息都要从每个位置开始尝试匹配。
+
+    Args:
+        pattern: 正则
+        header: 是否是 headerpattern
+        probe: 是否计时探测回溯
+    """
+    try:
+        compiled, parsed, exact = _compile(pattern)
+    except PatternNotReplayable as e:
+        return PatternReport(pattern, None, [], ["not replayable offline: " + str(e)], None, False)
+    except re.error as e:
+        return PatternReport(pattern, str(e), [], [], None, False)
+
+    warnings = _static_warnings(parsed)
+    notes = []
+    if exact:
+        if probe:
+            slow = _probe(compiled, parsed)
+            if slow is not None:
+                warnings.append("catastrophic backtracking: " + slow)
+    else:
+        notes.append("not replayable offline: uses RE2 syntax Python re cannot evaluate")
+    suggestion, suggestion_notes = _suggestion(pattern, parsed, header)
+    return PatternReport(pattern, None, warnings, notes + suggestion_notes, suggestion, exact)
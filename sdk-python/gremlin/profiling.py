@@ -0,0 +1,87 @@
+# coding=utf-8
+
+
+class QueryStats(object):
+    """一次往返的传输统计 Transfer statistics of one round trip to the event source"""
+
+    __slots__ = ('transfer_bytes', 'decode')
+
+    def __init__(self):
+        self.transfer_bytes: int = 0  # 线上传输的回复字节数(压缩时为压缩后大小)
+        self.decode: float = 0.0  # JSON 解析耗时(秒)
+
+
+class CheckProfile(object):
+    """一个检查的耗时和数据量 Per-check timings and sizes
+
+    时间单位为秒，took 为 ElasticSearch 报告的查询耗时(毫秒)。
+    多个检查共享一次 msearch 时，传输字节数和解析耗时按查询数分摊。
+    """
+
+    __slots__ = ('name', 'queries', 'build', 'took', 'transfer_bytes', 'decode', 'evaluate',
+                 'hits', 'buckets', 'elapsed')
+
+    def __init__(self, name: str):
+        self.name: str = name
+        self.queries: int = 0  # 查询数
+        self.build: float = 0.0  # 生成第一组查询的耗时
+        self.took: int = 0  # ElasticSearch 查询耗时之和(毫秒)
+        self.transfer_bytes: float = 0
+        self.decode: float = 0.0
+        self.evaluate: float = 0.0  # 处理结果的耗时
+        self.hits: int = 0  # 返回的命中数
+        self.buckets: int = 0  # 返回的聚合桶数
+        self.elapsed: float = 0.0  # 从开始到得出结果的总耗时
+
+    def add_responses(self, responses: list[dict]):
+        """累计查询结果中的耗时、命中数和桶数"""
+        self.queries += len(responses)
+        for response in responses:
+            self.took += response.get("took", 0)
+            self.hits += len(response["hits"]["hits"])
+            for aggregation in response.get("aggregations", {}).values():
+                self.buckets += len(aggregation.get("buckets", ()))
+
+    def add_stats(self, stats: QueryStats, share: float = 1.0):
+        """累计传输统计
+
+        Args:
+            stats: 一次往返的统计
+            share: 本检查在这次往返中所占的比例
+        """
+        self.transfer_bytes += stats.transfer_bytes * share
+        self.decode += stats.decode * share
+
+    def to_dict(self) -> dict[str: any]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self) -> str:
+        return "CheckProfile({})".format(", ".join("{}={!r}".format(k, v) for k, v in self.to_dict().items()))
+
+
+class ProxyStats(object):
+    """对一个代理的一种控制操作的统计 Control plane statistics for one operation on one proxy"""
+
+    __slots__ = ('count', 'errors', 'total_rtt', 'max_rtt')
+
+    def __init__(self):
+        self.count: int = 0
+        self.errors: int = 0
+        self.total_rtt: float = 0.0  # 秒
+        self.max_rtt: float = 0.0
+
+    def add(self, rtt: float, error: bool):
+        self.count += 1
+        self.errors += int(error)
+        self.total_rtt += rtt
+        self.max_rtt = max(self.max_rtt, rtt)
+
+    @property
+    def mean_rtt(self) -> float:
+        return self.total_rtt / self.count if self.count else 0.0
+
+    def to_dict(self) -> dict[str: any]:
+        return {"count": self.count, "errors": self.errors, "mean_rtt": self.mean_rtt, "max_rtt": self.max_rtt}
+
+    def __repr__(self) -> str:
+        return "ProxyStats({})".format(", ".join("{}={!r}".format(k, v) for k, v in self.to_dict().items()))
@@ -0,0 +1,77 @@
+# coding=utf-8
+
+import hashlib
+import json
+import os
+import zlib
+
+
+class QueryCache(object):
+    """已结束测试的查询结果磁盘缓存 On-disk cache of query results for finished tests
+
+    测试结束后日志不再变化，相同查询的结果可以重复使用。
+    缓存键由日志服务器、测试ID和规范化后的查询体组成，结果以 zlib 压缩的 JSON 保存，
+    总大小超过上限时按最近使用时间淘汰。
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 256 * 1024 * 1024):
+        """
+        Args:
+            directory: 缓存目录，不存在时创建
+            max_bytes: 缓存文件总大小上限
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._size = sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file())
+
+    @staticmethod
+    def _digest(value) -> str:
+        return hashlib.sha1(json.dumps(value, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+    def _path(self, host: str, test_id: str, body: dict) -> str:
+        # 文件名以测试的键开头，便于按测试失效
+        return os.path.join(self.directory, "{}-{}.z".format(self._digest([host, test_id])[:16],
+                                                             self._digest(body)))
+
+    def get(self, host: str, test_id: str, body: dict) -> dict or None:
+        """读取缓存的查询结果，未命中时返回 None"""
+        path = self._path(host, test_id, body)
+        try:
+            with open(path, 'rb') as fp:
+                data = json.loads(zlib.decompress(fp.read()))
+        except (OSError, ValueError, zlib.error):
+            return None
+        os.utime(path)  # 记录最近使用时间
+        return data
+
+    def put(self, host: str, test_id: str, body: dict, data: dict):
+        """保存查询结果，必要时淘汰最久未使用的结果"""
+        path = self._path(host, test_id, body)
+        blob = zlib.compress(json.dumps(data, separators=(',', ':')).encode())
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as fp:
+            fp.write(blob)
+        if os.path.exists(path):
+            self._size -= os.path.getsize(path)
+        os.replace(tmp, path)
+        self._size += len(blob)
+        if self._size > self.max_bytes:
+            self._evict()
+
+    def invalidate(self, host: str, test_id: str):
+        """删除一个测试的所有缓存结果"""
+        prefix = self._digest([host, test_id])[:16] + '-'
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith(prefix):
+                self._size -= entry.stat().st_size
+                os.remove(entry.path)
+
+    def _evict(self):
+        entries = sorted((entry for entry in os.scandir(self.directory) if entry.is_file()),
+                         key=lambda entry: entry.stat().st_mtime)
+        for entry in entries:
+            if self._size <= self.max_bytes:
+                break
+            self._size -= entry.stat().st_size
+            os.remove(entry.path)
@@ -0,0 +1,155 @@
+# coding=utf-8
+
+import random
+import re
+import time
+from collections import Counter, namedtuple
+
+from .failuregenerator import Rule
+from .patterns import PatternNotReplayable, compile_pattern
+
+TraceMessage = namedtuple('TraceMessage', ['source', 'dest', 'messagetype', 'reqID', 'body'])
+RuleHits = namedtuple('RuleHits', ['rule', 'hits', 'delays', 'mangles', 'aborts'])
+# 相同的消息只计算一次，evaluations 和 matches 按不同的消息计数，时间单位为秒
+PatternCost = namedtuple('PatternCost', ['pattern', 'evaluations', 'matches', 'total', 'max'])
+ReplayReport = namedtuple('ReplayReport', ['messages', 'matched', 'rules', 'patterns', 'invalid', 'unreplayable',
+                                           'elapsed'])
+
+# 日志中的 msg 对应的消息类型
+_msg_types = {"Request": "request", "Response": "response"}
+
+
+def trace_from_events(events) -> list[TraceMessage]:
+    """把记录的流量转换为回放用的消息
+
+    Args:
+        events: 代理日志事件(msg 为 Request/Response，没有消息体)，
+            或带 source, dest, messagetype, reqID, body 的字典
+    """
+    trace = []
+    for event in events:
+        if "_source" in event:
+            event = event["_source"]
+        messagetype = event.get("messagetype") or _msg_types.get(event.get("msg"))
+        if messagetype is None:
+            continue
+        trace.append(TraceMessage(event.get("source", ""), event.get("dest", ""), messagetype,
+                                  event.get("reqID", ""), event.get("body", "")))
+    return trace
+
+
+def _draw_and_decide(rng: random.Random, distribution: str, base: float, probability: float) -> bool:
+    """与代理的 drawAndDecide 相同的随机决定"""
+    if distribution == "uniform":
+        return rng.random() * base < probability
+    if distribution == "exponential":
+        return rng.expovariate(1.0) * base < probability
+    if distribution == "normal":
+        return rng.gauss(0.0, 1.0) * base < probability
+    return False
+
+
+class ReplayEngine(object):
+    """离线回放故障规则 Offline rule matching replay over recorded traffic
+
+    按代理的语义计算记录的流量会命中哪条规则：规则按 (source, dest, messagetype) 分组，保持加入顺序，
+    只有带 reqID 的消息参与匹配，headerpattern 匹配 reqID、bodypattern 匹配消息体(不锚定的搜索)，
+    第一条都匹配的规则生效。命中后按 drawAndDecide 的方式决定延迟、篡改和中止。
+    每条消息独立计算，不模拟中止的请求没有回复。
+
+    代理使用 Go 的 RE2 正则，这里把 RE2 写法转换为 Python re 执行，两者对常见模式的结果相同，
+    但 RE2 不支持反向引用和环视，re 的回溯模式在 RE2 中是线性时间的。
+    使用 \\pL 等 Python re 无法执行的写法的规则不参与回放，列在 unreplayable 中，
+    它们之后同一组的规则的命中数可能偏多。
+    """
+
+    def __init__(self, rules: list[Rule], seed: int = None):
+        """
+        Args:
+            rules: 故障规则，如 FailureGenerator.get_rules()
+            seed: 可选 决定故障动作的随机数种子
+        """
+        self.rules: list[Rule] = list(rules)
+        self.seed = seed
+        self._patterns: dict[str, re.Pattern] = {}
+        self.invalid: list[tuple[int, str]] = []  # (规则序号, 错误)
+        self.unreplayable: list[tuple[int, str]] = []  # (规则序号, 原因) 代理可以编译但无法离线执行
+        self._table: dict[tuple[str, str, str], list[tuple[int, str, str]]] = {}
+        for i, rule in enumerate(self.rules):
+            try:
+                for pattern in (rule.headerpattern, rule.bodypattern):
+                    if pattern not in self._patterns:
+                        self._patterns[pattern] = compile_pattern(pattern)
+            except PatternNotReplayable as e:
+                self.unreplayable.append((i, str(e)))
+                continue
+            except re.error as e:
+                # 代理会拒绝这条规则
+                self.invalid.append((i, "{!r}: {}".format(e.pattern, e)))
+                continue
+            self._table.setdefault((rule.source, rule.dest, rule.messagetype), []).append(
+                (i, rule.headerpattern, rule.bodypattern))
+
+    def replay(self, trace, faults: bool = True) -> ReplayReport:
+        """回放流量
+
+        Args:
+            trace: TraceMessage 序列，可以用 trace_from_events 从日志得到
+            faults: 是否对命中的消息决定故障动作
+
+        Returns:
+            每条规则的命中数和故障动作数，每个正则的匹配次数和耗时
+        """
+        start = time.perf_counter()
+        rng = random.Random(self.seed)
+        # 相同的消息只匹配一次
+        messages = Counter((m.source, m.dest, m.messagetype, m.reqID, m.body) for m in trace)
+        hits = [[0, 0, 0, 0] for _ in self.rules]
+        cost = {pattern: [0, 0, 0, 0] for pattern in self._patterns}  # 次数, 匹配数, 总耗时(ns), 最大耗时
+        matched = 0
+
+        def search(pattern: str, text: str) -> bool:
+            t = time.perf_counter_ns()
+            found = self._patterns[pattern].search(text) is not None
+            elapsed = time.perf_counter_ns() - t
+            c = cost[pattern]
+            c[0] += 1
+            c[1] += found
+            c[2] += elapsed
+            c[3] = max(c[3], elapsed)
+            return found
+
+        for (source, dest, messagetype, reqID, body), count in messages.items():
+            if not reqID:
+                continue
+            if isinstance(body, bytes):
+                body = body.decode("utf-8", "replace")
+            for i, headerpattern, bodypattern in self._table.get((source, dest, messagetype), ()):
+                if search(headerpattern, reqID) and search(bodypattern, body or ""):
+                    break
+            else:
+                continue
+            matched += count
+            hits[i][0] += count
+            if not faults:
+                continue
+            rule = self.rules[i]
+            for _ in range(count):
+                if _draw_and_decide(rng, rule.delaydistribution, 1.0, rule.delayprobability):
+                    hits[i][1] += 1
+                if _draw_and_decide(rng, rule.mangledistribution, 1.0 - rule.delayprobability,
+                                    rule.mangleprobability):
+                    hits[i][2] += 1
+                if _draw_and_decide(rng, rule.abortdistribution,
+                                    1.0 - rule.delayprobability - rule.mangleprobability, rule.abortprobability):
+                    hits[i][3] += 1
+
+        return ReplayReport(
+            sum(messages.values()),
+            matched,
+            [RuleHits(rule, *counts) for rule, counts in zip(self.rules, hits)],
+            [PatternCost(pattern, c[0], c[1], c[2] / 1e9, c[3] / 1e9) for pattern, c in
+             sorted(cost.items(), key=lambda kv: -kv[1][2])],
+            list(self.invalid),
+            list(self.unreplayable),
+            time.perf_counter() - start)
@@ -0,0 +1,380 @@
+# coding=utf-8
+
+import hashlib
+import json
+import mmap
+import os
+import re
+import threading
+import time
+from array import array
+
+from .events import _format_duration, _format_ts, _parse_duration_us, _parse_ts, msg_kinds
+from .eventsource import EventSource, _clauses, _match, _required_terms, _respond
+from .profiling import QueryStats
+
+# 定长数值列 (列名, array 类型码, 缺失值)
+_numeric_columns = (
+    ("ts", "q", -2 ** 63),  # 微秒，本地时间
+    ("duration", "q", -2 ** 63),  # 微秒
+    ("status", "h", -2 ** 15),
+    ("errorcode", "i", -2 ** 31),
+    ("delaytime", "i", -2 ** 31),  # 毫秒
+    ("msg", "B", 255),  # msg_kinds 中的序号
+)
+# 字符串列，保存段内字符串表的序号，0 表示缺失
+_string_columns = ("source", "dest", "reqID", "uri", "actions", "host", "protocol")
+
+block_rows = 4096  # 稀疏索引每块的行数
+_test_dir_re = re.compile(r"^[0-9A-Za-z_-]+$")
+
+
+def _matching_rows(data: bytes, pattern: bytes, itemsize: int):
+    """定长项的字节序列 data 中等于 pattern 的项的序号，由 bytes.find 在 C 中搜索"""
+    i = data.find(pattern)
+    while i >= 0:
+        offset = i % itemsize
+        if offset == 0:
+            yield i // itemsize
+            i = data.find(pattern, i + itemsize)
+        else:
+            # 跨项的匹配，从下一项开始继续搜索
+            i = data.find(pattern, i + itemsize - offset)
+
+
+def _ts_bounds(query: dict) -> tuple[int or None, int or None]:
+    """查询要求的 ts 范围(微秒)，用于按稀疏索引跳过数据块"""
+    low, high = None, None
+    (kind, clause), = query.items()
+    if kind == "filtered":
+        parts = [clause.get("query", {"match_all": {}}), clause.get("filter", {"match_all": {}})]
+    elif kind == "bool":
+        parts = _clauses(clause, "must", "filter")
+    elif kind == "range" and "ts" in clause:
+        for op, bound in clause["ts"].items():
+            if op in ("gte", "gt"):
+                low = _parse_ts(bound)
+            elif op in ("lte", "lt"):
+                high = _parse_ts(bound)
+        return low, high
+    else:
+        return low, high
+    for part in parts:
+        l, h = _ts_bounds(part)
+        if l is not None:
+            low = l if low is None else max(low, l)
+        if h is not None:
+            high = h if high is None else min(high, h)
+    return low, high
+
+
+class _Segment(object):
+    """一个段的列、字符串表和稀疏索引"""
+
+    def __init__(self, testid: str, rows: int, columns: dict, strings: list, index=None, mmaps=(),
+                 ids: dict = None):
+        self.testid = testid
+        self.rows = rows
+        self.columns = columns  # 列名 -> 可按行号索引的整数序列
+        self.strings = strings  # 序号 -> 字符串，strings[0] 为 None
+        self.ids = ids  # 字符串 -> 序号，None 时在第一次查找时建立
+        self.index = index  # 每块 (最小 ts, 最大 ts)，None 时不能跳过数据块
+        self._mmaps = mmaps
+
+    @classmethod
+    def open(cls, testid: str, path: str) -> '_Segment':
+        """mmap 打开已封闭的段"""
+        with open(os.path.join(path, "strings.json")) as fp:
+            strings = [None] + json.load(fp)
+        columns = {}
+        mmaps = []
+        rows = None
+        for name, code in [(name, code) for name, code, _ in _numeric_columns] + \
+                          [(name, "I") for name in _string_columns] + [("index", "q")]:
+            with open(os.path.join(path, name + ".col"), 'rb') as fp:
+                size = os.fstat(fp.fileno()).st_size
+                if size == 0:
+                    columns[name] = array(code)
+                    continue
+                mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            mmaps.append(mm)
+            columns[name] = memoryview(mm).cast(code)
+            if name == "ts":
+                rows = len(columns[name])
+        index = columns.pop("index")
+        return cls(testid, rows or 0, columns, strings, index, mmaps)
+
+    def close(self):
+        for column in list(self.columns.values()) + [self.index]:
+            if isinstance(column, memoryview):
+                column.release()
+        for mm in self._mmaps:
+            mm.close()
+
+    def string_id(self, value) -> int:
+        """字符串在段内的序号，段中没有时为 0"""
+        if self.ids is None:
+            self.ids = {string: i for i, string in enumerate(self.strings) if i}
+        return self.ids.get(value, 0)
+
+    def _checks(self, terms: dict) -> list[tuple] or None:
+        """term 条件转换为 (列, 值, 值的字节表示)，字符串列在前; 段中不可能有匹配时为 None"""
+        strings, numbers = [], []
+        codes = dict((name, code) for name, code, _ in _numeric_columns)
+        for name, value in terms.items():
+            if name in _string_columns:
+                i = self.string_id(value)
+                if i == 0:
+                    return None  # 段中没有这个字符串
+                strings.append((self.columns[name], i, array("I", [i]).tobytes()))
+            elif name == "msg":
+                if value not in msg_kinds:
+                    return None
+                i = msg_kinds.index(value)
+                numbers.append((self.columns["msg"], i, array("B", [i]).tobytes()))
+            elif name in ("status", "errorcode", "delaytime") and isinstance(value, int):
+                try:
+                    pattern = array(codes[name], [value]).tobytes()
+                except OverflowError:
+                    return None  # 超出列的范围，不可能相等
+                numbers.append((self.columns[name], value, pattern))
+        return strings + numbers
+
+    def scan(self, terms: dict, low: int or None, high: int or None):
+        """返回满足 term 条件和 ts 范围的事件，事件只包含存储的列
+
+        每个数据块先按稀疏索引跳过 ts 范围不相交的块，再在每个条件列的字节中搜索值，
+        有一列不含所需值时跳过整块，第一列中找到的行再逐个检查其余的列和 ts。
+        """
+        checks = self._checks(terms)
+        if checks is None:
+            return
+        ts = self.columns["ts"]
+        missing = _numeric_columns[0][2]
+        for block in range(0, (self.rows + block_rows - 1) // block_rows):
+            if self.index is not None and (
+                    (low is not None and self.index[2 * block + 1] < low) or
+                    (high is not None and self.index[2 * block] > high)):
+                continue
+            start, stop = block * block_rows, min(self.rows, (block + 1) * block_rows)
+            if checks:
+                # 切片复制一块的列(不导出缓冲区，写入中的 array 仍可追加)
+                blocks = [column[start:stop].tobytes() for column, _, _ in checks]
+                if not all(pattern in data for data, (_, _, pattern) in zip(blocks, checks)):
+                    continue
+                first, rest = checks[0], checks[1:]
+                rows = (start + i for i in _matching_rows(blocks[0], first[2], len(first[2])))
+            else:
+                rest = ()
+                rows = range(start, stop)
+            for row in rows:
+                if rest and not all(column[row] == value for column, value, _ in rest):
+                    continue
+                if (low is not None or high is not None) and ts[row] == missing:
+                    continue
+                if (low is not None and ts[row] < low) or (high is not None and ts[row] > high):
+                    continue
+                yield self.event(row)
+
+    def event(self, row: int) -> dict:
+        event = {"testid": self.testid}
+        for name, _, missing in _numeric_columns:
+            value = self.columns[name][row]
+            if value == missing:
+                continue
+            if name == "ts":
+                event[name] = _format_ts(value)
+            elif name == "duration":
+                event[name] = _format_duration(value)
+            elif name == "msg":
+                event[name] = msg_kinds[value]
+            else:
+                event[name] = value
+        for name in _string_columns:
+            value = self.columns[name][row]
+            if value != 0:
+                event[name] = self.strings[value]
+        return event
+
+
+class _Buffer(object):
+    """正在写入的段，写满后封闭到磁盘"""
+
+    def __init__(self):
+        self.columns = {name: array(code) for name, code, _ in _numeric_columns}
+        self.columns.update({name: array("I") for name in _string_columns})
+        self.strings: list = [None]
+        self.ids: dict[str, int] = {}
+        self.rows = 0
+
+    def add(self, event: dict):
+        for name, _, missing in _numeric_columns:
+            value = event.get(name)
+            if value is None:
+                value = missing
+            elif name == "ts":
+                value = _parse_ts(value)
+            elif name == "duration":
+                value = _parse_duration_us(value)
+            elif name == "msg":
+                value = msg_kinds.index(value) if value in msg_kinds else missing
+            self.columns[name].append(value)
+        for name in _string_columns:
+            value = event.get(name)
+            if value is None:
+                self.columns[name].append(0)
+                continue
+            value = str(value)
+            i = self.ids.get(value)
+            if i is None:
+                i = self.ids[value] = len(self.strings)
+                self.strings.append(value)
+            self.columns[name].append(i)
+        self.rows += 1
+
+    def snapshot(self, testid: str) -> _Segment:
+        """当前已写入行的视图，之后追加的行不可见"""
+        return _Segment(testid, self.rows, dict(self.columns), self.strings, ids=self.ids)
+
+    def seal(self, path: str):
+        """写入段目录，字符串表最后写入，作为段完整的标志"""
+        tmp = path + ".tmp"
+        os.makedirs(tmp, exist_ok=True)
+        for name, column in self.columns.items():
+            with open(os.path.join(tmp, name + ".col"), 'wb') as fp:
+                column.tofile(fp)
+        index = array("q")
+        ts = self.columns["ts"]
+        missing = _numeric_columns[0][2]
+        for start in range(0, self.rows, block_rows):
+            values = [v for v in ts[start:start + block_rows] if v != missing]
+            # 没有 ts 的块不会匹配任何 ts 范围
+            index.extend((min(values), max(values)) if values else (2 ** 63 - 1, missing))
+        with open(os.path.join(tmp, "index.col"), 'wb') as fp:
+            index.tofile(fp)
+        with open(os.path.join(tmp, "strings.json"), 'w') as fp:
+            json.dump(self.strings[1:], fp)
+        os.replace(tmp, path)
+
+
+class SegmentStore(EventSource):
+    """按测试分段、按列存储在磁盘上的代理日志事件 Append-only on-disk columnar event store
+
+    每个测试一个目录，事件按写入顺序分成段，每段每列一个定长数组文件(ts, duration, status, msg 等数值列，
+    source, dest, reqID 等字符串列保存段内字符串表的序号)，另有每 block_rows 行的 ts 范围稀疏索引。
+    查询时通过 mmap 顺序读取，段中没有查询要求的字符串时跳过整段，ts 范围不相交的数据块也被跳过，
+    查询结果边扫描边组装，只保留返回的一页(排序时为 from+size 的堆)，聚合在扫描中计算，
+    内存占用与事件总数无关，适合长时间的稳定性测试。
+
+    只保存 _numeric_columns 和 _string_columns 中的字段，其它字段(如 rule, level)不保存，
+    因此按 level 查询的 no_proxy_errors 在这个后端上总是通过。
+    """
+
+    def __init__(self, directory: str, segment_rows: int = 1 << 20):
+        """
+        Args:
+            directory: 存储目录，不存在时创建
+            segment_rows: 每段的最大行数，也是写入缓冲的最大行数
+        """
+        assert segment_rows > 0
+        self.directory = directory
+        self.segment_rows = segment_rows
+        self._buffers: dict[str, _Buffer] = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def cache_key(self) -> str:
+        return os.path.abspath(self.directory)
+
+    @staticmethod
+    def _test_dir(testid: str) -> str:
+        if _test_dir_re.match(testid):
+            return testid
+        return "x" + hashlib.sha1(testid.encode()).hexdigest()
+
+    def _test_path(self, testid: str) -> str:
+        return os.path.join(self.directory, self._test_dir(testid))
+
+    def add(self, event: dict):
+        """追加一个事件"""
+        testid = str(event.get("testid", ""))
+        with self._lock:
+            buffer = self._buffers.get(testid)
+            if buffer is None:
+                buffer = self._buffers[testid] = _Buffer()
+            buffer.add(event)
+            if buffer.rows >= self.segment_rows:
+                self._seal(testid)
+
+    def _seal(self, testid: str):
+        buffer = self._buffers.pop(testid, None)
+        if buffer is None or buffer.rows == 0:
+            return
+        path = self._test_path(testid)
+        if not os.path.exists(path):
+            os.makedirs(path)
+            with open(os.path.join(path, "test.json"), 'w') as fp:
+                json.dump({"testid": testid}, fp)
+        seq = len([name for name in os.listdir(path) if name.endswith(".seg")])
+        buffer.seal(os.path.join(path, "{:08d}.seg".format(seq)))
+
+    def flush(self):
+        """把所有缓冲的事件封闭为段"""
+        with self._lock:
+            for testid in list(self._buffers):
+                self._seal(testid)
+
+    def close(self):
+        self.flush()
+
+    def tests(self) -> list[str]:
+        """存储中的测试ID"""
+        testids = set()
+        for name in os.listdir(self.directory):
+            meta = os.path.join(self.directory, name, "test.json")
+            if os.path.exists(meta):
+                with open(meta) as fp:
+                    testids.add(json.load(fp)["testid"])
+        with self._lock:
+            testids.update(self._buffers)
+        return sorted(testids)
+
+    def _segments(self, testid: str):
+        """按写入顺序返回测试的所有段，最后是尚未封闭的缓冲"""
+        path = self._test_path(testid)
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if not name.endswith(".seg"):
+                    continue
+                segment = _Segment.open(testid, os.path.join(path, name))
+                try:
+                    yield segment
+                finally:
+                    segment.close()
+        with self._lock:
+            buffer = self._buffers.get(testid)
+            segment = buffer.snapshot(testid) if buffer is not None else None
+        if segment is not None:
+            yield segment
+
+    def _scan(self, query: dict):
+        terms = {}
+        for name, value in _required_terms(query):
+            if name in terms and terms[name] != value:
+                return
+            terms[name] = value
+        low, high = _ts_bounds(query)
+        testid = terms.pop("testid", None)
+        for test in ([testid] if testid is not None else self.tests()):
+            for segment in self._segments(test):
+                for event in segment.scan(terms, low, high):
+                    if _match(query, event):
+                        yield event
+
+    def search(self, body: dict, index: str = None, stats: QueryStats = None) -> dict:
+        start = time.time()
+        query = body.get("query", {"match_all": {}})
+        return _respond(body, ({"_source": event} for event in self._scan(query)), start)
+
+    def count(self, body: dict, index: str = None) -> int:
+        return sum(1 for _ in self._scan(body.get("query", {"match_all": {}})))
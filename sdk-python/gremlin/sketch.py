@@ -0,0 +1,109 @@
+# coding=utf-8
+
+import math
+
+
+class QuantileSketch(object):
+    """可合并的流式分位数估计 Mergeable streaming quantile sketch
+
+    按对数分桶计数(DDSketch)，估计的分位数相对误差不超过 relative_accuracy。
+    桶数超过 max_buckets 时合并最小的桶，内存与样本数量无关。
+    """
+
+    def __init__(self, relative_accuracy: float = 0.01, max_buckets: int = 2048):
+        """
+        Args:
+            relative_accuracy: 相对误差上限 0.0 ~ 1.0
+            max_buckets: 最多保留的桶数
+        """
+        assert 0.0 < relative_accuracy < 1.0 and max_buckets > 0
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self._buckets: dict[int, int] = {}
+        self._zeros = 0  # 不大于0的样本
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value: float, count: int = 1):
+        """加入样本"""
+        if value > 0:
+            index = math.ceil(math.log(value) / self._log_gamma)
+            self._buckets[index] = self._buckets.get(index, 0) + count
+            if len(self._buckets) > self.max_buckets:
+                self._collapse()
+        else:
+            self._zeros += count
+        self.count += count
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other: 'QuantileSketch'):
+        """合并另一个相同精度的估计"""
+        assert self._gamma == other._gamma
+        for index, count in other._buckets.items():
+            self._buckets[index] = self._buckets.get(index, 0) + count
+        if len(self._buckets) > self.max_buckets:
+            self._collapse()
+        self._zeros += other._zeros
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def bounds(self, low: float, high: float) -> list[float]:
+        """覆盖 [low, high] 的桶边界，相邻两个边界之间正好是一个桶
+
+        用作 ElasticSearch range 聚合的边界时，各处返回的桶计数可以用 add_range 合并到一个估计中，
+        结果的大小只取决于范围和精度，与样本数量无关。
+        """
+        assert 0 < low < high
+        first = math.floor(math.log(low) / self._log_gamma)
+        last = math.ceil(math.log(high) / self._log_gamma)
+        return [self._gamma ** index for index in range(first, last + 1)]
+
+    def add_range(self, low: float or None, high: float or None, count: int):
+        """加入落在 bounds 中相邻两个边界 [low, high) 之间的 count 个样本
+
+        low 为 None 时是最小边界以下的样本，high 为 None 时是最大边界以上的样本，按相邻的桶计算。
+        """
+        if count == 0:
+            return
+        if low is None:
+            value = high / math.sqrt(self._gamma)
+        elif high is None:
+            value = low * math.sqrt(self._gamma)
+        else:
+            value = math.sqrt(low * high)
+        self.add(value, count)
+
+    def _collapse(self):
+        """把最小的桶合并到一起，保证桶数不超过上限"""
+        indexes = sorted(self._buckets)
+        merged = sum(self._buckets.pop(index) for index in indexes[:len(indexes) - self.max_buckets + 1])
+        target = indexes[len(indexes) - self.max_buckets]
+        self._buckets[target] = self._buckets.get(target, 0) + merged
+
+    def quantile(self, q: float) -> float or None:
+        """估计分位数
+
+        Args:
+            q: 0.0 ~ 1.0
+
+        Returns:
+            估计值，没有样本时为 None
+        """
+        assert 0.0 <= q <= 1.0
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = self._zeros
+        if rank < seen:
+            return min(self.min, 0.0)
+        for index in sorted(self._buckets):
+            seen += self._buckets[index]
+            if rank < seen:
+                value = 2 * self._gamma ** index / (self._gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
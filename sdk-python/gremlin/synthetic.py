@@ -0,0 +1,174 @@
+# coding=utf-8
+
+import datetime
+import heapq
+import itertools
+import json
+import math
+import random
+
+from .assertionchecker import _parse_duration, ts_format
+
+
+class SyntheticLog(object):
+    """生成模拟的代理日志事件 Realistic synthetic proxy event streams for benchmarks
+
+    模拟 gateway -> productpage -> reviews 的调用链，按泊松过程到达的用户请求带不同的 reqID:
+    productpage 调用 reviews 失败(代理中止)后按 retry_wait (带抖动) 重试，最多 retries 次；
+    productpage 的每个实例有一个断路器，失败超过 closed_attempts 次断开，reset_time 后半断开，
+    成功超过 halfopen_attempts 次重新闭合。每隔 outage_every 有一段 outage_duration 的 reviews 故障，
+    用于产生断路器断开和恢复的序列。延迟服从对数正态分布。
+
+    事件按时间顺序生成，格式与代理经 Logstash 写入的事件相同。
+    """
+
+    def __init__(self, test_id: str = "bench", seed: int = 0, start: datetime.datetime = None,
+                 rps: float = 100.0, hosts: int = 2, headerprefix: str = "testUser-bench-",
+                 latency_median: str = "20ms", latency_sigma: float = 0.6,
+                 failure_rate: float = 0.01, retries: int = 2, retry_wait: str = "100ms", retry_jitter: float = 0.1,
+                 closed_attempts: int = 3, reset_time: str = "1s", halfopen_attempts: int = 1,
+                 outage_every: str = "60s", outage_duration: str = "5s"):
+        """
+        Args:
+            test_id: 事件的测试ID
+            seed: 随机数种子，相同参数和种子生成相同的事件
+            start: 第一个事件的时间，缺省为 2022-01-01
+            rps: 每秒用户请求数
+            hosts: productpage 实例数，事件的 host 字段区分实例
+            headerprefix: reqID 前缀
+            latency_median: 单次调用延迟的中位数
+            latency_sigma: 延迟对数的标准差
+            failure_rate: 正常时 reviews 调用失败的概率
+            retries: 最多重试次数
+            retry_wait: 重试间隔
+            retry_jitter: 重试间隔的相对抖动
+            closed_attempts: 断路器闭合时允许的失败次数
+            reset_time: 断路器断开的时间
+            halfopen_attempts: 半断开时重新闭合需要的成功次数
+            outage_every: reviews 故障的间隔
+            outage_duration: 每次 reviews 故障持续的时间
+        """
+        assert rps > 0 and hosts > 0 and retries >= 0 and 0.0 <= failure_rate <= 1.0
+        self.test_id = test_id
+        self.seed = seed
+        self.start = start or datetime.datetime(2022, 1, 1)
+        self.rps = rps
+        self.hosts = ["10.0.0.%d" % (i + 1) for i in range(hosts)]
+        self.headerprefix = headerprefix
+        self.latency_median = _parse_duration(latency_median).total_seconds()
+        self.latency_sigma = latency_sigma
+        self.failure_rate = failure_rate
+        self.retries = retries
+        self.retry_wait = _parse_duration(retry_wait).total_seconds()
+        self.retry_jitter = retry_jitter
+        self.closed_attempts = closed_attempts
+        self.reset_time = _parse_duration(reset_time).total_seconds()
+        self.halfopen_attempts = halfopen_attempts
+        self.outage_every = _parse_duration(outage_every).total_seconds()
+        self.outage_duration = _parse_duration(outage_duration).total_seconds()
+
+    def _event(self, t: float, msg: str, source: str, dest: str, req_id: str, host: str, **fields) -> dict:
+        event = {
+            "msg": msg,
+            "level": "info",
+            "source": source,
+            "dest": dest,
+            "protocol": "http",
+            "trackingheader": "X-Gremlin-ID",
+            "reqID": req_id,
+            "testid": self.test_id,
+            "actions": "[]",
+            "delaytime": 0,
+            "errorcode": -2,
+            "uri": "/" + dest,
+            "ts": (self.start + datetime.timedelta(seconds=t)).strftime(ts_format),
+            "host": host,
+        }
+        event.update(fields)
+        return event
+
+    @staticmethod
+    def _duration(seconds: float) -> str:
+        return "{:.6f}".format(seconds * 1000).rstrip('0').rstrip('.') + "ms"
+
+    def events(self, count: int):
+        """按时间顺序生成 count 个事件"""
+        return itertools.islice(self._generate(), count)
+
+    def _generate(self):
+        rng = random.Random(self.seed)
+        latency_mu = math.log(self.latency_median)
+        # 每个实例的断路器 [状态, 失败次数, 断开时间, 成功次数]
+        breakers = {host: ["closed", 0, 0.0, 0] for host in self.hosts}
+        queue = []  # (时间, 序号, 动作, 参数)
+        seq = 0
+
+        def push(t, action, *args):
+            nonlocal seq
+            seq += 1
+            heapq.heappush(queue, (t, seq, action, args))
+
+        def latency():
+            return rng.lognormvariate(latency_mu, self.latency_sigma)
+
+        push(0.0, "arrive", 0)
+        while True:
+            t, _, action, args = heapq.heappop(queue)
+            if action == "arrive":
+                i, = args
+                push(t + rng.expovariate(self.rps), "arrive", i + 1)
+                req_id = self.headerprefix + str(i)
+                host = self.hosts[i % len(self.hosts)]
+                yield self._event(t, "Request", "gateway", "productpage", req_id, "10.0.0.0")
+                push(t + latency() / 4, "call", req_id, host, t, 0)
+            elif action == "call":
+                # productpage 调用 reviews，第 attempt 次尝试
+                req_id, host, arrived, attempt = args
+                breaker = breakers[host]
+                if breaker[0] == "open":
+                    if t - breaker[2] < self.reset_time * 1.05:
+                        # 断开时不调用 reviews，直接返回缺省值
+                        push(t + latency() / 4, "reply", req_id, arrived)
+                        continue
+                    breaker[0], breaker[3] = "half-open", 0
+                in_outage = self.outage_every > 0 and t % self.outage_every < self.outage_duration
+                if rng.random() < (1.0 if in_outage else self.failure_rate):
+                    yield self._event(t, "Request", "productpage", "reviews", req_id, host,
+                                      actions="[abort]", errorcode=503)
+                    breaker[1] += 1
+                    if breaker[0] == "half-open" or (breaker[0] == "closed" and breaker[1] > self.closed_attempts):
+                        breaker[0], breaker[1], breaker[2] = "open", 0, t
+                    if attempt < self.retries and breaker[0] != "open":
+                        wait = self.retry_wait * (1 + rng.uniform(-self.retry_jitter, self.retry_jitter))
+                        push(t + wait, "call", req_id, host, arrived, attempt + 1)
+                    else:
+                        push(t + latency() / 4, "reply", req_id, arrived)
+                    continue
+                d = latency()
+                yield self._event(t, "Request", "productpage", "reviews", req_id, host)
+                push(t + d, "emit", self._event(t + d, "Response", "productpage", "reviews", req_id, host,
+                                                status=200, duration=self._duration(d)), host)
+                push(t + d + latency() / 4, "reply", req_id, arrived)
+            elif action == "emit":
+                event, host = args
+                yield event
+                # 与检查一致，半断开时按收到的成功回复计数，包括断开前发出的请求的回复
+                breaker = breakers[host]
+                if breaker[0] == "half-open":
+                    breaker[3] += 1
+                    if breaker[3] > self.halfopen_attempts:
+                        breaker[0], breaker[1] = "closed", 0
+            elif action == "reply":
+                req_id, arrived = args
+                yield self._event(t, "Response", "gateway", "productpage", req_id, "10.0.0.0",
+                                  status=200, duration=self._duration(t - arrived))
+
+    def write_ndjson(self, path: str, count: int) -> int:
+        """把 count 个事件写入 NDJSON 文件，返回写入的事件数"""
+        written = 0
+        with open(path, 'w') as fp:
+            for event in self.events(count):
+                fp.write(json.dumps(event))
+                fp.write('\n')
+                written += 1
+        return written
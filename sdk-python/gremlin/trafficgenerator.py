@@ -0,0 +1,170 @@
+# coding=utf-8
+
+import asyncio
+import re
+import ssl
+import time
+from collections import Counter, namedtuple
+from urllib.parse import urlsplit
+
+from .assertionchecker import _parse_duration
+from .sketch import QuantileSketch
+from .transport import ProxyConnection
+
+TrafficReport = namedtuple('TrafficReport', ['sent', 'completed', 'errors', 'dropped', 'statuses', 'duration',
+                                             'latency'])
+
+_regex_meta = set('.^$*+?{}[]\\|()')
+_idempotent_methods = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+
+
+def header_prefix(headerpattern: str) -> str:
+    """从故障规则的 headerpattern 取出字面前缀，如 testUser-timeout-* -> testUser-timeout-
+
+    前缀后加上序号得到的请求头值能被 headerpattern 匹配时才返回，否则抛出 ValueError。
+    """
+    prefix = []
+    for c in headerpattern.lstrip('^'):
+        if c in _regex_meta:
+            break
+        prefix.append(c)
+    prefix = ''.join(prefix)
+    if not re.search(headerpattern, prefix + '0'):
+        raise ValueError("Cannot derive a literal prefix from headerpattern {}".format(headerpattern))
+    return prefix
+
+
+class TrafficGenerator(object):
+    """开环流量生成器 Open-loop traffic driver for recipes
+
+    按目标速率发出带 X-Gremlin-ID 请求头的 HTTP 请求，请求头值为 前缀+序号，匹配故障规则的 headerpattern。
+    请求按计划时间发出，不等待之前的请求完成；延迟从计划发出时间开始计算。
+    请求复用空闲的 keep-alive 连接，没有空闲连接时才新建，连接数不超过同时进行的请求数。
+    """
+
+    def __init__(self, url: str, rps: float, header_prefix: str, header: str = "X-Gremlin-ID",
+                 method: str = "GET", body: bytes = b"", timeout: float = 10.0, max_inflight: int = 1000,
+                 debug: bool = False):
+        """
+        Args:
+            url: 请求地址，如 http://localhost:9080/
+            rps: 每秒请求数
+            header_prefix: 请求头值的前缀，可以用 header_prefix(headerpattern) 从故障规则得到
+            header: 故障注入代理跟踪的请求头
+            method: HTTP 方法
+            body: 请求体
+            timeout: 单个请求超时时间(秒)
+            max_inflight: 同时进行的请求数上限，超过时丢弃新请求并计数
+        """
+        assert rps > 0 and max_inflight > 0
+        self.url = urlsplit(url)
+        assert self.url.scheme in ('http', 'https')
+        self.instance = "{}:{}".format(self.url.hostname, self.url.port or (443 if self.url.scheme == 'https' else 80))
+        self.rps = rps
+        self.header_prefix = header_prefix
+        self.header = header
+        self.method = method
+        self.body = body
+        self.timeout = timeout
+        self.max_inflight = max_inflight
+        self.debug = debug
+
+    def run(self, duration: float = None, count: int = None) -> TrafficReport:
+        """发送流量直到经过 duration 秒或发出 count 个请求
+
+        Args:
+            duration: 持续时间(秒)
+            count: 请求数
+        """
+        return asyncio.run(self.run_async(duration, count))
+
+    async def run_async(self, duration: float = None, count: int = None) -> TrafficReport:
+        assert duration is not None or count is not None
+        if count is None:
+            count = int(duration * self.rps)
+        latency = QuantileSketch()
+        statuses = Counter()
+        errors = 0
+        dropped = 0
+        inflight = set()
+        idle: list[ProxyConnection] = []  # 空闲的 keep-alive 连接
+        ssl_context = ssl.create_default_context() if self.url.scheme == 'https' else None
+
+        async def send(i: int, scheduled: float):
+            nonlocal errors
+            conn = idle.pop() if idle else ProxyConnection(self.instance, self.timeout, ssl_context)
+            try:
+                status = await asyncio.wait_for(self._request(conn, self.header_prefix + str(i)), self.timeout)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                    ValueError) as e:
+                errors += 1
+                if self.debug:
+                    print("request %d failed: %r" % (i, e))
+                return
+            finally:
+                # 失败时连接已关闭，下次使用时重新连接
+                idle.append(conn)
+            statuses[status] += 1
+            latency.add((time.perf_counter() - scheduled) * 1000)
+
+        start = time.perf_counter()
+        try:
+            for i in range(count):
+                scheduled = start + i / self.rps
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if len(inflight) >= self.max_inflight:
+                    dropped += 1
+                    continue
+                task = asyncio.ensure_future(send(i, scheduled))
+                inflight.add(task)
+                task.add_done_callback(inflight.discard)
+            if inflight:
+                await asyncio.wait(inflight)
+        finally:
+            for conn in idle:
+                conn.close()
+
+        return TrafficReport(count - dropped, latency.count, errors, dropped, dict(statuses),
+                             time.perf_counter() - start, latency)
+
+    async def _request(self, conn: ProxyConnection, header_value: str) -> int:
+        """在连接 conn 上发出一个请求并读完回复，返回 HTTP 状态码"""
+        path = self.url.path or '/'
+        if self.url.query:
+            path += '?' + self.url.query
+        request = conn.encode(self.method, path, self.body, headers={self.header: header_value})
+        # 只有幂等的请求在复用的连接被服务端关闭时重发 Only resend idempotent requests
+        (status, _), = await conn.pipeline(request, 1, idempotent=self.method in _idempotent_methods,
+                                           head_request=self.method == 'HEAD')
+        return status
+
+
+def run_traffic(traffic: dict, gremlins: dict = None, debug: bool = False) -> TrafficReport:
+    """按配置发送测试流量
+
+    Args:
+        traffic: 流量配置
+            {
+                "url": "http://localhost:9080/",
+                "rps": 5,
+                "duration": "10s",  或 "count": 50
+                "headerprefix": "testUser-timeout-"  可选，缺省从第一个故障的 headerpattern 得到
+            }
+        gremlins: 故障配置，用于得到请求头前缀
+    """
+    assert 'url' in traffic and 'rps' in traffic and ('duration' in traffic or 'count' in traffic)
+    prefix = traffic.get('headerprefix')
+    if prefix is None:
+        assert gremlins is not None and len(gremlins['gremlins']) != 0
+        prefix = header_prefix(gremlins['gremlins'][0]['headerpattern'])
+    generator = TrafficGenerator(traffic['url'], float(traffic['rps']), prefix,
+                                 header=traffic.get('header', "X-Gremlin-ID"),
+                                 method=traffic.get('method', "GET"),
+                                 timeout=float(traffic.get('timeout', 10.0)),
+                                 debug=debug)
+    duration = traffic.get('duration')
+    if isinstance(duration, str):
+        duration = _parse_duration(duration).total_seconds()
+    return generator.run(duration, traffic.get('count'))
@@ -0,0 +1,277 @@
+# coding=utf-8
+
+import asyncio
+import gzip
+import json
+import ssl
+import threading
+import time
+import zlib
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .profiling import QueryStats
+
+
+def _decompress(raw: bytes, encoding: str) -> bytes:
+    """按 Content-Encoding 解压回复体"""
+    encoding = encoding.strip().lower()
+    if encoding == "gzip":
+        return gzip.decompress(raw)
+    if encoding == "deflate":
+        try:
+            return zlib.decompress(raw)
+        except zlib.error:
+            # 有的服务端发送不带 zlib 头的 deflate 数据
+            return zlib.decompress(raw, -zlib.MAX_WBITS)
+    return raw
+
+
+class ElasticsearchTransport(object):
+    """到一个 ElasticSearch 集群的 keep-alive HTTP 连接池
+    Pooled keep-alive HTTP connections to the nodes of one ElasticSearch cluster
+
+    与 elasticsearch 客户端一样，host 可以是一个节点或同一集群的节点列表，请求轮流发给各节点，
+    连接失败或节点返回 502/503/504 时标记该节点暂时不可用并换一个节点重试，最多重试 max_retries 次。
+    不支持嗅探(sniffing)集群中的其他节点。
+    回复压缩通过 Accept-Encoding 协商(服务端需开启 http.compression)，
+    请求体压缩需服务端支持，缺省关闭。
+    """
+
+    def __init__(self, host: str or list[str], pool_maxsize: int = 10, compress_requests: bool = False,
+                 timeout: float = 60.0, max_retries: int = 3, dead_timeout: float = 60.0):
+        """
+        Args:
+            host: ElasticSearch 地址，如 http://localhost:9200/，或同一集群的节点地址列表
+            pool_maxsize: 每个节点的连接池中保持的最大连接数
+            compress_requests: 是否用 gzip 压缩请求体
+            timeout: 请求超时时间(秒)
+            max_retries: 换节点重试的次数
+            dead_timeout: 失败的节点暂停使用的时间(秒)
+        """
+        self.hosts: list[str] = [host] if isinstance(host, str) else list(host)
+        assert len(self.hosts) > 0, "ElasticsearchTransport needs at least one host"
+        self.urls = [(h if '://' in h else 'http://' + h).rstrip('/') for h in self.hosts]
+        self.options = {"pool_maxsize": pool_maxsize, "compress_requests": compress_requests, "timeout": timeout,
+                        "max_retries": max_retries, "dead_timeout": dead_timeout}
+        self.compress_requests = compress_requests
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.dead_timeout = dead_timeout
+        self._next = 0
+        self._dead: dict[str, float] = {}  # 节点 -> 恢复使用的时间
+        self._lock = threading.Lock()
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=len(self.urls), pool_maxsize=pool_maxsize)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self._session.headers.update({"Accept-Encoding": "gzip, deflate"})
+
+    def _node(self) -> str:
+        """轮流选择一个可用的节点，都不可用时选择最早恢复的节点"""
+        with self._lock:
+            now = time.monotonic()
+            for _ in range(len(self.urls)):
+                url = self.urls[self._next % len(self.urls)]
+                self._next += 1
+                if self._dead.get(url, 0.0) <= now:
+                    self._dead.pop(url, None)
+                    return url
+            return min(self.urls, key=lambda u: self._dead[u])
+
+    def _mark_dead(self, url: str):
+        with self._lock:
+            self._dead[url] = time.monotonic() + self.dead_timeout
+
+    def request(self, method: str, path: str, body: bytes or None = None,
+                params: dict = None, content_type: str = "application/json", stats: QueryStats = None) -> dict:
+        """发送请求并解析 JSON 回复，连接失败时换节点重试
+
+        Args:
+            stats: 可选 累计传输字节数和解析耗时
+
+        Raises:
+            requests.exceptions.HTTPError: ElasticSearch 返回错误
+            requests.exceptions.ConnectionError: 重试后仍然无法连接
+        """
+        headers = {"Content-Type": content_type}
+        if body is not None and self.compress_requests:
+            body = gzip.compress(body)
+            headers["Content-Encoding"] = "gzip"
+        for attempt in range(self.max_retries + 1):
+            url = self._node()
+            try:
+                resp = self._session.request(method, url + path, data=body, params=params,
+                                             headers=headers, timeout=self.timeout, stream=True)
+            except requests.exceptions.ConnectionError:
+                self._mark_dead(url)
+                if attempt == self.max_retries:
+                    raise
+                continue
+            if resp.status_code in (502, 503, 504) and attempt < self.max_retries:
+                resp.close()
+                self._mark_dead(url)
+                continue
+            break
+        try:
+            resp.raise_for_status()
+            # 自己解压，才能知道线上传输的字节数(分块传输且没有 Content-Length 时也一样)
+            raw = resp.raw.read(decode_content=False)
+        except BaseException:
+            resp.close()
+            raise
+        resp.raw.release_conn()
+        start = time.perf_counter()
+        data = json.loads(_decompress(raw, resp.headers.get("Content-Encoding", "")))
+        if stats is not None:
+            stats.decode += time.perf_counter() - start
+            stats.transfer_bytes += len(raw)
+        return data
+
+    def close(self):
+        self._session.close()
+
+
+_transports: dict[tuple[str, ...], ElasticsearchTransport] = {}
+_transports_lock = threading.Lock()
+
+
+def get_transport(host: str or list[str], **options) -> ElasticsearchTransport:
+    """取得进程内共享的到 host 的连接，不存在时用 options 创建
+    Borrow the process wide transport for *host*, so back-to-back checkers reuse warm connections
+
+    Args:
+        host: ElasticSearch 地址或同一集群的节点地址列表
+        options: 传给 ElasticsearchTransport 的参数
+
+    Raises:
+        ValueError: 已经存在的连接使用了不同的参数，需要先 close_transports()
+    """
+    key = (host,) if isinstance(host, str) else tuple(host)
+    with _transports_lock:
+        transport = _transports.get(key)
+        if transport is None:
+            transport = _transports[key] = ElasticsearchTransport(host, **options)
+            return transport
+        conflicts = {name: value for name, value in options.items() if transport.options.get(name) != value}
+        if conflicts:
+            raise ValueError("transport for {} already exists with {}, requested {}; call close_transports() first"
+                             .format(host, {name: transport.options.get(name) for name in conflicts}, conflicts))
+        return transport
+
+
+def close_transports():
+    """关闭所有共享连接"""
+    with _transports_lock:
+        for transport in _transports.values():
+            transport.close()
+        _transports.clear()
+
+
+class ProxyConnection(object):
+    """到一个代理控制接口的 asyncio keep-alive 连接
+    Pipelined HTTP/1.1 connection to one proxy's REST interface
+
+    请求预先编码为字节，一组请求一次写出(流水线)，再依次读取回复，
+    同时向几百个代理发送时每个代理只需要一次写操作。TrafficGenerator 也用它向被测服务发送流量。
+    """
+
+    def __init__(self, instance: str, timeout: float = 10.0, ssl_context: ssl.SSLContext = None):
+        """
+        Args:
+            instance: 代理地址 host:port
+            timeout: 一组请求的超时时间(秒)
+            ssl_context: 可选 使用 https 时的 SSL 上下文
+        """
+        self.instance = instance
+        self.host, _, port = instance.rpartition(':')
+        self.port = int(port)
+        self.timeout = timeout
+        self.ssl_context = ssl_context
+        self._reader: asyncio.StreamReader or None = None
+        self._writer: asyncio.StreamWriter or None = None
+
+    def encode(self, method: str, path: str, body: bytes = b"", content_type: str = "application/json",
+               headers: dict[str, str] = None) -> bytes:
+        """编码一个请求，headers 为额外的请求头"""
+        head = "{} {} HTTP/1.1\r\nHost: {}\r\nContent-Length: {}\r\n".format(method, path, self.instance, len(body))
+        if body:
+            head += "Content-Type: {}\r\n".format(content_type)
+        for name, value in (headers or {}).items():
+            head += "{}: {}\r\n".format(name, value)
+        return (head + "\r\n").encode() + body
+
+    async def connect(self):
+        """建立连接，已连接时不做任何事"""
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port, ssl=self.ssl_context), self.timeout)
+
+    async def _response(self, head_request: bool = False) -> tuple[int, bytes]:
+        head = await self._reader.readuntil(b"\r\n\r\n")
+        lines = head.decode("latin-1").split("\r\n")
+        parts = lines[0].split(" ", 2)
+        if len(parts) < 2 or not parts[1].isdigit():
+            raise ValueError("Bad status line {!r}".format(lines[0]))
+        status = int(parts[1])
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if head_request or status < 200 or status in (204, 304):
+            # 这些回复没有回复体 No body, whatever the headers say
+            body = b""
+        elif headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await self._reader.readuntil(b"\r\n")).split(b";")[0], 16)
+                if size == 0:
+                    # 跳过 trailer 直到空行
+                    while await self._reader.readuntil(b"\r\n") != b"\r\n":
+                        pass
+                    break
+                chunks.append((await self._reader.readexactly(size + 2))[:-2])
+            body = b"".join(chunks)
+        elif "content-length" in headers:
+            body = await self._reader.readexactly(int(headers["content-length"]))
+        else:
+            body = await self._reader.read()
+            self.close()
+        if headers.get("connection", "").lower() == "close":
+            self.close()
+        return status, body
+
+    async def _exchange(self, payload: bytes, count: int, head_request: bool) -> list[tuple[int, bytes]]:
+        await self.connect()
+        self._writer.write(payload)
+        await self._writer.drain()
+        return [await self._response(head_request) for _ in range(count)]
+
+    async def pipeline(self, payload: bytes, count: int, idempotent: bool = False,
+                       head_request: bool = False) -> list[tuple[int, bytes]]:
+        """写出 payload 中的 count 个请求，返回每个请求的 (状态码, 回复体)
+
+        写出前发现空闲连接已被代理关闭时先重新连接。写出后连接才断开时请求可能已经执行，
+        只有 idempotent(全部请求可以重复执行，如 GET PUT DELETE)时重新连接重发一次，否则抛出异常;
+        POST rules/add 重发会重复添加规则。head_request 表示请求都是 HEAD，回复没有回复体。
+        """
+        if self._writer is not None and (self._reader.at_eof() or self._writer.is_closing()):
+            self.close()
+        for attempt in range(2):
+            reused = self._writer is not None
+            try:
+                return await asyncio.wait_for(self._exchange(payload, count, head_request), self.timeout)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                self.close()
+                if attempt > 0 or not reused or not idempotent:
+                    raise
+            except BaseException:
+                # 回复没有读完，连接状态未知
+                self.close()
+                raise
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._reader, self._writer = None, None
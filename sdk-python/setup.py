@@ -14,6 +14,11 @@ setuptools.setup(
     packages=setuptools.find_packages(),
     include_package_data=True,
     platforms="any",
+    entry_points={
+        'console_scripts': [
+            'gremlin = gremlin.cli:main',
+        ],
+    },
     classifiers=[
         'Intended Audience :: Developers',
         'Operating System :: OS Independent',
@@ -26,8 +31,6 @@ setuptools.setup(
     install_requires=[
         'certifi==2022.6.15',
         'charset-normalizer==2.0.12',
-        'elastic-transport==8.1.2',
-        'elasticsearch==1.7.0',
         'idna==3.3',
         'isodate==0.6.1',
         'networkx==2.8.4',
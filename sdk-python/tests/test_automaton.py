@@ -0,0 +1,70 @@
+# coding=utf-8
+
+import datetime
+
+import pytest
+
+from gremlin.automaton import Automaton, run_automata
+from gremlin.events import decode_events
+
+# Automaton 文档中的断路器
+BREAKER = {
+    "name": "automaton",
+    "label": "circuit breaker",
+    "source": "productpage", "dest": "reviews", "headerprefix": "testUser-",
+    "key": ["source", "host"],
+    "initial": "closed",
+    "counters": ["failures"],
+    "transitions": [
+        {"from": "closed", "on": {"msg": "Response", "status": {"ne": 200}},
+         "if": {"failures": {"ge": 2}}, "to": "open", "reset": ["failures"]},
+        {"from": "closed", "on": {"msg": "Response", "status": {"ne": 200}}, "inc": ["failures"]},
+        {"from": "closed", "on": {"msg": "Response", "status": 200}, "reset": ["failures"]},
+        {"from": "open", "if": {"elapsed": {"ge": "1s"}}, "to": "closed", "continue": True},
+        {"from": "open", "on": {"msg": "Request"},
+         "fail": "{key}: request {reqID} sent {elapsed} after the breaker opened"}
+    ]
+}
+
+START = datetime.datetime(2026, 1, 1)
+
+
+def _events(steps: list[tuple]) -> list:
+    """(秒, msg, status) -> productpage 到 reviews 同一实例的事件"""
+    return decode_events([
+        {"ts": (START + datetime.timedelta(seconds=t)).strftime("%Y-%m-%dT%H:%M:%S.%f"), "msg": msg,
+         "source": "productpage", "dest": "reviews", "host": "10.0.0.1", "reqID": "testUser-%d" % i,
+         **({"status": status} if status is not None else {})}
+        for i, (t, msg, status) in enumerate(steps)])
+
+
+def _failures(*seconds) -> list[tuple]:
+    return [step for t in seconds for step in ((t, "Request", None), (t + 0.01, "Response", 503))]
+
+
+def test_breaker_opens_after_three_failures():
+    error, = run_automata([Automaton(BREAKER)], _events(_failures(0, 0.1, 0.2) + [(0.5, "Request", None)]))
+    assert error.startswith("productpage/10.0.0.1: request testUser-6 sent")
+
+
+def test_breaker_success_resets_failures():
+    steps = _failures(0, 0.1) + [(0.2, "Request", None), (0.21, "Response", 200)] + _failures(0.3) + \
+        [(0.5, "Request", None)]
+    assert run_automata([Automaton(BREAKER)], _events(steps)) == [""]
+
+
+def test_breaker_closes_after_reset_time():
+    steps = _failures(0, 0.1, 0.2) + [(1.3, "Request", None), (1.31, "Response", 200)]
+    assert run_automata([Automaton(BREAKER)], _events(steps)) == [""]
+
+
+def test_missing_field_does_not_match():
+    # 请求事件没有 status，不能算作失败回复
+    spec = {"initial": "ok", "transitions": [{"on": {"status": {"ne": 200}}, "fail": "failed {reqID}"},
+                                             {"on": {"status": {"not_in": [200]}}, "fail": "failed {reqID}"}]}
+    assert run_automata([Automaton(spec)], _events([(0, "Request", None), (0.1, "Response", 200)])) == [""]
+
+
+def test_unknown_field_rejected():
+    with pytest.raises(AssertionError, match="stauts"):
+        Automaton({"initial": "ok", "transitions": [{"on": {"stauts": {"ne": 200}}, "fail": "failed"}]})
@@ -0,0 +1,68 @@
+# coding=utf-8
+
+import pytest
+
+import gremlin.assertionchecker
+from gremlin import AssertionChecker, NDJSONSource, SyntheticLog
+
+EVENTS = 2000
+
+
+@pytest.fixture
+def synthetic(tmp_path):
+    log = SyntheticLog(test_id="checks", seed=3)
+    path = str(tmp_path / "proxy.ndjson")
+    log.write_ndjson(path, EVENTS)
+    return log, AssertionChecker(NDJSONSource(path), log.test_id)
+
+
+def _answered_req_id(log) -> str:
+    return next(event["reqID"] for event in log.events(EVENTS)
+                if event["msg"] == "Response" and event["dest"] == "reviews" and event["status"] == 200)
+
+
+def test_http_status_filters_on_logged_req_id(synthetic):
+    log, ac = synthetic
+    req_id = _answered_req_id(log)
+    result = ac.check_assertion(name="http_status", source="productpage", dest="reviews", status=200, req_id=req_id)
+    assert result.success and result.profile.hits == 1
+    result = ac.check_assertion(name="http_status", source="productpage", dest="reviews", status=503, req_id=req_id)
+    assert not result.success
+
+
+@pytest.fixture
+def rounds(synthetic, monkeypatch):
+    """分页的检查每页 100 个事件，记录每一轮 msearch 的查询数"""
+    log, ac = synthetic
+    monkeypatch.setattr(gremlin.assertionchecker, "page_size", 100)
+    batches = []
+    msearch = ac._msearch
+
+    def recording(bodies, stats=None):
+        batches.append(len(bodies))
+        return msearch(bodies, stats)
+
+    monkeypatch.setattr(ac, "_msearch", recording)
+    failing = {"name": "http_status", "source": "productpage", "dest": "reviews", "status": 503,
+               "req_id": _answered_req_id(log)}
+    paged = {"name": "bounded_percentile_latency", "source": "gateway", "dest": "productpage",
+             "max_latency": "60s"}
+    return ac, batches, failing, paged
+
+
+def test_check_assertions_stops_querying_after_failure(rounds):
+    ac, batches, failing, paged = rounds
+    results = ac.check_assertions({"checks": [failing, paged]})
+    assert [r.success for r in results] == [False]
+    assert batches == [2]
+    del batches[:]
+    results = ac.check_assertions({"checks": [failing, paged]}, all=True)
+    assert [r.success for r in results] == [False, True]
+    assert len(batches) > 1
+
+
+def test_check_assertions_finishes_checks_before_failure(rounds):
+    ac, batches, failing, paged = rounds
+    results = ac.check_assertions({"checks": [paged, failing, dict(paged, name="bounded_percentile_latency")]})
+    assert [r.success for r in results] == [True, False]
+    assert batches[:2] == [3, 1]
@@ -0,0 +1,39 @@
+# coding=utf-8
+
+import json
+
+import pytest
+
+import gremlin.cli
+from gremlin.cli import RecipeRunner
+
+TOPOLOGY = {"services": [{"name": "productpage"}, {"name": "reviews"}], "dependencies": {"productpage": ["reviews"]}}
+
+
+class _FailureGenerator(object):
+    """记录规则的注入和清除，不连接代理"""
+
+    def __init__(self):
+        self.active = False
+
+    def start_test(self, gremlins):
+        self.active = True
+        return "cli-test"
+
+    def get_test_start_time(self):
+        return None
+
+    def clear_rules_from_all_proxies(self):
+        self.active = False
+
+
+def test_rules_cleared_when_traffic_raises(monkeypatch):
+    def run_traffic(*args, **kwargs):
+        raise ConnectionRefusedError("gateway down")
+
+    monkeypatch.setattr(gremlin.cli, "run_traffic", run_traffic)
+    runner = RecipeRunner(log_server="127.0.0.1:9200")
+    fg = runner._generators[json.dumps(TOPOLOGY, sort_keys=True)] = _FailureGenerator()
+    with pytest.raises(ConnectionRefusedError):
+        runner._test({"gremlins": "recipe"}, {"traffic": {}}, {}, TOPOLOGY)
+    assert not fg.active
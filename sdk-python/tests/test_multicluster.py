@@ -0,0 +1,62 @@
+# coding=utf-8
+
+import json
+import random
+
+from gremlin import AssertionChecker, ElasticsearchSource, MultiClusterSource, NDJSONSource, close_transports
+
+
+def _write(path, events):
+    with open(path, "w") as fp:
+        for event in events:
+            fp.write(json.dumps(event) + "\n")
+    return str(path)
+
+
+def _percentile_body(percents):
+    return {"size": 0, "query": {"term": {"testid": "mc"}},
+            "aggs": {"latency": {"percentiles": {"field": "latency", "percents": percents}}}}
+
+
+def test_percentiles_merge_within_accuracy_and_bounded(tmp_path):
+    rng = random.Random(1)
+    events = [{"testid": "mc", "latency": rng.lognormvariate(3, 1)} for _ in range(20000)]
+    # 两个集群的延迟分布不同
+    for event in events[:5000]:
+        event["latency"] *= 10
+    us = _write(tmp_path / "us.ndjson", events[::2])
+    eu = _write(tmp_path / "eu.ndjson", events[1::2])
+    percents = [50, 90, 99]
+    source = MultiClusterSource([NDJSONSource(us), NDJSONSource(eu)])
+
+    cluster_body, _ = source._cluster_body(_percentile_body(percents))
+    buckets = NDJSONSource(us).search(cluster_body)["aggregations"]["latency"]["buckets"]
+    assert len(buckets) == len(source._percentile_ranges) < 1200
+    assert sum(bucket["doc_count"] for bucket in buckets) == 10000
+
+    merged = source.search(_percentile_body(percents))
+    exact = NDJSONSource(us, eu).search(_percentile_body(percents))
+    assert merged["hits"]["total"] == 20000
+    for key, value in exact["aggregations"]["latency"]["values"].items():
+        estimate = merged["aggregations"]["latency"]["values"][key]
+        assert abs(estimate - value) <= 0.02 * value, (key, estimate, value)
+
+
+def test_host_list_means_nodes_of_one_cluster():
+    close_transports()
+    ac = AssertionChecker(["127.0.0.1:9200", "127.0.0.1:9201"], "mc")
+    assert isinstance(ac._backend, ElasticsearchSource)
+    assert ac._backend._transport.hosts == ["127.0.0.1:9200", "127.0.0.1:9201"]
+    with AssertionChecker(None, "mc", clusters=["127.0.0.1:9200", ["127.0.0.1:9202", "127.0.0.1:9203"]]) as ac:
+        assert isinstance(ac._backend, MultiClusterSource) and len(ac._backend.sources) == 2
+    close_transports()
+
+
+def test_close_stops_fanout_threads(tmp_path):
+    us = _write(tmp_path / "us.ndjson", [{"testid": "mc", "latency": 1.0}])
+    eu = _write(tmp_path / "eu.ndjson", [{"testid": "mc", "latency": 2.0}])
+    with MultiClusterSource([NDJSONSource(us), NDJSONSource(eu)]) as source:
+        assert source.count({"query": {"term": {"testid": "mc"}}}) == 2
+        executor = source._executor
+        assert executor is not None
+    assert source._executor is None and executor._shutdown
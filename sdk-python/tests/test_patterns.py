@@ -0,0 +1,72 @@
+# coding=utf-8
+
+import re
+import warnings
+
+import pytest
+
+from gremlin import ApplicationGraph, FailureGenerator, PatternNotReplayable, ReplayEngine, TraceMessage, \
+    analyze_pattern, compile_pattern
+
+
+@pytest.fixture(autouse=True)
+def no_warnings():
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        yield
+
+
+def test_re2_end_of_text():
+    report = analyze_pattern(r"foo\z")
+    assert report.error is None and report.replayable
+    assert compile_pattern(r"foo\z").search("xfoo")
+    assert not compile_pattern(r"foo\z").search("foo\n")
+
+
+def test_re2_unicode_class_is_valid_but_not_replayable():
+    for pattern in (r"\pL", r"\p{Greek}+", r"[\PN]"):
+        report = analyze_pattern(pattern)
+        assert report.error is None and not report.replayable, pattern
+        with pytest.raises(PatternNotReplayable):
+            compile_pattern(pattern)
+
+
+def test_re2_posix_class():
+    report = analyze_pattern("[[:alpha:]]+-[[:digit:]]")
+    assert report.error is None and report.replayable
+    assert compile_pattern("^[[:alpha:]]+-[[:digit:]]$").match("testUser-7")
+    assert compile_pattern("^[^[:space:]]+$").match("testUser-7")
+
+
+def test_re2_inline_flags():
+    compiled = compile_pattern("a(?i)b|c")
+    assert compiled.fullmatch("aB") and compiled.fullmatch("C") and not compiled.fullmatch("AB")
+
+
+@pytest.mark.parametrize("pattern, error", [
+    (r"(a)\1", "backreferences"),
+    ("foo(?=bar)", "lookaround"),
+    (r"foo\Z", r"\Z is not supported"),
+    ("a++", "possessive"),
+    ("(?>a)", "atomic"),
+    ("*", "nothing to repeat"),
+])
+def test_re2_incompatible(pattern, error):
+    report = analyze_pattern(pattern)
+    assert report.error is not None and error in report.error
+    with pytest.raises(re.error):
+        compile_pattern(pattern)
+
+
+def test_rules_accept_re2_syntax():
+    app = ApplicationGraph({"services": [{"name": "productpage"}, {"name": "reviews"}],
+                            "dependencies": {"productpage": ["reviews"]}})
+    fg = FailureGenerator(app)
+    for pattern in (r"testUser-[[:digit:]]+\z", r"\pL+-.*"):
+        fg.setup_failure('abort_requests', source='productpage', dest='reviews', headerpattern=pattern,
+                         bodypattern='', abortprobability=1.0, errorcode=503)
+    report = ReplayEngine(fg.get_rules(), seed=1).replay(
+        [TraceMessage("productpage", "reviews", "request", "testUser-7", "")])
+    assert report.invalid == []
+    assert [i for i, _ in report.unreplayable] == [1]
+    assert report.rules[0].hits == 1
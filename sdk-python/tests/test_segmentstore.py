@@ -0,0 +1,56 @@
+# coding=utf-8
+
+from array import array
+
+import pytest
+
+from gremlin import EventStore, SegmentStore, SyntheticLog
+from gremlin.segmentstore import _matching_rows
+
+EVENTS = 12000
+
+
+@pytest.fixture
+def stores(tmp_path):
+    log = SyntheticLog(test_id="segments", seed=5, failure_rate=0.2)
+    segments = SegmentStore(str(tmp_path), segment_rows=5000)
+    store = EventStore()
+    for event in log.events(EVENTS):
+        segments.add(event)
+        store.add(event)
+    # 两个已封闭的段和一个写入中的缓冲
+    return log, segments, store
+
+
+def _query(*terms, ts=None) -> dict:
+    must = [{"term": {name: value}} for name, value in terms]
+    if ts is not None:
+        must.append({"range": {"ts": ts}})
+    return {"size": EVENTS, "query": {"filtered": {"filter": {"bool": {"must": must}}}}}
+
+
+def test_matching_rows_ignores_unaligned_bytes():
+    column = array("I", [0x00010000, 0, 0x100, 7, 0x100])
+    pattern = array("I", [0x100]).tobytes()
+    assert list(_matching_rows(column.tobytes(), pattern, 4)) == [2, 4]
+
+
+def test_scan_matches_event_store(stores):
+    log, segments, store = stores
+    ts = store.search(_query(("testid", "segments"), ("msg", "Request")))["hits"]["hits"][EVENTS // 4]["_source"]["ts"]
+    queries = [
+        _query(("testid", "segments"), ("source", "productpage"), ("dest", "reviews")),
+        _query(("testid", "segments"), ("dest", "reviews"), ("msg", "Response"), ("status", 200)),
+        _query(("testid", "segments"), ("reqID", log.headerprefix + "10")),
+        _query(("testid", "segments"), ("host", "10.0.0.0"), ts={"gte": ts}),
+        _query(("testid", "segments"), ("msg", "Request"), ts={"lt": ts}),
+        _query(("testid", "segments"), ("dest", "nowhere")),
+        _query(("testid", "segments"), ("status", 2 ** 20)),
+    ]
+    for body in queries:
+        expected = store.search(body)["hits"]
+        actual = segments.search(body)["hits"]
+        assert actual["total"] == expected["total"], body
+        assert sorted((hit["_source"]["ts"], hit["_source"]["reqID"]) for hit in actual["hits"]) == \
+            sorted((hit["_source"]["ts"], hit["_source"]["reqID"]) for hit in expected["hits"]), body
+    assert segments.count(queries[0]) > 0 and segments.count(queries[-2]) == 0
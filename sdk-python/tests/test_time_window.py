@@ -0,0 +1,52 @@
+# coding=utf-8
+
+import datetime
+import time
+
+import pytest
+
+from gremlin import AssertionChecker, NDJSONSource, SyntheticLog
+
+EVENTS = 300
+
+
+@pytest.fixture
+def shanghai(monkeypatch):
+    """本机时区为 UTC+8，代理(容器没有设置 TZ)按 UTC 记录 ts"""
+    monkeypatch.setenv("TZ", "Asia/Shanghai")
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def _write_log(path: str, start: datetime.datetime) -> str:
+    """从 start (日志时区，不带时区) 开始写出 EVENTS 个事件"""
+    SyntheticLog(test_id="tz", start=start, rps=200).write_ndjson(path, EVENTS)
+    return path
+
+
+def test_window_matches_utc_logs_on_non_utc_host(shanghai, tmp_path):
+    start = datetime.datetime.now(datetime.timezone.utc)
+    path = _write_log(str(tmp_path / "proxy.ndjson"), start.replace(tzinfo=None))
+    # FailureGenerator.get_test_start_time() 返回带时区的 UTC 时间，不带时区的时间视为本地时间
+    for start_time in (start, start.astimezone().replace(tzinfo=None)):
+        ac = AssertionChecker(NDJSONSource(path), "tz", start_time=start_time)
+        assert ac.wait_until_ingested(expected_count=EVENTS, timeout=1) == EVENTS
+        ac.finish()
+        assert ac.wait_until_ingested(expected_count=EVENTS, timeout=1) == EVENTS
+
+
+def test_window_excludes_events_before_start(shanghai, tmp_path):
+    start = datetime.datetime.now(datetime.timezone.utc)
+    path = _write_log(str(tmp_path / "proxy.ndjson"), (start - datetime.timedelta(hours=1)).replace(tzinfo=None))
+    ac = AssertionChecker(NDJSONSource(path), "tz", start_time=start)
+    assert ac.wait_until_ingested(quiet_period=0.1, timeout=0.3) == 0
+
+
+def test_log_timezone(shanghai, tmp_path):
+    local = datetime.timezone(datetime.timedelta(hours=8))
+    start = datetime.datetime.now(datetime.timezone.utc)
+    path = _write_log(str(tmp_path / "proxy.ndjson"), start.astimezone(local).replace(tzinfo=None))
+    ac = AssertionChecker(NDJSONSource(path), "tz", start_time=start, log_timezone=local)
+    assert ac.wait_until_ingested(expected_count=EVENTS, timeout=1) == EVENTS
@@ -0,0 +1,84 @@
+# coding=utf-8
+
+import gzip
+import json
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from gremlin import AssertionChecker, QueryStats, close_transports, get_transport
+
+BODY = json.dumps({"count": 3}).encode()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    status = 200
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.requests += 1
+        data = gzip.compress(BODY)
+        self.send_response(self.server.status)
+        self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def _serve(status=200):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    server.status = status
+    server.requests = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _unused_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture(autouse=True)
+def fresh_transports():
+    close_transports()
+    yield
+    close_transports()
+
+
+def test_fails_over_to_live_node():
+    live, busy = _serve(), _serve(status=503)
+    nodes = ["127.0.0.1:%d" % _unused_port(), "127.0.0.1:%d" % busy.server_port, "127.0.0.1:%d" % live.server_port]
+    transport = get_transport(nodes)
+    for _ in range(4):
+        stats = QueryStats()
+        assert transport.request("POST", "/_count", b"{}", stats=stats) == {"count": 3}
+        assert stats.transfer_bytes == len(gzip.compress(BODY))
+    # 失败的节点暂停使用，之后的请求直接发给可用的节点
+    assert busy.requests == 1 and live.requests == 4
+
+
+def test_gives_up_after_max_retries():
+    transport = get_transport(["127.0.0.1:%d" % _unused_port()], max_retries=1)
+    with pytest.raises(Exception):
+        transport.request("POST", "/_count", b"{}")
+
+
+def test_conflicting_options_raise():
+    host = "127.0.0.1:%d" % _serve().server_port
+    transport = get_transport(host, pool_maxsize=4)
+    assert get_transport(host) is transport
+    assert get_transport(host, pool_maxsize=4) is transport
+    with pytest.raises(ValueError):
+        get_transport(host, pool_maxsize=20)
+    with pytest.raises(ValueError):
+        AssertionChecker(host, "t", transport_options={"compress_requests": True})
+    close_transports()
+    ac = AssertionChecker(host, "t", transport_options={"compress_requests": True})
+    assert ac.wait_until_ingested(expected_count=3, timeout=1) == 3